@@ -0,0 +1,82 @@
+"""
+Line Protocol Encoding Benchmark
+================================
+
+Compares the columnar line protocol encoder against building influxdb_client
+Point objects sample by sample, as the legacy burst writer does. This runs
+entirely offline, using synthetic data.
+
+    python benchmarks/lineprotocol.py --rows 1000000
+"""
+
+import time
+import argparse
+import datetime
+
+import numpy
+import polars
+from influxdb_client import Point
+
+from tendril.connectors.influxdb.lineprotocol import LineProtocolEncoder
+
+
+def synthetic_frame(rows, sites=16):
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    rng = numpy.random.default_rng(0)
+    return polars.DataFrame({
+        '_time': polars.datetime_range(
+            start, start + datetime.timedelta(seconds=rows - 1),
+            interval='1s', eager=True, time_zone='UTC'),
+        'site': [f'site {x}' for x in rng.integers(0, sites, rows)],
+        'value': rng.normal(100, 10, rows),
+        'count': rng.integers(0, 1000, rows),
+    })
+
+
+def encode_points(df):
+    lines = []
+    for ts, site, value, count in df.iter_rows():
+        point = Point('benchmark')
+        point.tag('host', 'bench').tag('site', site)
+        point.field('count', count).field('value', value)
+        point.time(ts)
+        lines.append(point.to_line_protocol())
+    return '\n'.join(lines).encode()
+
+
+def encode_columnar(df, chunk_rows):
+    encoder = LineProtocolEncoder('benchmark', ['value', 'count'],
+                                  tags={'host': 'bench'}, tag_columns=['site'],
+                                  chunk_rows=chunk_rows)
+    return b'\n'.join(x for _, x in encoder.chunks(df))
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    rv = func(*args)
+    return time.perf_counter() - start, rv
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--chunk-rows', type=int, default=5000)
+    args = parser.parse_args()
+
+    df = synthetic_frame(args.rows)
+    point_time, point_payload = timed(encode_points, df)
+    columnar_time, columnar_payload = timed(encode_columnar, df,
+                                            args.chunk_rows)
+
+    assert point_payload.count(b'\n') == columnar_payload.count(b'\n')
+    for name, elapsed, payload in (
+            ('Point', point_time, point_payload),
+            ('Columnar', columnar_time, columnar_payload)):
+        print(f"{name:>10} : {elapsed:8.3f} s  "
+              f"{args.rows / elapsed:12,.0f} rows/s  "
+              f"{len(payload) / 2 ** 20:8.1f} MiB")
+    print(f"{'Speedup':>10} : {point_time / columnar_time:8.1f} x")
+
+
+if __name__ == '__main__':
+    main()
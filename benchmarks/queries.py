@@ -0,0 +1,194 @@
+"""
+Query Execution Benchmark
+=========================
+
+Times query plans for each exporter end to end (planning, building,
+executing and repacking) against a local stand-in for the InfluxDB query
+API serving synthetic data. This runs entirely offline. See standin.py for
+how responses are produced.
+
+For each exporter, a plan with one item per channel is executed repeatedly,
+and the latency percentiles of planning and building alone and of the
+complete execution are reported, along with the response bytes transferred
+per execution and the peak Python heap allocated during one execution.
+Allocations made by polars outside the Python heap are not included in the
+latter.
+
+    python benchmarks/queries.py --channels 64 --rate 10 --span 86400
+"""
+
+import time
+import asyncio
+import argparse
+import datetime
+import tracemalloc
+
+import numpy
+
+from tendril.config import INFLUXDB_ORG
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import QueryTimeSpanTModel
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+from tendril.connectors.influxdb import aio
+from tendril.connectors.influxdb.pool import InfluxDBClientPool
+from tendril.connectors.influxdb.query.planner import InfluxDBQueryPlanner
+from tendril.connectors.influxdb.query.sharded import ShardedFluxQueryBuilder
+
+from standin import SyntheticDataset
+from standin import StandInServer
+from standin import annotated_csv
+from standin import render_response
+
+
+def build_plan(dataset, domain, exporter, time_span, quantiles=None, shards=1):
+    plan = InfluxDBQueryPlanner(segment_cache=False, shards=shards,
+                                shard_min_span=0)
+    if exporter != TimeSeriesExporter.WINDOWED_BAND:
+        quantiles = None
+    for idx, series in enumerate(dataset.series):
+        plan.add_item(TimeSeriesQueryItemTModel(
+            domain=domain, export_name=f'ch{idx}',
+            measurement=series['measurement'], tags=series['tags'],
+            fields=['value'], exporter=exporter, time_span=time_span,
+            quantiles=quantiles,
+        ))
+    return plan
+
+
+def register_responses(server, dataset, plan):
+    # Queries render identically on every execution, so responses are
+    # computed once for the queries of a plan. Sharded builders run the
+    # queries of their shards.
+    for domain in plan.query_domains():
+        for _, builder in plan.generate_queries(domain):
+            if isinstance(builder, ShardedFluxQueryBuilder):
+                builders = builder.shard_builders()
+            else:
+                builders = [builder]
+            for x in builders:
+                server.register(x.build(),
+                                annotated_csv(render_response(dataset, x)))
+
+
+def plan_and_build(plan_factory):
+    plan = plan_factory()
+    for domain in plan.query_domains():
+        for _, builder in plan.generate_queries(domain):
+            builder.build()
+
+
+async def execute(plan_factory):
+    rv = await aio.influxdb_execute_query_plan(plan_factory())
+    for domain, results in rv.items():
+        for name, result in results.items():
+            if result.get('error'):
+                raise RuntimeError(f"Query {name} in {domain} failed : "
+                                   f"{result['error']}")
+    return rv
+
+
+def percentiles(samples):
+    return [x * 1000 for x in numpy.percentile(samples, [50, 90, 99])]
+
+
+async def run_exporter(server, plan_factory, iterations):
+    await execute(plan_factory)
+
+    build_times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        plan_and_build(plan_factory)
+        build_times.append(time.perf_counter() - start)
+
+    server.reset_counters()
+    total_times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await execute(plan_factory)
+        total_times.append(time.perf_counter() - start)
+    requests = server.requests / iterations
+    transferred = server.bytes_sent / iterations
+
+    tracemalloc.start()
+    await execute(plan_factory)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return build_times, total_times, requests, transferred, peak
+
+
+async def run(args):
+    end = datetime.datetime(2024, 1, 2, tzinfo=datetime.timezone.utc)
+    time_span = QueryTimeSpanTModel(
+        end=end, width=datetime.timedelta(seconds=args.span),
+        window_count=args.windows)
+    # Data starts a little before the time span, so that items have open
+    # values.
+    start = time_span.start - datetime.timedelta(seconds=10 * args.rate)
+    dataset = SyntheticDataset(
+        args.channels, start, end,
+        rate=args.rate, tag_cardinality=args.tag_cardinality)
+    print(f"{len(dataset)} channels, {dataset.rows:,} rows, "
+          f"{args.span} s span, {args.iterations} iterations")
+
+    server = StandInServer(port=args.port).start()
+    aio._client_pool = InfluxDBClientPool({args.domain: {
+        'url': server.url, 'token': 'benchmark', 'org': INFLUXDB_ORG}})
+    if not args.cache:
+        aio._query_cache = None
+
+    exporters = [TimeSeriesExporter[x] for x in args.exporters] \
+        if args.exporters else list(TimeSeriesExporter)
+
+    print(f"{'Exporter':>22} | {'Plan+build ms (p50/p90/p99)':>28} | "
+          f"{'Total ms (p50/p90/p99)':>28} | {'Requests':>8} | "
+          f"{'KiB':>10} | {'Peak MiB':>8}")
+    try:
+        for exporter in exporters:
+            def plan_factory():
+                return build_plan(dataset, args.domain, exporter, time_span,
+                                  quantiles=args.quantiles, shards=args.shards)
+            register_responses(server, dataset, plan_factory())
+            build_times, total_times, requests, transferred, peak = \
+                await run_exporter(server, plan_factory, args.iterations)
+            build_ms = '/'.join(f'{x:.2f}' for x in percentiles(build_times))
+            total_ms = '/'.join(f'{x:.1f}' for x in percentiles(total_times))
+            print(f"{exporter.value:>22} | {build_ms:>28} | {total_ms:>28} | "
+                  f"{requests:>8.0f} | {transferred / 2 ** 10:>10,.1f} | "
+                  f"{peak / 2 ** 20:>8.1f}")
+    finally:
+        await aio.influxdb_close_clients()
+        server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--domain', default=INFLUXDB_BUCKETS[0],
+                        help="Configured domain to query. Its bucket name "
+                             "is only used to render queries.")
+    parser.add_argument('--channels', type=int, default=32)
+    parser.add_argument('--rate', type=int, default=10,
+                        help="Seconds between samples of each channel")
+    parser.add_argument('--tag-cardinality', type=int, default=4,
+                        help="Number of distinct device tag values")
+    parser.add_argument('--span', type=int, default=86400,
+                        help="Time span of the queries, in seconds")
+    parser.add_argument('--windows', type=int, default=240,
+                        help="Number of windows of windowed exporters")
+    parser.add_argument('--quantiles', type=float, nargs='*',
+                        default=[0.5, 0.95])
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--exporters', nargs='*',
+                        help="Names of the exporters to run. Defaults to all.")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Number of time shards to split the queries into")
+    parser.add_argument('--cache', action='store_true',
+                        help="Leave the query cache enabled, if it is "
+                             "configured")
+    parser.add_argument('--port', type=int, default=18086)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,360 @@
+"""
+InfluxDB Query Stand-in
+=======================
+
+Synthetic tendril-style series, and a local HTTP server which answers
+``/api/v2/query`` requests with annotated CSV, for running query benchmarks
+without an InfluxDB server.
+
+The stand-in does not interpret Flux. The response to each query is
+computed from the synthetic data using the structure of the builder which
+renders it, and registered against the rendered query before the query is
+executed. Requests for queries which are not registered get an empty
+response. Responses have the shape InfluxDB would give them, so the client
+side parsing and repacking work is representative, even though values of
+computed results (aggregates, windows) are only approximately what Flux
+would produce.
+"""
+
+import asyncio
+import datetime
+import threading
+
+import numpy
+import polars
+from aiohttp import web
+
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.connectors.influxdb.query.builder import (
+    SimpleFluxQueryBuilder,
+    ChangesOnlyFluxQueryBuilder,
+    DiscontinuitiesOnlyFluxQueryBuilder,
+    DecimatedFluxQueryBuilder,
+    BatchedFluxQueryBuilder,
+    AggregatedFluxQueryBuilder,
+    GroupedAggregateFluxQueryBuilder,
+    WindowedFluxQueryBuilder,
+    _band_statistics,
+    _band_columns,
+    _quantile_name,
+)
+from tendril.connectors.influxdb.query.sharded import (
+    ShardBatchedFluxQueryBuilder,
+)
+from tendril.connectors.influxdb.query.decimation import minmax_decimate
+
+
+_datatypes = {
+    polars.Float64: 'double',
+    polars.Int64: 'long',
+    polars.UInt32: 'long',
+    polars.Boolean: 'boolean',
+    polars.String: 'string',
+}
+
+
+class SyntheticDataset(object):
+    """
+    Synthetic ``value`` field series of a single domain.
+
+    :param channels: Number of series.
+    :param start: Start of the data, a timezone aware datetime.
+    :param end: End of the data.
+    :param rate: Seconds between consecutive samples of each series.
+    :param tag_cardinality: Number of distinct values of the ``device`` tag.
+                            Channels are spread across devices, and channels
+                            of different devices share measurement names.
+    :param hold: Probability that a sample repeats the previous value, as
+                 slowly changing monitored values do.
+    """
+    def __init__(self, channels, start, end, rate=10, tag_cardinality=4,
+                 hold=0.8, seed=0):
+        rng = numpy.random.default_rng(seed)
+        times = polars.datetime_range(start, end, interval=f'{rate}s',
+                                      eager=True, closed='left',
+                                      time_zone='UTC') \
+            .cast(polars.Datetime('ns', 'UTC'))
+        self.series = []
+        for idx in range(channels):
+            steps = numpy.where(rng.random(len(times)) < hold, 0.0,
+                                numpy.round(rng.normal(0, 5, len(times)), 1))
+            values = numpy.round(100 + numpy.cumsum(steps), 1)
+            self.series.append({
+                'measurement': f'channel{idx // tag_cardinality}',
+                'tags': {'device': f'device{idx % tag_cardinality}'},
+                'frame': polars.DataFrame({'_time': times, '_value': values}),
+            })
+        self._index = {(x['measurement'], tuple(sorted(x['tags'].items()))): x
+                       for x in self.series}
+
+    def __len__(self):
+        return len(self.series)
+
+    @property
+    def rows(self):
+        return sum(x['frame'].height for x in self.series)
+
+    def frame(self, measurement, tags):
+        series = self._index.get((measurement, tuple(sorted(tags.items()))))
+        if series is None:
+            return polars.DataFrame(
+                schema={'_time': polars.Datetime('ns', 'UTC'),
+                        '_value': polars.Float64})
+        return series['frame']
+
+
+def annotated_csv(results):
+    """
+    Serialize a dict of result name to DataFrame as an annotated CSV
+    response, with each result as a single table. Empty results are left
+    out, as InfluxDB does.
+    """
+    blocks = []
+    for name, df in results.items():
+        if df.is_empty():
+            continue
+        columns = []
+        datatypes = []
+        for column, dtype in df.schema.items():
+            if isinstance(dtype, polars.Datetime):
+                columns.append(polars.col(column)
+                               .dt.to_string('%Y-%m-%dT%H:%M:%S%.9fZ'))
+                datatypes.append('dateTime:RFC3339')
+            else:
+                columns.append(polars.col(column))
+                datatypes.append(_datatypes.get(dtype, 'string'))
+        df = df.select(columns).with_columns(
+            polars.lit('').alias('__result'), polars.lit(0).alias('__table'))
+        df = df.select(['__result', '__table'] + [x for x in df.columns
+                                                  if not x.startswith('__')])
+        header = [f"#datatype,string,long,{','.join(datatypes)}",
+                  f"#group,false,false,{','.join(['false'] * len(datatypes))}",
+                  f"#default,{name},,{','.join([''] * len(datatypes))}",
+                  f",result,table,{','.join(df.columns[2:])}"]
+        body = df.write_csv(include_header=False, line_terminator='\r\n')
+        body = ''.join(f',{x}\r\n' for x in body.split('\r\n') if x)
+        blocks.append('\r\n'.join(header) + '\r\n' + body)
+    return '\r\n'.join(blocks).encode() + b'\r\n'
+
+
+def _span(builder, params=None):
+    time_span = (params or builder).time_span
+    return tuple(datetime.datetime.fromtimestamp(int(x.timestamp()),
+                                                 datetime.timezone.utc)
+                 for x in (time_span.start, time_span.end))
+
+
+def _raw(dataset, params, start, end):
+    df = dataset.frame(params.measurement, params.tags)
+    rv = df.filter((polars.col('_time') >= start) &
+                   (polars.col('_time') < end))
+    if params.include_ends:
+        before = df.filter(polars.col('_time') < start).tail(1)
+        rv = polars.concat([before, rv])
+    return rv
+
+
+def _changes(df):
+    changed = polars.col('_value').ne_missing(polars.col('_value').shift(1))
+    last = polars.int_range(polars.len()) == polars.len() - 1
+    return df.filter(changed | last)
+
+
+def _discontinuities(df, step_size):
+    lower, upper = step_size
+    before = polars.col('_value').diff()
+    after = polars.col('_value').shift(-1) - polars.col('_value')
+    index = polars.int_range(polars.len())
+    return df.filter((index == 0) | (index == polars.len() - 1) |
+                     (before < lower) | (before > upper) |
+                     (after < lower) | (after > upper))
+
+
+def _item_rows(dataset, builder):
+    params = builder._params
+    start, end = _span(builder)
+    df = _raw(dataset, params, start, end)
+    if isinstance(builder, ChangesOnlyFluxQueryBuilder):
+        df = _changes(df)
+    elif isinstance(builder, DiscontinuitiesOnlyFluxQueryBuilder):
+        df = _discontinuities(df, builder.step_size)
+    elif isinstance(builder, DecimatedFluxQueryBuilder):
+        # The reduction done in flux, which the repacker repeats.
+        df = minmax_decimate(df, '_value', *builder._bucket_bounds)
+    return df.rename({'_value': params.measurement})
+
+
+def _statistics(column='_value'):
+    return [polars.col(column).min().alias('min'),
+            polars.col(column).mean().alias('mean'),
+            polars.col(column).max().alias('max')]
+
+
+def _aggregate(df, exporter):
+    if exporter in (TimeSeriesExporter.AGGREGATE_BAND, 'band'):
+        return df.select(_statistics())
+    if exporter in (TimeSeriesExporter.AGGREGATE_MEAN, 'mean'):
+        return df.select(polars.col('_value').mean())
+    if exporter in (TimeSeriesExporter.AGGREGATE_SUM, 'sum'):
+        return df.select(polars.col('_value').sum())
+    return df.select(polars.col('_value').count().cast(polars.Int64))
+
+
+def _windowed(dataset, builder):
+    start, end = _span(builder)
+    width = builder.time_span.window_width
+    frames = []
+    for params in builder._items:
+        df = _raw(dataset, params, start, end)
+        opening = df.filter(polars.col('_time') < start)
+        df = df.filter(polars.col('_time') >= start)
+        windows = df.group_by_dynamic('_time', every=width, closed='left',
+                                      label='right') \
+            .agg([polars.col('_value').mean().alias('mean'),
+                  polars.col('_value').sum().alias('sum'),
+                  polars.col('_value').count().cast(polars.Float64)
+                  .alias('count'),
+                  polars.col('_value').min().alias('min'),
+                  polars.col('_value').max().alias('max')] +
+                 [polars.col('_value').quantile(q).alias(_quantile_name(q))
+                  for q in params.quantiles or []])
+        if params.exporter == TimeSeriesExporter.WINDOWED_BAND:
+            statistics = list(_band_statistics) + \
+                [_quantile_name(q) for q in params.quantiles or []]
+            windows = windows.select(['_time'] + [
+                polars.col(x).alias(c)
+                for x, c in zip(statistics, _band_columns(params))])
+        else:
+            column = {
+                TimeSeriesExporter.WINDOWED_MEAN: 'mean',
+                TimeSeriesExporter.WINDOWED_SUM: 'sum',
+                TimeSeriesExporter.WINDOWED_COUNT: 'count',
+            }[params.exporter]
+            windows = windows.select(
+                '_time', polars.col(column).alias(params.export_name))
+        if not opening.is_empty():
+            opening = opening.select(['_time'] +
+                                     [polars.col('_value').alias(x)
+                                      for x in windows.columns[1:]])
+            windows = polars.concat([opening, windows])
+        frames.append(windows)
+    rv = frames[0]
+    for df in frames[1:]:
+        rv = rv.join(df, on='_time', how='full', coalesce=True)
+    return {'_result': rv.sort('_time')}
+
+
+def _grouped(dataset, builder):
+    rv = {}
+    for branch_idx, (key, items) in enumerate(builder._branches().items()):
+        include_ends, tag_keys = key
+        for aggregator in dict.fromkeys(builder._aggregator(x) for x in items):
+            rows = []
+            for params in items:
+                if builder._aggregator(params) != aggregator:
+                    continue
+                start, end = _span(builder, params)
+                df = _aggregate(_raw(dataset, params, start, end), aggregator)
+                field = params.fields[0] if params.fields else 'value'
+                rows.append(df.with_columns(
+                    [polars.lit(params.measurement).alias('_measurement'),
+                     polars.lit(field).alias('_field')] +
+                    [polars.lit(params.tags.get(x, '')).alias(x)
+                     for x in tag_keys]))
+            rv[builder._result_name(branch_idx, aggregator)] = \
+                polars.concat(rows, how='diagonal_relaxed')
+    return rv
+
+
+def render_response(dataset, builder):
+    """
+    Compute the response to the builder's query from the dataset, as a
+    dict of result name to DataFrame.
+    """
+    if isinstance(builder, BatchedFluxQueryBuilder):
+        rv = {name: _item_rows(dataset, x)
+              for name, x in builder._builders.items()}
+        if isinstance(builder, ShardBatchedFluxQueryBuilder):
+            for name, x in builder.edge_builders.items():
+                df = _item_rows(dataset, x)
+                rv[builder.edges_name(name)] = \
+                    polars.concat([df.head(2), df.tail(2)])
+        return rv
+    if isinstance(builder, WindowedFluxQueryBuilder):
+        return _windowed(dataset, builder)
+    if isinstance(builder, GroupedAggregateFluxQueryBuilder):
+        return _grouped(dataset, builder)
+    if isinstance(builder, AggregatedFluxQueryBuilder):
+        params = builder._params
+        start, end = _span(builder)
+        df = _aggregate(_raw(dataset, params, start, end), params.exporter)
+        measurement = polars.lit(params.measurement).alias('_measurement')
+        return {'_result': df.with_columns(measurement)}
+    if isinstance(builder, SimpleFluxQueryBuilder):
+        return {'_result': _item_rows(dataset, builder)}
+    raise TypeError(f"The stand-in cannot answer queries of "
+                    f"{type(builder).__name__}")
+
+
+class StandInServer(object):
+    """
+    Local HTTP server answering registered queries. The server runs its own
+    event loop in a background thread, so that serving responses does not
+    hold up the event loop of the client being measured.
+    """
+    def __init__(self, host='127.0.0.1', port=18086):
+        self.host = host
+        self.port = port
+        self._responses = {}
+        self._loop = None
+        self._thread = None
+        self._runner = None
+        self.requests = 0
+        self.bytes_sent = 0
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def register(self, query, body):
+        self._responses[query] = body
+
+    def reset_counters(self):
+        self.requests = 0
+        self.bytes_sent = 0
+
+    async def _query(self, request):
+        query = (await request.json())['query']
+        body = self._responses.get(query, b'')
+        self.requests += 1
+        self.bytes_sent += len(body)
+        return web.Response(body=body, content_type='text/csv')
+
+    async def _start(self):
+        app = web.Application(client_max_size=2 ** 26)
+        app.router.add_post('/api/v2/query', self._query)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def _run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        future = asyncio.run_coroutine_threadsafe(self._runner.cleanup(),
+                                                  self._loop)
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
@@ -70,7 +70,254 @@ config_elements_influxdb = [
         'INFLUXDB_BUCKETS',
         "[]",
         "InfluxDB buckets to be made available to the application."
-    )
+    ),
+    ConfigOption(
+        'INFLUXDB_CLIENT_MAX_CONNECTIONS',
+        "10",
+        "Maximum number of simultaneous HTTP connections held by the "
+        "pooled async client of each InfluxDB bucket domain."
+    ),
+    ConfigOption(
+        'INFLUXDB_CLIENT_KEEPALIVE_TIMEOUT',
+        "30",
+        "Time in seconds for which idle HTTP connections to InfluxDB are "
+        "kept open for reuse by the pooled async clients."
+    ),
+    ConfigOption(
+        'INFLUXDB_CLIENT_IDLE_TIMEOUT',
+        "300",
+        "Time in seconds after which a pooled async client which has not "
+        "been used is closed and discarded. It will be recreated when next "
+        "needed."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_CONCURRENCY',
+        "16",
+        "Maximum number of queries which may be in flight against the "
+        "InfluxDB server at any time, across all domains."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_DOMAIN_CONCURRENCY',
+        "8",
+        "Maximum number of queries which may be in flight against any single "
+        "InfluxDB bucket domain at any time."
+    ),
+    ConfigOption(
+        'INFLUXDB_STREAM_BATCH_ROWS',
+        "10000",
+        "Number of rows parsed from the response in each batch when "
+        "executing streaming queries."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_CACHE_ENABLED',
+        "False",
+        "Whether repacked query results should be cached. Results served "
+        "from the cache may be up to INFLUXDB_QUERY_CACHE_LIVE_TTL seconds "
+        "old."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_CACHE_MAX_ENTRIES',
+        "1024",
+        "Maximum number of query results held by the in-memory query cache. "
+        "The least recently used results are discarded first."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_CACHE_LIVE_TTL',
+        "5",
+        "Time in seconds for which results of queries whose time span ends "
+        "at or near the present are cached. The bounds of such time spans "
+        "are rounded down to multiples of this when looking up cached "
+        "results, so that queries over a span which moves with the present "
+        "can be served from the cache."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_CACHE_HISTORICAL_TTL',
+        "3600",
+        "Time in seconds for which results of queries over historical time "
+        "spans are cached."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_CACHE_LIVE_MARGIN',
+        "300",
+        "Queries whose time span ends less than this many seconds before the "
+        "present are treated as live, since late data may still arrive."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_FLUX_PARAMS',
+        "False",
+        "Whether query time bounds are passed to InfluxDB as Flux params "
+        "instead of being rendered into the query, so that the rendered "
+        "query does not change with the time span. Flux params are not "
+        "supported by all InfluxDB versions."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_PROFILERS',
+        "[]",
+        "Flux profilers to enable for queries with columnar responses, such "
+        "as ['query', 'operator']. Profiler results are attached to the "
+        "query stats passed to query hooks. Profiling adds some overhead on "
+        "the server."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_SLOW_THRESHOLD',
+        "0",
+        "Queries taking longer than this many seconds are logged as slow, "
+        "with a breakdown of where the time was spent. Set to 0 to disable."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_DEFAULT_SAMPLE_RATE',
+        "1",
+        "Sample rate, in points per second, assumed when estimating the cost "
+        "of query items for measurements whose sample rate has not been "
+        "probed."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_SAMPLE_RATE_WINDOW',
+        "3600",
+        "Length in seconds of the recent window over which points are "
+        "counted to probe the sample rates of measurements, for domains "
+        "with query limits."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_SAMPLE_RATE_TTL',
+        "86400",
+        "Time in seconds for which probed sample rates are cached."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_SHARDS',
+        "1",
+        "Number of consecutive time shards long range RAW, CHANGES_ONLY, "
+        "DISCONTINUITIES_ONLY and WINDOWED queries are split into, which "
+        "are then queried concurrently and merged. Set to 1 to disable."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_SHARD_MIN_SPAN',
+        "7 * 86400",
+        "Minimum length in seconds of the time span of a query for it to "
+        "be split into time shards."
+    ),
+    ConfigOption(
+        'INFLUXDB_QUERY_SHARD_CONCURRENCY',
+        "4",
+        "Maximum number of the time shards of a single query which are "
+        "queried concurrently."
+    ),
+    ConfigOption(
+        'INFLUXDB_SEGMENT_CACHE_ENABLED',
+        "False",
+        "Whether RAW and WINDOWED query items should be served from the "
+        "incremental segment cache, querying InfluxDB only for the parts of "
+        "the time span not already fetched. Windowed items are then always "
+        "returned as complete windows aligned to the window width."
+    ),
+    ConfigOption(
+        'INFLUXDB_SEGMENT_CACHE_MAX_ROWS',
+        "1000000",
+        "Approximate maximum number of rows held by the segment cache. The "
+        "least recently used series are discarded first."
+    ),
+    ConfigOption(
+        'INFLUXDB_CHANGES_ONLY_SERVER_SIDE',
+        "True",
+        "Whether CHANGES_ONLY query items with a declared NUMERIC or BOOLEAN "
+        "value_type should have unchanged values filtered out by InfluxDB "
+        "instead of after the full series is received."
+    ),
+    ConfigOption(
+        'INFLUXDB_DECIMATION_METHOD',
+        "'lttb'",
+        "Method used to decimate DECIMATED query items. Either 'lttb', for "
+        "largest-triangle-three-buckets over a min/max preselection, or "
+        "'minmax', for the first, last, min and max points of each bucket."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_BATCH_SIZE',
+        "5000",
+        "Maximum number of points sent to InfluxDB in a single write request "
+        "by the async writer."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_FLUSH_INTERVAL',
+        "1",
+        "Time in seconds after which points buffered by the async writer are "
+        "flushed, even if a full batch has not accumulated."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_MAX_PENDING',
+        "100000",
+        "Maximum number of points the async writer holds in memory. Writers "
+        "wait for pending points to be flushed once this is reached."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_MAX_RETRIES',
+        "5",
+        "Number of times a failed write is retried before its points are "
+        "dropped."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_RETRY_INTERVAL',
+        "1",
+        "Base interval in seconds for the exponential backoff between write "
+        "retries."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_MAX_RETRY_DELAY',
+        "30",
+        "Maximum delay in seconds between write retries."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_GZIP',
+        "True",
+        "Whether write requests from the async writer should be gzip "
+        "compressed."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_SPOOL_DIRECTORY',
+        "None",
+        "Directory for the on-disk write spool of the async writer. Points "
+        "which cannot be written to InfluxDB in time are spooled here and "
+        "written once it recovers. The spool is disabled if this is None."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_SPOOL_MAX_BYTES',
+        "1073741824",
+        "Maximum total size in bytes of the write spool. Points which do not "
+        "fit are dropped."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_SPOOL_SEGMENT_BYTES',
+        "67108864",
+        "Size in bytes of each write spool segment file."
+    ),
+    ConfigOption(
+        'INFLUXDB_WRITER_SPOOL_DRAIN_RATE',
+        "50000",
+        "Maximum rate, in points per second, at which spooled points are "
+        "written back to InfluxDB. Set to 0 for no limit."
+    ),
+    ConfigOption(
+        'INFLUXDB_ROLLUP_TASK_OFFSET',
+        "30",
+        "Delay in seconds after the end of each rollup window before the "
+        "downsampling task for it runs, to allow for late points."
+    ),
+    ConfigOption(
+        'INFLUXDB_ROLLUP_TASK_LOOKBACK',
+        "2",
+        "Number of most recent windows recomputed by each run of a "
+        "downsampling task."
+    ),
+    ConfigOption(
+        'INFLUXDB_ROLLUP_BACKFILL_CHUNK',
+        "86400",
+        "Approximate length in seconds of the chunks in which rollups are "
+        "backfilled over historical data."
+    ),
+    ConfigOption(
+        'INFLUXDB_ROLLUP_BACKFILL_CONCURRENCY',
+        "4",
+        "Maximum number of rollup backfill chunks run concurrently."
+    ),
 ]
 
 
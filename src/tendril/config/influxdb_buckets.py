@@ -20,6 +20,46 @@ def _bucket_config_template(bucket_name):
             "InfluxDB Token to with with the {} data bucket".format(bucket_name),
             masked=True
         ),
+        ConfigOption(
+            'INFLUXDB_{}_ROLLUPS'.format(bucket_name.upper()),
+            "[]",
+            "Downsampled rollup buckets holding {} data, as a list of dicts "
+            "with the keys 'bucket' (bucket name, readable with the {} "
+            "token), 'resolution' (window width in seconds), 'fn' (the "
+            "aggregate function, one of mean, sum, count, min or max), and "
+            "optionally 'retention' (seconds, None if kept forever), "
+            "'delay' (seconds by which the rollup lags the source data) and "
+            "'uniform' (whether the source data has the same number of points "
+            "in every window). Rollup points must be timestamped at the start "
+            "of their window. Windowed queries are served from the coarsest "
+            "rollup whose resolution divides the window width and whose "
+            "retention covers the time span. Mean rollups are only used if "
+            "uniform is set. Windowed means are otherwise served from a sum "
+            "and a count rollup of the same resolution, if both are present. "
+            "Min and max rollups serve the min and max of windowed bands, "
+            "along with a rollup which can serve the mean, all of the same "
+            "resolution. Band quantiles are always read from the source "
+            "bucket. The "
+            "downsampling tasks which feed rollups are managed by "
+            "tendril.connectors.influxdb.tasks."
+            "".format(bucket_name, bucket_name)
+        ),
+        ConfigOption(
+            'INFLUXDB_{}_QUERY_LIMITS'.format(bucket_name.upper()),
+            "{}",
+            "Limits on the estimated cost of each query item of {} data, as "
+            "a dict with the keys 'max_points' (points returned), "
+            "'max_scanned' (points read by InfluxDB), either of which may be "
+            "omitted, and 'action', the action taken for items which exceed "
+            "them. The action is one of 'reject' (the default), 'downgrade' "
+            "(query RAW, CHANGES_ONLY and DISCONTINUITIES_ONLY items as "
+            "WINDOWED_MEAN instead), 'split' (query RAW items in chunks of "
+            "their time span within the limits) or 'warn'. Items the action "
+            "cannot bring within the limits are rejected, as are items which "
+            "would need more than 'max_chunks' (default 100) chunks. Costs "
+            "are estimated from sample rates probed from recent data."
+            "".format(bucket_name)
+        ),
     ]
 
 
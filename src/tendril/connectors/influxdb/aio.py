@@ -1,13 +1,43 @@
 
 
-from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+import time
+import asyncio
+import weakref
+from functools import partial
+from contextlib import nullcontext
+from contextlib import asynccontextmanager
+from .pool import InfluxDBClientPool
+from .cache import QueryCache
+from .cache import _copy_result
+from .cache import MemoryQueryCacheBackend
 from .query.planner import InfluxDBQueryPlanner
+from .query.builder import _buckets
+from .query.columnar import parse_annotated_csv
+from .query.columnar import iter_annotated_csv
+from .query.cost import query_limits
+from .query.cost import sample_rates
+from .query.cost import SampleRateProbeFluxQueryBuilder
+from .instrumentation import QueryStats
+from .instrumentation import LoggingQueryHook
+from .instrumentation import split_profile
+from influxdb_client.domain.query import Query
+from influxdb_client.client._base import _BaseQueryApi
 
 from tendril import config
 from tendril.config import INFLUXDB_SERVER_HOST
 from tendril.config import INFLUXDB_SERVER_PORT
 from tendril.config import INFLUXDB_ORG
 from tendril.config import INFLUXDB_BUCKETS
+from tendril.config import INFLUXDB_QUERY_CONCURRENCY
+from tendril.config import INFLUXDB_QUERY_DOMAIN_CONCURRENCY
+from tendril.config import INFLUXDB_STREAM_BATCH_ROWS
+from tendril.config import INFLUXDB_QUERY_CACHE_ENABLED
+from tendril.config import INFLUXDB_QUERY_CACHE_MAX_ENTRIES
+from tendril.config import INFLUXDB_QUERY_CACHE_LIVE_TTL
+from tendril.config import INFLUXDB_QUERY_CACHE_HISTORICAL_TTL
+from tendril.config import INFLUXDB_QUERY_CACHE_LIVE_MARGIN
+from tendril.config import INFLUXDB_QUERY_PROFILERS
+from tendril.config import INFLUXDB_QUERY_SLOW_THRESHOLD
 
 from tendril.utils import log
 logger = log.get_logger(__name__)
@@ -17,8 +47,6 @@ from influxdb_client.client.warnings import MissingPivotFunction
 warnings.simplefilter("ignore", MissingPivotFunction)
 
 
-# TODO There is no apparent connection pooling going on here.
-
 _influxdb_url = f"http://{INFLUXDB_SERVER_HOST}:{INFLUXDB_SERVER_PORT}"
 
 
@@ -32,27 +60,312 @@ def _get_connection_parameters(domain):
 _connection_parameters = {x: _get_connection_parameters(x)
                           for x in INFLUXDB_BUCKETS}
 
+_client_pool = InfluxDBClientPool(_connection_parameters)
+
+
+_query_cache = None
+if INFLUXDB_QUERY_CACHE_ENABLED:
+    _query_cache = QueryCache(
+        MemoryQueryCacheBackend(INFLUXDB_QUERY_CACHE_MAX_ENTRIES),
+        live_ttl=INFLUXDB_QUERY_CACHE_LIVE_TTL,
+        historical_ttl=INFLUXDB_QUERY_CACHE_HISTORICAL_TTL,
+        live_margin=INFLUXDB_QUERY_CACHE_LIVE_MARGIN,
+    )
+
+
+def influxdb_query_cache():
+    # Returns the query cache, if enabled, to allow access to its stats
+    # or to install a shared backend.
+    return _query_cache
+
+
+_query_hooks = []
+if INFLUXDB_QUERY_SLOW_THRESHOLD:
+    _query_hooks.append(
+        LoggingQueryHook(slow_threshold=INFLUXDB_QUERY_SLOW_THRESHOLD))
+
+
+def influxdb_add_query_hook(hook):
+    # Install a hook to be given the QueryStats of every query executed.
+    # See instrumentation.py.
+    _query_hooks.append(hook)
+
+
+def influxdb_remove_query_hook(hook):
+    _query_hooks.remove(hook)
+
+
+def _record_query(stats):
+    stats.finish()
+    for hook in _query_hooks:
+        try:
+            hook.record(stats)
+        except Exception as e:
+            logger.warning(f"Query hook {hook!r} failed : {e!r}")
+
+
+async def influxdb_close_clients():
+    # Shutdown hook. Closes all pooled clients and their connections.
+    await _client_pool.close()
+
+
+# Semaphores bind to the event loop they are first used in, so the
+# concurrency limits are held separately for each running loop.
+_query_limits = weakref.WeakKeyDictionary()
+
+
+def _get_query_limits(domain):
+    loop = asyncio.get_running_loop()
+    if loop not in _query_limits:
+        global_limit = asyncio.Semaphore(INFLUXDB_QUERY_CONCURRENCY)
+        _query_limits[loop] = (global_limit, {})
+    global_limit, domain_limits = _query_limits[loop]
+    if domain not in domain_limits:
+        domain_limits[domain] = \
+            asyncio.Semaphore(INFLUXDB_QUERY_DOMAIN_CONCURRENCY)
+    return global_limit, domain_limits[domain]
+
+
+@asynccontextmanager
+async def _query_limit(domain):
+    global_limit, domain_limit = _get_query_limits(domain)
+    # The domain limit is acquired first so that queries waiting on a busy
+    # domain do not hold up global slots which other domains could use.
+    async with domain_limit, global_limit:
+        yield
+
+
+# Queries in flight, keyed as the query cache keys them, for each running
+# loop. Identical queries issued while one is already in flight wait for
+# its result instead of being sent to the server again.
+_inflight_queries = weakref.WeakKeyDictionary()
+
+
+def _get_inflight_queries():
+    loop = asyncio.get_running_loop()
+    if loop not in _inflight_queries:
+        _inflight_queries[loop] = {}
+    return _inflight_queries[loop]
+
+
+async def _single_flight(key, fetch):
+    # Each entry holds the task and the number of callers which joined it.
+    # Callers may modify the results they get, so once a query has been
+    # joined every caller, including the one which issued it, gets its own
+    # copy of the result.
+    inflight = _get_inflight_queries()
+    if key in inflight:
+        logger.debug(f"Joining in-flight query {key}")
+        flight = inflight[key]
+        flight[1] += 1
+        return _copy_result(await asyncio.shield(flight[0]))
+    task = asyncio.ensure_future(fetch())
+    flight = inflight[key] = [task, 0]
+    task.add_done_callback(lambda _: inflight.pop(key, None))
+    # Shielded so that a cancelled caller does not cancel the query for
+    # the others waiting on it.
+    rv = await asyncio.shield(task)
+    if flight[1]:
+        return _copy_result(rv)
+    return rv
 
-async def _influxdb_execute_query(client, query, want_data_frame=False):
-    # TODO Investigate Query Profiler.
-    #  https://github.com/influxdata/influxdb-client-python#profile-query
+
+async def _influxdb_execute_columnar_query(query_api, query, params, stats):
+    # This is what the client's query_raw() does, taken apart to time the
+    # server and the transfer separately. Profilers are enabled in the
+    # query's extern, as the client does, without the client printing
+    # the profiler results.
+    extern = _BaseQueryApi._build_flux_ast(params, INFLUXDB_QUERY_PROFILERS)
+    query = Query(query=query, dialect=query_api.default_dialect,
+                  extern=extern)
+    with stats.phase('server'):
+        response = await query_api._post_query(
+            org=query_api._org_param(None), query=query)
+    try:
+        with stats.phase('transfer'):
+            raw = await response.read()
+    finally:
+        response.release()
+    stats.response_bytes += len(raw)
+    with stats.phase('parse'):
+        result = parse_annotated_csv(raw)
+    profile = result.pop('_profiler', None)
+    if profile is not None:
+        stats.profile = split_profile(profile)
+    stats.rows += sum(x.height for x in result.values())
+    return result
+
+
+async def _influxdb_execute_query(client, query, want_data_frame=False,
+                                  want_columnar=False, params=None,
+                                  stats=None):
+    if stats is None:
+        stats = QueryStats(None, None, None)
     query_api = client.query_api()
     logger.debug(f"Executing query : \n{query}")
+    if params:
+        logger.debug(f"Query params : {params}")
+    stats.queries += 1
+    if want_columnar:
+        return await _influxdb_execute_columnar_query(query_api, query,
+                                                      params, stats)
+    with stats.phase('execute'):
+        if want_data_frame:
+            result = await query_api.query_data_frame(query, params=params)
+        else:
+            result = await query_api.query(query, params=params)
     if want_data_frame:
-        result = await query_api.query_data_frame(query)
+        frames = result if isinstance(result, list) else [result]
+        stats.rows += sum(len(x) for x in frames)
     else:
-        result = await query_api.query(query)
+        stats.rows += sum(len(x.records) for x in result)
     return result
 
 
-async def influxdb_execute_query(builder):
-    kwargs = _connection_parameters[builder.domain]
-    async with InfluxDBClientAsync(**kwargs) as client:
-        rv = await _influxdb_execute_query(
-            client, builder.build(),
-            want_data_frame=builder.want_data_frame
-        )
-        rv = builder.repacker(rv)
+def _builder_domain(builder):
+    # Builders hold the bucket of their domain, which need not have the
+    # same name as the domain itself.
+    domains = [x for x, bucket in _buckets.items() if bucket == builder.domain]
+    if len(domains) != 1:
+        raise ValueError(f"Could not determine the domain of bucket "
+                         f"{builder.domain}. Provide the domain explicitly.")
+    return domains[0]
+
+
+async def influxdb_stream_query(builder, batch_rows=INFLUXDB_STREAM_BATCH_ROWS,
+                                domain=None):
+    # Execute the query and yield repacked rows in batches as the response
+    # arrives, instead of buffering the whole response. Batched builders
+    # yield dicts of rows keyed by export name. The query holds its
+    # concurrency slots until the response has been consumed.
+    if domain is None:
+        domain = _builder_domain(builder)
+    if builder.composite:
+        yield await _influxdb_fetch(domain, builder, limited=True)
+        return
+    repacker = builder.stream_repacker()
+    async with _query_limit(domain), _client_pool.client(domain) as client:
+        query_api = client.query_api()
+        query = builder.build()
+        logger.debug(f"Streaming query : \n{query}")
+        # This is how the client's own query_stream() issues the request.
+        # We need the response itself to parse it without FluxRecords.
+        response = await query_api._post_query(
+            org=query_api._org_param(None),
+            query=query_api._create_query(query, query_api.default_dialect,
+                                          builder.query_params))
+        try:
+            async for result, df in iter_annotated_csv(response.content,
+                                                       batch_rows):
+                rows = repacker.feed(result, df)
+                if rows:
+                    yield rows
+        finally:
+            response.release()
+    rows = repacker.finish()
+    if rows:
+        yield rows
+
+
+def _unpack_results(name, builder, data, error=None):
+    if builder.batched:
+        names = builder.strategy.keys()
+        strategies = builder.strategy
+        columns = builder.response_columns
+    else:
+        names = [name]
+        strategies = {name: builder.strategy}
+        columns = {name: builder.response_columns}
+        data = {name: data}
+    rv = []
+    for name in names:
+        result = {'strategy': strategies[name],
+                  'columns': columns[name],
+                  'data': data[name] if data else None}
+        if error:
+            result['error'] = error
+        rv.append((name, result))
+    return rv
+
+
+async def _influxdb_fetch_columnar_query(domain, query, stats):
+    started = time.perf_counter()
+    async with _client_pool.client(domain) as client:
+        stats.add_time('wait', time.perf_counter() - started)
+        return await _influxdb_execute_query(client, query, want_columnar=True,
+                                             stats=stats)
+
+
+async def _influxdb_fetch_columnar(domain, query, stats):
+    # Scripts run by composite builders depend on their state, so these
+    # are only coalesced on the script itself.
+    key = QueryCache.key(domain, None, query)
+    return await _single_flight(
+        key, partial(_influxdb_fetch_columnar_query, domain, query, stats))
+
+
+async def _influxdb_fetch_query(domain, builder, query, limited, stats):
+    started = time.perf_counter()
+    async with _query_limit(domain) if limited else nullcontext():
+        async with _client_pool.client(domain) as client:
+            stats.add_time('wait', time.perf_counter() - started)
+            response = await _influxdb_execute_query(
+                client, query,
+                want_data_frame=builder.want_data_frame,
+                want_columnar=builder.want_columnar,
+                params=builder.query_params,
+                stats=stats
+            )
+    with stats.phase('repack'):
+        return builder.repacker(response)
+
+
+async def _influxdb_fetch_builder(domain, builder, limited, stats):
+    if builder.composite:
+        started = time.perf_counter()
+        async with _query_limit(domain) if limited else nullcontext():
+            stats.add_time('wait', time.perf_counter() - started)
+            return await builder.execute(
+                partial(_influxdb_fetch_columnar, domain, stats=stats))
+    with stats.phase('render'):
+        query = builder.build()
+    stats.query = query
+    bucket = _query_cache.bucket(builder) if _query_cache else None
+    key = QueryCache.key(domain, builder, query, bucket)
+    if _query_cache:
+        rv = await _query_cache.get(key)
+        if rv is not None:
+            stats.cached = True
+            return rv
+    stats.coalesced = key in _get_inflight_queries()
+    rv = await _single_flight(
+        key, partial(_influxdb_fetch_query, domain, builder, query,
+                     limited, stats))
+    if _query_cache and rv is not None:
+        await _query_cache.set(key, rv, builder)
+    return rv
+
+
+async def _influxdb_fetch(domain, builder, limited=False, name=None):
+    # Execute the builder's query and return the repacked data, going
+    # through the query cache if it is enabled. Identical queries already
+    # in flight are joined rather than sent again. If limited, the query
+    # is subject to the concurrency limits. The execution is reported to
+    # the installed query hooks.
+    stats = QueryStats(domain, name, builder)
+    try:
+        return await _influxdb_fetch_builder(domain, builder, limited, stats)
+    except Exception as e:
+        stats.error = repr(e)
+        raise
+    finally:
+        _record_query(stats)
+
+
+async def influxdb_execute_query(builder, domain=None):
+    if domain is None:
+        domain = _builder_domain(builder)
+    rv = await _influxdb_fetch(domain, builder, limited=True)
     return {
         'strategy': builder.strategy,
         'columns': builder.response_columns,
@@ -60,17 +373,48 @@ async def influxdb_execute_query(builder):
     }
 
 
+async def _influxdb_execute_plan_query(domain, name, builder):
+    try:
+        data = await _influxdb_fetch(domain, builder, limited=True, name=name)
+    except Exception as e:
+        logger.error(f"Query {name} in domain {domain} failed : {e!r}")
+        return domain, _unpack_results(name, builder, None, error=str(e))
+    return domain, _unpack_results(name, builder, data)
+
+
+async def influxdb_probe_sample_rates(domain, measurements):
+    # Probe the sample rates of the measurements of the domain which are not
+    # already known, for estimating the cost of query items.
+    rates = sample_rates()
+    missing = rates.missing(domain, measurements)
+    if not missing:
+        return
+    builder = SampleRateProbeFluxQueryBuilder(domain, missing)
+    try:
+        probed = await _influxdb_fetch(domain, builder, limited=True,
+                                       name='sample_rates')
+    except Exception as e:
+        logger.warning(f"Could not probe sample rates in domain "
+                       f"{domain} : {e!r}")
+        return
+    for measurement in missing:
+        rates.set(domain, measurement, *probed.get(measurement, (None, None)))
+
+
 async def influxdb_execute_query_plan(plan: InfluxDBQueryPlanner):
     rv = {}
+    queries = []
+    # Query limits are applied when the queries are generated, and need
+    # the sample rates of the measurements being queried.
+    await asyncio.gather(*[influxdb_probe_sample_rates(x, plan.measurements(x))
+                           for x in plan.query_domains() if query_limits(x)])
     for domain in plan.query_domains():
         rv[domain] = {}
-        kwargs = _connection_parameters[domain]
-        async with InfluxDBClientAsync(**kwargs) as client:
-            for name, builder in plan.generate_queries(domain):
-                response = await _influxdb_execute_query(
-                    client, query=builder.build(),
-                    want_data_frame=builder.want_data_frame)
-                rv[domain][name] = {'strategy': builder.strategy,
-                                    'columns': builder.response_columns,
-                                    'data': builder.repacker(response)}
+        for name, builder in plan.generate_queries(domain):
+            queries.append(_influxdb_execute_plan_query(domain, name, builder))
+    for domain, results in await asyncio.gather(*queries):
+        rv[domain].update(results)
+    for domain in rv.keys():
+        plan.resolve_limits(domain, rv[domain])
+        plan.resolve_duplicates(domain, rv[domain])
     return rv
@@ -0,0 +1,178 @@
+
+
+import re
+import copy
+import time
+import hashlib
+from datetime import datetime
+from collections import OrderedDict
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+def _copy_result(value):
+    # Results are handed out to callers which may modify them, so the
+    # cache holds and returns copies. Rows are tuples of immutable values
+    # and are shared rather than copied.
+    if isinstance(value, dict):
+        return {k: _copy_result(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_result(x) for x in value]
+    if isinstance(value, tuple):
+        return value
+    return copy.deepcopy(value)
+
+
+class QueryCacheBackend(object):
+    # Interface for query result cache storage. Shared backends (redis,
+    # memcached, etc.) can be provided by implementing these methods and
+    # installing an instance using QueryCache.backend.
+
+    async def get(self, key):
+        # Return the cached value, or None if it is not present or expired.
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    async def clear(self):
+        raise NotImplementedError
+
+
+class MemoryQueryCacheBackend(QueryCacheBackend):
+    def __init__(self, max_entries):
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+
+    async def get(self, key):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    async def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class QueryCache(object):
+    # Caches repacked query results, keyed by the domain, the builder type
+    # and strategy, and the rendered flux. Queries whose time span ends
+    # close to the present, or whose last window is partial, are expected
+    # to change as data arrives, and are only cached for live_ttl. Queries
+    # over historical ranges are cached for historical_ttl. The bounds of
+    # live spans are rounded down to multiples of live_ttl in the key, so
+    # that repeated queries over a span moving with the present hit the
+    # cache instead of getting a new key every second.
+    def __init__(self, backend, live_ttl, historical_ttl, live_margin):
+        self._backend = backend
+        self._live_ttl = live_ttl
+        self._historical_ttl = historical_ttl
+        self._live_margin = live_margin
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        return self._backend
+
+    @backend.setter
+    def backend(self, value):
+        self._backend = value
+
+    @staticmethod
+    def _bucket_bounds(builder, query, params, bucket):
+        # Bounds are rendered into the flux in whole seconds, or passed as
+        # datetime params.
+        bounds = {}
+        for value in (builder.time_span.start, builder.time_span.end):
+            ts = int(value.timestamp())
+            bounds[str(ts)] = str(ts - ts % bucket)
+        pattern = r'\b(' + '|'.join(bounds) + r')\b'
+        query = re.sub(pattern, lambda m: bounds[m.group(1)], query)
+        if params:
+            params = dict(params)
+            for name, value in params.items():
+                if isinstance(value, datetime):
+                    ts = int(value.timestamp())
+                    params[name] = datetime.fromtimestamp(
+                        ts - ts % bucket, tz=value.tzinfo)
+        return query, params
+
+    @staticmethod
+    def key(domain, builder, query, bucket=None):
+        # Builders using Flux params render the same query for any time
+        # span, so their params are part of the key. If bucket is given,
+        # the bounds of the builder's time span are rounded down to
+        # multiples of it.
+        params = getattr(builder, 'query_params', None)
+        if bucket:
+            query, params = QueryCache._bucket_bounds(
+                builder, query, params, bucket)
+        rv = hashlib.sha256()
+        strategy = getattr(builder, 'strategy', None)
+        for part in (domain, type(builder).__name__, str(strategy),
+                     query, params):
+            rv.update(str(part).encode())
+            rv.update(b'\0')
+        return rv.hexdigest()
+
+    def _live(self, builder):
+        time_span = builder.time_span
+        if time_span is None or time_span.end is None:
+            return True
+        if time_span.partial_window_end is not None:
+            return True
+        return time_span.end.timestamp() >= time.time() - self._live_margin
+
+    def ttl(self, builder):
+        if self._live(builder):
+            return self._live_ttl
+        return self._historical_ttl
+
+    def bucket(self, builder):
+        # The width, in seconds, to which the bounds of the builder's time
+        # span are rounded in its key, if any. A result cached under the
+        # rounded bounds is at most as far off the requested span as it
+        # may be out of date.
+        time_span = builder.time_span
+        if time_span is None or time_span.start is None or \
+                time_span.end is None:
+            return None
+        if self._live_ttl < 1 or not self._live(builder):
+            return None
+        return int(self._live_ttl)
+
+    async def get(self, key):
+        rv = await self._backend.get(key)
+        if rv is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return _copy_result(rv)
+
+    async def set(self, key, value, builder):
+        ttl = self.ttl(builder)
+        if ttl <= 0:
+            return
+        await self._backend.set(key, _copy_result(value), ttl)
+
+    async def clear(self):
+        await self._backend.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,243 @@
+
+
+import time
+from contextlib import contextmanager
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# Instrumentation of query execution. Each execution of a builder's query
+# is measured into a QueryStats, which is passed to the installed query
+# hooks once the query completes, whether it succeeded or not. Hooks are
+# called inline with query execution and should not block.
+#
+# Time is broken down into the following phases, in seconds :
+#
+#   render    : rendering the builder's Flux
+#   wait      : waiting on the concurrency limits and for a pooled client
+#   server    : from sending the query until the response headers arrive,
+#               which is mostly the time InfluxDB spends running the query
+#   transfer  : reading the response body
+#   parse     : parsing the annotated CSV response
+#   execute   : sending the query and reading and parsing the response, for
+#               builders without columnar responses, where the client does
+#               not allow these to be separated
+#   repack    : repacking the response into the result
+#
+# Phases which do not apply are absent. Queries served from the query cache
+# only have render time, and queries which joined an identical query already
+# in flight have none of the later phases, since they did no work of their
+# own. Composite builders run several scripts, whose phases are summed, and
+# their repacking is not separated from their total.
+
+_phases = ('render', 'wait', 'server', 'transfer', 'parse', 'execute',
+           'repack')
+
+
+class QueryStats(object):
+    def __init__(self, domain, name, builder):
+        self.domain = domain
+        # Name of the query within its plan, if it was executed as part of
+        # one.
+        self.name = name
+        self.builder = type(builder).__name__ if builder is not None else None
+        self.query = None
+        self.timings = {}
+        self.rows = 0
+        self.response_bytes = 0
+        self.queries = 0
+        self.cached = False
+        self.coalesced = False
+        self.error = None
+        # Profiler results, as a dict of profiler name to a list of records,
+        # if profilers are enabled.
+        self.profile = None
+        self.started = time.time()
+        self.duration = None
+        self._started = time.perf_counter()
+
+    def __repr__(self):
+        return f"<QueryStats {self.domain} {self.name or self.builder} " \
+               f"{self.outcome}>"
+
+    @property
+    def outcome(self):
+        if self.error is not None:
+            return 'error'
+        if self.cached:
+            return 'cached'
+        if self.coalesced:
+            return 'coalesced'
+        return 'executed'
+
+    def add_time(self, phase, value):
+        self.timings[phase] = self.timings.get(phase, 0) + value
+
+    @contextmanager
+    def phase(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - started)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+
+    def summary(self):
+        timings = ', '.join(f'{x} {self.timings[x] * 1000:.1f}ms'
+                            for x in _phases if x in self.timings)
+        rv = f"{self.domain} {self.name or '-'} ({self.builder}) " \
+             f"{self.outcome} in {(self.duration or 0) * 1000:.1f}ms"
+        if timings:
+            rv += f" [{timings}]"
+        if self.queries:
+            rv += f", {self.rows} rows, {self.response_bytes} bytes"
+        if self.error is not None:
+            rv += f" : {self.error}"
+        return rv
+
+
+def split_profile(df):
+    # Profiler results are returned as tables of a result named _profiler,
+    # with the profiler identified by their measurement.
+    rv = {}
+    for record in df.to_dicts():
+        measurement = record.pop('_measurement', None) or 'profiler/unknown'
+        record = {k: v for k, v in record.items()
+                  if v is not None and k != 'table'}
+        rv.setdefault(measurement.split('/', 1)[-1], []).append(record)
+    return rv
+
+
+class QueryHook(object):
+    # Interface for query instrumentation hooks. Hooks are installed using
+    # influxdb_add_query_hook().
+
+    def record(self, stats: QueryStats):
+        raise NotImplementedError
+
+
+class LoggingQueryHook(QueryHook):
+    # Logs every query at debug level, and queries slower than the
+    # threshold as warnings.
+    def __init__(self, slow_threshold=None):
+        self._slow_threshold = slow_threshold
+
+    def record(self, stats: QueryStats):
+        if self._slow_threshold and stats.duration > self._slow_threshold:
+            # The query itself is logged at debug level when it is executed.
+            logger.warning(f"Slow query {stats.summary()}")
+            if stats.profile:
+                logger.warning(f"Profile of slow query "
+                               f"{stats.name or stats.builder} : "
+                               f"{stats.profile}")
+        else:
+            logger.debug(f"Query {stats.summary()}")
+
+
+class CounterQueryHook(QueryHook):
+    # Accumulates Prometheus style counters and a histogram of query
+    # durations, labelled by domain, builder and outcome. Use exposition()
+    # to render them in the Prometheus text format, or read counters and
+    # histogram directly to export them some other way.
+    default_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, prefix='tendril_influxdb_query',
+                 buckets=default_buckets):
+        self._prefix = prefix
+        self._buckets = tuple(sorted(buckets))
+        # (metric, labels) -> value, where labels is a tuple of pairs
+        self.counters = {}
+        # labels -> [bucket counts, sum, count]
+        self.histogram = {}
+
+    def _count(self, metric, labels, value=1):
+        key = (metric, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def record(self, stats: QueryStats):
+        labels = (('domain', stats.domain), ('builder', stats.builder))
+        self._count('queries_total', labels + (('outcome', stats.outcome),))
+        for phase, value in stats.timings.items():
+            self._count('phase_seconds_total',
+                        labels + (('phase', phase),), value)
+        self._count('rows_total', labels, stats.rows)
+        self._count('response_bytes_total', labels, stats.response_bytes)
+        if labels not in self.histogram:
+            self.histogram[labels] = [[0] * len(self._buckets), 0, 0]
+        histogram = self.histogram[labels]
+        for idx, bound in enumerate(self._buckets):
+            if stats.duration <= bound:
+                histogram[0][idx] += 1
+        histogram[1] += stats.duration
+        histogram[2] += 1
+
+    @staticmethod
+    def _render_labels(labels):
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    def exposition(self):
+        render = self._render_labels
+        lines = []
+        metrics = {}
+        for (metric, labels), value in self.counters.items():
+            metrics.setdefault(metric, []).append((labels, value))
+        for metric, values in metrics.items():
+            lines.append(f'# TYPE {self._prefix}_{metric} counter')
+            for labels, value in values:
+                lines.append(f'{self._prefix}_{metric}{render(labels)} '
+                             f'{value:g}')
+        if self.histogram:
+            name = f'{self._prefix}_duration_seconds'
+            lines.append(f'# TYPE {name} histogram')
+            for labels, (buckets, total, count) in self.histogram.items():
+                for bound, value in zip(self._buckets, buckets):
+                    le = (('le', f'{bound:g}'),)
+                    lines.append(f'{name}_bucket{render(labels + le)} {value}')
+                le = (('le', '+Inf'),)
+                lines.append(f'{name}_bucket{render(labels + le)} {count}')
+                lines.append(f'{name}_sum{render(labels)} {total:g}')
+                lines.append(f'{name}_count{render(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class OpenTelemetryQueryHook(QueryHook):
+    # Records each query as an OpenTelemetry span, created with the given
+    # tracer (opentelemetry.trace.get_tracer(...)), with phase timings and
+    # counts as span attributes. Spans are created once the query completes,
+    # with its actual start and end times, as children of the span current
+    # where the query was executed.
+    def __init__(self, tracer, span_name='influxdb.query',
+                 include_query=False):
+        self._tracer = tracer
+        self._span_name = span_name
+        self._include_query = include_query
+
+    def record(self, stats: QueryStats):
+        attributes = {
+            'db.system': 'influxdb',
+            'influxdb.domain': stats.domain,
+            'influxdb.builder': stats.builder,
+            'influxdb.outcome': stats.outcome,
+            'influxdb.rows': stats.rows,
+            'influxdb.response_bytes': stats.response_bytes,
+        }
+        if stats.name:
+            attributes['influxdb.query_name'] = stats.name
+        if self._include_query and stats.query:
+            attributes['db.statement'] = stats.query
+        for phase, value in stats.timings.items():
+            attributes[f'influxdb.time.{phase}'] = value
+        start = int(stats.started * 1e9)
+        span = self._tracer.start_span(self._span_name, start_time=start,
+                                       attributes=attributes)
+        if stats.error is not None:
+            span.set_attribute('error.message', stats.error)
+        if stats.profile:
+            for record in stats.profile.get('operator', []):
+                span.add_event('influxdb.operator', attributes={
+                    k: v for k, v in record.items()
+                    if isinstance(v, (str, bool, int, float))})
+        span.end(end_time=start + int(stats.duration * 1e9))
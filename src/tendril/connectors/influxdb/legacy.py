@@ -13,9 +13,9 @@ from tendril.config import INFLUXDB_DEFAULT_BUCKET
 from tendril.config import INFLUXDB_DEFAULT_BUCKET_TOKEN
 
 
-# This is simply copied over from the earlier implementation and is untested.
-# In theory, this should essentially be a fire and forget async writer. In
-# practice, not sure. This is probably Influx 1.x code.
+# This is simply copied over from the earlier implementation. It is retained
+# for existing synchronous users. New code should use the batched asyncio
+# writer in tendril.connectors.influxdb.writer instead.
 
 class InfluxDBAsyncBurstWriter(object):
     def __init__(self, bucket=INFLUXDB_DEFAULT_BUCKET,
@@ -52,7 +52,9 @@ class InfluxDBAsyncBurstWriter(object):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         _async_result = self._write_api.write(bucket=self._bucket,
-                                              record=[self._points])
+                                              record=self._points)
+        # Wait for the write to complete before the client is torn down.
+        _async_result.get()
         self._client.close()
 
 
@@ -0,0 +1,284 @@
+
+
+import io
+import math
+import datetime
+import threading
+import numpy
+import polars
+from decimal import Decimal
+from collections.abc import Mapping
+from numbers import Integral
+from numbers import Real
+
+from tendril.config import INFLUXDB_WRITER_BATCH_SIZE
+
+
+# Line protocol serialization without going through influxdb_client Point
+# objects. Columnar data is serialized using polars expressions, so each
+# chunk of lines is produced by a single native string concatenation rather
+# than by per-sample python objects. Escaping and value formatting follow
+# the influxdb_client Point implementation. Timestamps are always written
+# with nanosecond precision.
+
+_escape_measurement_chars = [',', ' ', '\n', '\t', '\r']
+_escape_key_chars = [',', '=', ' ', '\n', '\t', '\r']
+_escape_string_chars = ['\\', '"']
+
+_escapes = {',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n',
+            '\t': r'\t', '\r': r'\r', '"': r'\"', '\\': '\\\\'}
+
+_epoch = datetime.datetime.fromtimestamp(0, tz=datetime.timezone.utc)
+
+
+def _translation(chars):
+    return str.maketrans({x: _escapes[x] for x in chars})
+
+
+_escape_measurement_table = _translation(_escape_measurement_chars)
+_escape_key_table = _translation(_escape_key_chars)
+_escape_string_table = _translation(_escape_string_chars)
+
+
+def escape_measurement(value):
+    return str(value).translate(_escape_measurement_table)
+
+
+def escape_key(value):
+    return str(value).translate(_escape_key_table)
+
+
+def escape_tag_value(value):
+    rv = escape_key(value)
+    if rv.endswith('\\'):
+        rv += ' '
+    return rv
+
+
+def escape_string(value):
+    return str(value).translate(_escape_string_table)
+
+
+def _escape_expr(expr, chars):
+    for char in chars:
+        expr = expr.str.replace_all(char, _escapes[char], literal=True)
+    return expr
+
+
+def _format_float(value):
+    if not math.isfinite(value):
+        return None
+    rv = str(value)
+    return rv[:-2] if rv.endswith('.0') else rv
+
+
+def _format_value(value):
+    # The common python types are checked for first. numpy scalars are
+    # accepted as well, and other real numbers, such as Decimals, are
+    # written as floats.
+    kind = type(value)
+    if kind is float:
+        return _format_float(value)
+    if kind is int:
+        return f'{value}i'
+    if isinstance(value, (bool, numpy.bool_)):
+        return 'true' if value else 'false'
+    if isinstance(value, Integral):
+        return f'{int(value)}i'
+    if isinstance(value, (Real, Decimal)):
+        if not isinstance(value, (float, numpy.floating)):
+            value = float(value)
+        return _format_float(value)
+    if isinstance(value, str):
+        return f'"{escape_string(value)}"'
+    raise ValueError(f'Type: "{type(value)}" of field value {value} '
+                     f'is not supported.')
+
+
+def _timestamp_ns(ts):
+    if isinstance(ts, Integral):
+        return int(ts)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.timezone.utc)
+    delta = ts - _epoch
+    seconds = delta.days * 86400 + delta.seconds
+    return seconds * 10 ** 9 + delta.microseconds * 1000
+
+
+class PointEncoder(object):
+    """
+    Encodes single points to lines of line protocol, reusing the same
+    buffer for each line. An encoder should not be shared across threads.
+    """
+    def __init__(self):
+        self._buffer = io.StringIO()
+
+    def encode(self, measurement, fields, tags=None, ts=None):
+        """
+        Encode a single point to a line of line protocol.
+
+        Tags and fields are written in sorted order. Fields whose values are
+        None or not finite are omitted. Returns None if no fields remain. If
+        ``ts`` is not given, the current time is used. Naive datetimes are
+        taken to be in UTC, and integers to be nanoseconds since the epoch.
+        """
+        if ts is None:
+            ts = datetime.datetime.now(datetime.timezone.utc)
+        buffer = self._buffer
+        buffer.seek(0)
+        buffer.truncate()
+        buffer.write(escape_measurement(measurement))
+        for key, value in sorted((tags or {}).items()):
+            if value is None or value == '':
+                continue
+            buffer.write(f',{escape_key(key)}={escape_tag_value(value)}')
+        separator = ' '
+        for key, value in sorted(fields.items()):
+            if value is None:
+                continue
+            value = _format_value(value)
+            if value is not None:
+                buffer.write(f'{separator}{escape_key(key)}={value}')
+                separator = ','
+        if separator == ' ':
+            return None
+        buffer.write(f' {_timestamp_ns(ts)}')
+        return buffer.getvalue()
+
+
+_encoders = threading.local()
+
+
+def encode_point(measurement, fields, tags=None, ts=None):
+    """
+    Encode a single point to a line of line protocol, as
+    PointEncoder.encode() does, with an encoder held for each thread.
+    """
+    encoder = getattr(_encoders, 'encoder', None)
+    if encoder is None:
+        encoder = _encoders.encoder = PointEncoder()
+    return encoder.encode(measurement, fields, tags=tags, ts=ts)
+
+
+def as_frame(data):
+    """
+    Coerce columnar data into a polars DataFrame. Accepts polars DataFrames,
+    pyarrow Tables and RecordBatches, and mappings of column names to
+    sequences or numpy arrays.
+    """
+    if isinstance(data, polars.DataFrame):
+        return data
+    if isinstance(data, Mapping):
+        return polars.DataFrame(dict(data))
+    if hasattr(data, 'schema') and hasattr(data, 'num_rows'):
+        return polars.from_arrow(data)
+    raise TypeError(f"Cannot encode data of type {type(data)} "
+                    f"to line protocol.")
+
+
+class LineProtocolEncoder(object):
+    """
+    Serializes columnar data to line protocol.
+
+    :param measurement: Measurement name for all lines.
+    :param fields: Names of the columns to be written as fields.
+    :param tags: Optional mapping of tags to be applied to all lines.
+    :param tag_columns: Names of the columns to be written as tags.
+    :param time_column: Name of the timestamp column. This may be a
+                        datetime column, or an integer column of
+                        nanoseconds since the epoch.
+    :param chunk_rows: Maximum number of lines in each chunk.
+
+    Null values in field and tag columns are omitted from their lines, and
+    rows in which all field values are null are skipped entirely.
+    """
+    def __init__(self, measurement, fields, tags=None, tag_columns=None,
+                 time_column='_time', chunk_rows=INFLUXDB_WRITER_BATCH_SIZE):
+        self._measurement = measurement
+        self._fields = sorted(fields)
+        self._tags = tags or {}
+        self._tag_columns = tag_columns or []
+        self._time_column = time_column
+        self._chunk_rows = chunk_rows
+        overlap = set(self._tags.keys()) & set(self._tag_columns)
+        if overlap:
+            raise ValueError(f"Tags {overlap} are specified both as "
+                             f"constants and columns.")
+
+    def _prefix(self):
+        rv = escape_measurement(self._measurement)
+        for key, value in sorted(self._tags.items()):
+            if value is None or value == '':
+                continue
+            rv += f',{escape_key(key)}={escape_tag_value(value)}'
+        return rv
+
+    def _tag_expr(self, name):
+        value = _escape_expr(polars.col(name).cast(polars.String),
+                             _escape_key_chars)
+        value = polars.when(value.str.ends_with('\\')) \
+            .then(value + ' ').otherwise(value)
+        key = polars.lit(f',{escape_key(name)}=')
+        return polars.when(value != '').then(key + value)
+
+    def _field_expr(self, name, dtype):
+        col = polars.col(name)
+        if dtype == polars.Boolean:
+            value = col.cast(polars.String)
+        elif dtype.is_float():
+            value = polars.when(col.is_finite()).then(
+                col.cast(polars.String).str.replace(r'\.0$', ''))
+        elif dtype.is_unsigned_integer():
+            value = col.cast(polars.String) + 'u'
+        elif dtype.is_integer():
+            value = col.cast(polars.String) + 'i'
+        elif dtype in (polars.String, polars.Categorical):
+            value = _escape_expr(col.cast(polars.String),
+                                 _escape_string_chars)
+            value = '"' + value + '"'
+        else:
+            raise TypeError(f'Type: "{dtype}" of field: "{name}" '
+                            f'is not supported.')
+        return polars.lit(f'{escape_key(name)}=') + value
+
+    def _time_expr(self, dtype):
+        col = polars.col(self._time_column)
+        if isinstance(dtype, polars.Datetime):
+            return col.dt.epoch('ns').cast(polars.String)
+        if dtype.is_integer():
+            return col.cast(polars.String)
+        raise TypeError(f'Type: "{dtype}" of time column: '
+                        f'"{self._time_column}" is not supported.')
+
+    def _line_expr(self, schema):
+        tag_set = [self._tag_expr(x)
+                   for x in sorted(self._tag_columns, key=escape_key)]
+        field_set = polars.concat_str(
+            [self._field_expr(x, schema[x]) for x in self._fields],
+            separator=',', ignore_nulls=True)
+        return polars.concat_str([
+            polars.lit(self._prefix()),
+            polars.concat_str(tag_set, ignore_nulls=True)
+            if tag_set else polars.lit(''),
+            polars.lit(' '), field_set,
+            polars.lit(' '), self._time_expr(schema[self._time_column]),
+        ]), field_set
+
+    def chunks(self, data):
+        """
+        Generate ``(lines, payload)`` tuples, where ``payload`` is a bytes
+        object containing up to ``chunk_rows`` newline separated lines.
+        """
+        df = as_frame(data)
+        line, field_set = self._line_expr(df.schema)
+        for chunk in df.iter_slices(self._chunk_rows):
+            lines = chunk.select(line.alias('line'),
+                                 field_set.alias('fields')) \
+                .filter(polars.col('line').is_not_null() &
+                        (polars.col('fields') != ''))['line']
+            if not len(lines):
+                continue
+            yield len(lines), lines.str.join('\n').item().encode()
+
+    def encode(self, data):
+        return b'\n'.join(x for _, x in self.chunks(data))
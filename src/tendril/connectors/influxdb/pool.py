@@ -0,0 +1,133 @@
+
+
+import time
+import asyncio
+import aiohttp
+from contextlib import asynccontextmanager
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+from tendril.config import INFLUXDB_CLIENT_MAX_CONNECTIONS
+from tendril.config import INFLUXDB_CLIENT_KEEPALIVE_TIMEOUT
+from tendril.config import INFLUXDB_CLIENT_IDLE_TIMEOUT
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+def _client_session_factory(connector=None, **kwargs):
+    # The async client constructs its own TCPConnector and does not expose
+    # the keep-alive timeout, so the session is given an equivalent one
+    # which sets it instead. The client's connector has not opened any
+    # connections yet, and is simply dropped. The pool does not configure
+    # TLS, so aiohttp's default verification applies, as it does in the
+    # client's connector.
+    connector = aiohttp.TCPConnector(
+        limit=connector.limit,
+        keepalive_timeout=INFLUXDB_CLIENT_KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, **kwargs)
+
+
+class _PooledClient(object):
+    def __init__(self, client, loop):
+        self.client = client
+        self.loop = loop
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class InfluxDBClientPool(object):
+    def __init__(self, connection_parameters,
+                 max_connections=INFLUXDB_CLIENT_MAX_CONNECTIONS,
+                 idle_timeout=INFLUXDB_CLIENT_IDLE_TIMEOUT):
+        self._connection_parameters = connection_parameters
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._clients = {}
+
+    def _create_client(self, domain):
+        logger.debug(f"Creating pooled InfluxDB client for {domain}")
+        return InfluxDBClientAsync(
+            **self._connection_parameters[domain],
+            connection_pool_maxsize=self._max_connections,
+            client_session_type=_client_session_factory,
+        )
+
+    async def _discard(self, domain, pooled):
+        # Other tasks may have replaced or discarded the client while this
+        # one was waiting, so it is only discarded if it is still the one
+        # pooled for the domain, and is not in use.
+        if self._clients.get(domain) is not pooled or pooled.users:
+            return
+        del self._clients[domain]
+        await self._close_client(domain, pooled)
+
+    async def _close_client(self, domain, pooled):
+        if pooled.loop is not asyncio.get_running_loop():
+            await self._discard_stale(domain, pooled)
+            return
+        logger.debug(f"Closing pooled InfluxDB client for {domain}")
+        await pooled.client.close()
+
+    @staticmethod
+    async def _discard_stale(domain, pooled):
+        # The client belongs to another event loop. If that loop is still
+        # running, in another thread, the client is closed there. Otherwise
+        # the session is closed from here, which releases its connector.
+        # Sockets of a loop which has already been closed are only closed
+        # when they are collected.
+        logger.debug(f"Closing pooled InfluxDB client for {domain} "
+                     f"from a previous event loop")
+        if pooled.loop.is_running():
+            asyncio.run_coroutine_threadsafe(pooled.client.close(),
+                                             pooled.loop)
+            return
+        try:
+            await pooled.client.close()
+        except Exception as e:
+            logger.warning(f"Could not close stale InfluxDB client "
+                           f"for {domain} : {e!r}")
+
+    async def _evict_idle(self):
+        now = time.monotonic()
+        for domain, pooled in list(self._clients.items()):
+            if pooled.users:
+                continue
+            if now - pooled.last_used > self._idle_timeout:
+                await self._discard(domain, pooled)
+
+    async def _acquire(self, domain):
+        await self._evict_idle()
+        loop = asyncio.get_running_loop()
+        while True:
+            pooled = self._clients.get(domain, None)
+            if not pooled or pooled.loop is loop:
+                break
+            # aiohttp sessions are bound to the loop they were created in.
+            # This only really happens when asyncio.run() is used repeatedly.
+            # A client still in use from another loop is left to its users.
+            if pooled.users:
+                del self._clients[domain]
+                pooled = None
+                break
+            await self._discard(domain, pooled)
+        if not pooled:
+            pooled = _PooledClient(self._create_client(domain), loop)
+            self._clients[domain] = pooled
+        pooled.users += 1
+        return pooled
+
+    @asynccontextmanager
+    async def client(self, domain):
+        pooled = await self._acquire(domain)
+        try:
+            yield pooled.client
+        finally:
+            pooled.users -= 1
+            pooled.last_used = time.monotonic()
+
+    async def close(self):
+        for domain in list(self._clients.keys()):
+            pooled = self._clients.pop(domain, None)
+            if pooled is not None:
+                await self._close_client(domain, pooled)
@@ -2,14 +2,34 @@
 
 import polars
 from functools import partial
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from typing import List
 from polars.exceptions import ColumnNotFoundError
 
 from tendril import config
 from tendril.config import INFLUXDB_BUCKETS
+from tendril.config import INFLUXDB_CHANGES_ONLY_SERVER_SIDE
+from tendril.config import INFLUXDB_QUERY_FLUX_PARAMS
+from tendril.config import INFLUXDB_DECIMATION_METHOD
 from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
 from tendril.core.tsdb.query.models import QueryTimeSpanTModel
 from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.constants import TimeSeriesFundamentalType
+from .columnar import result_frame
+from .columnar import select_columns
+from .streaming import BufferedStreamRepacker
+from .streaming import ColumnsStreamRepacker
+from .streaming import ChangesOnlyStreamRepacker
+from .streaming import BatchedStreamRepacker
+from .rollups import select_rollup
+from .rollups import MeanRollup
+from .rollups import BandRollup
+from .decimation import decimation_methods
+from .decimation import bucket_width
+from .decimation import bucket_offset
+from .decimation import decimate
 from tendril.utils import log
 logger = log.get_logger(__name__)
 
@@ -20,6 +40,66 @@ def _get_bucket(domain):
 _buckets = {x: _get_bucket(x) for x in INFLUXDB_BUCKETS}
 
 
+def _get_aggregator(exporter):
+    match exporter:
+        case TimeSeriesExporter.AGGREGATE_MEAN:
+            aggregator = 'mean'
+        case TimeSeriesExporter.AGGREGATE_SUM:
+            aggregator = 'sum'
+        case TimeSeriesExporter.AGGREGATE_COUNT:
+            aggregator = 'count'
+        case _:
+            raise NotImplementedError("We only presently support mean, sum "
+                                      "and count aggregators")
+    return aggregator
+
+
+# Statistics computed for band exporters. These are accumulated for each
+# window (or for the whole span) in a single reduce() pass over the data.
+_band_statistics = ('min', 'mean', 'max')
+
+
+def _quantile_name(q):
+    return f'p{q * 100:g}'
+
+
+def _band_columns(params: TimeSeriesQueryItemTModel):
+    rv = [f'{params.export_name}_{x}' for x in _band_statistics]
+    if params.exporter == TimeSeriesExporter.WINDOWED_BAND:
+        rv += [f'{params.export_name}_{_quantile_name(q)}'
+               for q in params.quantiles or []]
+    return rv
+
+
+def _render_band_reduce():
+    rv = ' |> toFloat()\n'
+    rv += ' |> reduce(identity: {count: 0, sum: 0.0, min: 0.0, max: 0.0}, ' \
+          'fn: (r, accumulator) => ({\n'
+    rv += '      count: accumulator.count + 1,\n'
+    rv += '      sum: accumulator.sum + r._value,\n'
+    rv += '      min: if accumulator.count == 0 or ' \
+          'r._value < accumulator.min then r._value else accumulator.min,\n'
+    rv += '      max: if accumulator.count == 0 or ' \
+          'r._value > accumulator.max then r._value else accumulator.max,\n'
+    rv += '    }))\n'
+    rv += ' |> map(fn: (r) => ({r with mean: r.sum / float(v: r.count)}))\n'
+    return rv
+
+
+def _render_duration(value):
+    # Window widths are not necessarily whole seconds unless the time span
+    # is aligned. Truncating them would shift every window boundary.
+    if not value.microseconds:
+        return f'{int(value.total_seconds())}s'
+    return f'{value // timedelta(microseconds=1)}us'
+
+
+def _whole_seconds(value):
+    # Time bounds are rendered at a resolution of whole seconds, and are
+    # passed as params at the same resolution.
+    return datetime.fromtimestamp(int(value.timestamp()), tz=timezone.utc)
+
+
 def _escape(name):
     return name \
         .replace(".", "_") \
@@ -30,12 +110,32 @@ def _escape(name):
 class InfluxDBFluxQueryBuilderBase(object):
     _strategy = None
     want_data_frame = False
+    # Columnar builders receive the response as a dict of polars DataFrames
+    # keyed by result name, parsed directly from the annotated CSV.
+    want_columnar = True
+    # Batched builders produce a separate result for each of their items,
+    # and their repacker returns a dict keyed by the item export names.
+    batched = False
+    # Composite builders run one or more queries themselves, through their
+    # execute() method, instead of providing a single script to be run.
+    composite = False
+    # If set, the time bounds are rendered as references to Flux params,
+    # which are sent along with the query (see query_params). The script
+    # then does not change with the time span, unless the builder renders
+    # other parts of the span into it (_span_in_script).
+    use_params = INFLUXDB_QUERY_FLUX_PARAMS
+    _span_in_script = False
+    # The rendered script, kept until the builder is changed.
+    _rendered = None
 
     def __init__(self):
         self._time_span: QueryTimeSpanTModel = None
         self._bucket = None
         self._simple_filters = []
 
+    def _invalidate(self):
+        self._rendered = None
+
     @property
     def bucket(self):
         return self._bucket
@@ -43,6 +143,7 @@ class InfluxDBFluxQueryBuilderBase(object):
     @bucket.setter
     def bucket(self, value):
         self._bucket = _buckets[value]
+        self._invalidate()
 
     def _render_bucket(self):
         return f'from(bucket: "{self._bucket}")\n'
@@ -58,23 +159,39 @@ class InfluxDBFluxQueryBuilderBase(object):
     @time_span.setter
     def time_span(self, value):
         self._time_span = value
+        if not self.use_params or self._span_in_script:
+            self._invalidate()
+
+    @property
+    def query_params(self):
+        if not self.use_params or self._time_span is None:
+            return None
+        return {'_queryStart': _whole_seconds(self._time_span.start),
+                '_queryStop': _whole_seconds(self._time_span.end)}
+
+    def _render_bounds(self):
+        if self.use_params:
+            # The client passes params to the server as options.
+            return '_queryStart', '_queryStop'
+        return int(self._time_span.start.timestamp()), \
+            int(self._time_span.end.timestamp())
 
     def _render_range(self, range=None):
+        start, stop = self._render_bounds()
         if range == 'before':
-            return f' |> range(start: -inf, stop: {int(self._time_span.start.timestamp())})\n'
-        return f' |> range(start: {int(self._time_span.start.timestamp())}, stop: {int(self._time_span.end.timestamp())})\n'
+            return f' |> range(start: -inf, stop: {start})\n'
+        return f' |> range(start: {start}, stop: {stop})\n'
 
     def simple_filter(self, key, value):
         self._simple_filters.append((key, value))
+        self._invalidate()
 
     def _render_simple_filter(self, key, value):
         return f' |> filter(fn: (r) => r["{key}"] == "{value}")\n'
 
     def _render_simple_filters(self):
-        rv = ""
-        for key, value in self._simple_filters:
-            rv += self._render_simple_filter(key, value)
-        return rv
+        return ''.join(self._render_simple_filter(key, value)
+                       for key, value in self._simple_filters)
 
     def _render_selectors(self, range=None):
         rv = self._render_bucket()
@@ -84,11 +201,19 @@ class InfluxDBFluxQueryBuilderBase(object):
         return rv
 
     def build(self):
+        if self._rendered is None:
+            self._rendered = self._render()
+        return self._rendered
+
+    def _render(self):
         raise NotImplementedError
 
     def repacker(self, response):
         return response
 
+    def stream_repacker(self):
+        return BufferedStreamRepacker(self)
+
     @property
     def strategy(self):
         return self._strategy
@@ -127,18 +252,11 @@ class InfluxDBFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
                 ('rangeValues', (self._render_selectors,))
             ]
 
-    def _render_aggregator(self, exporter):
-        match exporter:
-            case TimeSeriesExporter.AGGREGATE_MEAN:
-                aggregator = 'mean'
-            case TimeSeriesExporter.AGGREGATE_SUM:
-                aggregator = 'sum'
-            case TimeSeriesExporter.AGGREGATE_COUNT:
-                aggregator = 'count'
-            case _:
-                raise NotImplementedError("We only presently support mean, sum "
-                                          "and count aggregators")
-        rv = f' |> {aggregator}()\n'
+    @staticmethod
+    def _render_aggregator(exporter):
+        if exporter == TimeSeriesExporter.AGGREGATE_BAND:
+            return _render_band_reduce()
+        rv = f' |> {_get_aggregator(exporter)}()\n'
         return rv
 
     def _render_windowed_aggregator(self, exporter):
@@ -149,46 +267,74 @@ class InfluxDBFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
                 aggregator = 'sum'
             case TimeSeriesExporter.WINDOWED_COUNT:
                 aggregator = 'count'
+            case TimeSeriesExporter.WINDOWED_BAND:
+                return self._render_windowed_band()
             case _:
-                raise NotImplementedError("We only presently support mean, sum "
-                                          "and count aggregators")
-        rv = f' |> aggregateWindow(every: {int(self.time_span.window_width.total_seconds())}s, fn: {aggregator}, createEmpty: false)\n'
+                raise NotImplementedError("We only presently support mean, "
+                                          "sum, count and band aggregators")
+        every = _render_duration(self.time_span.window_width)
+        rv = f' |> aggregateWindow(every: {every}, fn: {aggregator}, ' \
+             f'createEmpty: false)\n'
+        return rv
+
+    def _render_windowed_band(self):
+        # Equivalent to aggregateWindow, with the window stop as the _time
+        # of each row, but with all the band statistics from a single pass.
+        every = _render_duration(self.time_span.window_width)
+        rv = f' |> window(every: {every}, createEmpty: false)\n'
+        rv += _render_band_reduce()
+        rv += ' |> duplicate(column: "_stop", as: "_time")\n'
+        rv += ' |> window(every: inf)\n'
+        return rv
+
+    def _render_windowed_quantile(self, q):
+        every = _render_duration(self.time_span.window_width)
+        rv = f' |> aggregateWindow(every: {every}, '
+        rv += f'fn: (column, tables=<-) => ' \
+              f'tables |> quantile(q: {float(q)!r}, column: column), '
+        rv += 'createEmpty: false)\n'
         return rv
 
     def _reshape_output(self):
         pass
 
-    def _render_union(self):
-        return f'union(tables: [{", ".join([x[0] for x in self._subqueries])}])\n'
+    def _render_union(self, prefix=''):
+        tables = ", ".join([prefix + x[0] for x in self._subqueries])
+        return f'union(tables: [{tables}])\n'
 
     def _render_logic(self):
         return ''
 
-    def build(self):
-        if not self._subqueries:
-            rv = self._render_selectors()
-            rv += self._render_logic()
-            rv += self._reshape_output()
-            return rv
-
-        rv = ''
+    def _render_subqueries(self, prefix=''):
+        parts = []
         for subquery, components in self._subqueries:
-            rv += f'{subquery} = '
-            for component in components:
-                if callable(component):
-                    rv += component()
-                else:
-                    rv += component
-            rv += '\n'
-        rv += self._render_union()
+            parts.append(f'{prefix}{subquery} = ')
+            parts.extend(x() if callable(x) else x for x in components)
+            parts.append('\n')
+        return ''.join(parts)
+
+    def _render_source(self, prefix=''):
+        if not self._subqueries:
+            return self._render_selectors()
+        return self._render_union(prefix=prefix)
+
+    def _render_body(self, prefix=''):
+        # The prefix allows several builders to render into the same
+        # script without their subquery variables colliding.
+        rv = self._render_subqueries(prefix=prefix)
+        rv += self._render_source(prefix=prefix)
         rv += self._render_logic()
         rv += self._reshape_output()
         return rv
 
-    want_data_frame = False
+    def _render(self):
+        return self._render_body()
 
     def repacker(self, response):
-        return response.to_values(columns=['_time', self._params.measurement])
+        return self.repack_frame(result_frame(response))
+
+    def repack_frame(self, df):
+        return select_columns(df, ['_time', self._params.measurement]).rows()
 
 
 class SimpleFluxQueryBuilder(InfluxDBFluxQueryBuilder):
@@ -206,12 +352,15 @@ class SimpleFluxQueryBuilder(InfluxDBFluxQueryBuilder):
         columns_str = ", ".join([f'"{x}"' for x in columns])
         pivot_columns = ["_time"] + self._extra_columns
         pivot_columns_str = ", ".join([f'"{x}"' for x in pivot_columns])
-        rv =  f' |> keep(columns: [{columns_str}])\n'
+        rv = f' |> keep(columns: [{columns_str}])\n'
         rv += f' |> pivot(rowKey:[{pivot_columns_str}], columnKey: ["_measurement"], valueColumn: "_value")\n'
-        rv += f' |> group()\n'
-        rv += f' |> sort(columns: ["_time"], desc: false)\n'
+        rv += ' |> group()\n'
+        rv += ' |> sort(columns: ["_time"], desc: false)\n'
         return rv
 
+    def stream_repacker(self):
+        return ColumnsStreamRepacker(['_time', self._params.measurement])
+
     @property
     def response_columns(self):
         return ['_time', self._params.export_name]
@@ -219,56 +368,246 @@ class SimpleFluxQueryBuilder(InfluxDBFluxQueryBuilder):
 
 class ChangesOnlyFluxQueryBuilder(SimpleFluxQueryBuilder):
     _strategy = TimeSeriesExporter.CHANGES_ONLY
-    want_data_frame = True
+    # Value types for which changes are detected in flux, so that only the
+    # changed rows are transferred. Values of other or undeclared types are
+    # all fetched, and filtered in the repacker.
+    _server_side_types = (TimeSeriesFundamentalType.NUMERIC,
+                          TimeSeriesFundamentalType.BOOLEAN)
+
+    def __init__(self, params, lone_value=False,
+                 server_side=INFLUXDB_CHANGES_ONLY_SERVER_SIDE):
+        super(ChangesOnlyFluxQueryBuilder, self).__init__(
+            params, lone_value=lone_value)
+        self._server_side = server_side and \
+            params.value_type in self._server_side_types
 
-    def repacker(self, response):
-        df = polars.from_pandas(response)
+    @property
+    def server_side(self):
+        return self._server_side
+
+    def _render_body(self, prefix=''):
+        if not self._server_side:
+            return super()._render_body(prefix=prefix)
+        # Changes are found by differencing the values (as floats, which
+        # also covers booleans) against the previous row. The first row is
+        # kept by difference() with a null difference, and the last row is
+        # added back in separately.
+        rv = self._render_subqueries(prefix=prefix)
+        rv += f'{prefix}changesData = '
+        rv += self._render_source(prefix=prefix)
+        rv += ' |> group()\n'
+        rv += ' |> sort(columns: ["_time"], desc: false)\n\n'
+        rv += 'union(tables: [\n'
+        rv += f'  {prefix}changesData\n'
+        rv += '   |> map(fn: (r) => ({r with _change: float(v: r._value)}))\n'
+        rv += '   |> difference(columns: ["_change"], keepFirst: true)\n'
+        rv += '   |> filter(fn: (r) => ' \
+              'not exists r._change or r._change != 0.0)\n'
+        rv += '   |> drop(columns: ["_change"]),\n'
+        rv += f'  {prefix}changesData |> last()\n'
+        rv += '])\n'
+        rv += ' |> group()\n'
+        rv += ' |> sort(columns: ["_time"], desc: false)\n'
+        rv += ' |> unique(column: "_time")\n'
+        rv += self._reshape_output()
+        return rv
+
+    def repack_frame(self, df):
+        if self._server_side:
+            return super().repack_frame(df)
         colname = self._params.measurement
         try:
             df = df.with_columns(df[colname].shift(1).alias("prev_value"))
             df = df.with_columns(
-                polars.when(polars.col(colname) != polars.col("prev_value"))
+                polars.when(polars.col(colname)
+                            .ne_missing(polars.col("prev_value")))
                 .then(True)
                 .otherwise(polars.col("_time") == df["_time"].max()).alias("keep"))
             df = df.filter(polars.col("keep"))
-            df = df.drop(["prev_value", "keep", "result", "table"])
-            return [row for row in df.rows()]
+            return df.select(["_time", colname]).rows()
         except ColumnNotFoundError as e:
             logger.warn(f"Expected column not found in query response.\n Error: {e} \n Query:\n {self.build()}")
 
+    def stream_repacker(self):
+        if self._server_side:
+            return super().stream_repacker()
+        return ChangesOnlyStreamRepacker(self._params.measurement)
+
 
 class DiscontinuitiesOnlyFluxQueryBuilder(SimpleFluxQueryBuilder):
     _strategy = TimeSeriesExporter.DISCONTINUITIES_ONLY
-    want_data_frame = True
+    # Default range of steps between consecutive values which are not
+    # considered discontinuities. Items can override this with step_size.
     step_size = (0, 150)
-    _extra_columns = ['difference']
 
-    def _render_logic(self):
-        rv = f' |> group()\n'
-        rv += f' |> duplicate(column: "_value", as: "difference")\n'
-        rv += f' |> difference(columns: ["difference"], keepFirst: true)\n'
-        rv += f' |> fill(column: "difference", value: 0)\n'
+    def __init__(self, params, lone_value=False):
+        super(DiscontinuitiesOnlyFluxQueryBuilder, self).__init__(
+            params, lone_value=lone_value)
+        if params.step_size is not None:
+            self.step_size = tuple(params.step_size)
+
+    def _render_body(self, prefix=''):
+        # Rows are kept if the step from the previous row or to the next row
+        # is outside step_size, along with the first and last rows. Steps to
+        # the next row are found by differencing in reverse order, which
+        # gives them with the sign inverted.
+        lower, upper = (float(x) for x in self.step_size)
+        rv = self._render_subqueries(prefix=prefix)
+        rv += f'{prefix}discontinuitiesData = '
+        rv += self._render_source(prefix=prefix)
+        rv += ' |> group()\n'
+        rv += ' |> sort(columns: ["_time"], desc: false)\n'
+        rv += ' |> map(fn: (r) => ({r with _step: float(v: r._value)}))\n\n'
+        rv += 'union(tables: [\n'
+        rv += f'  {prefix}discontinuitiesData |> first(),\n'
+        rv += f'  {prefix}discontinuitiesData |> last(),\n'
+        rv += f'  {prefix}discontinuitiesData\n'
+        rv += '   |> difference(columns: ["_step"])\n'
+        rv += f'   |> filter(fn: (r) => ' \
+              f'r._step < {lower!r} or r._step > {upper!r}),\n'
+        rv += f'  {prefix}discontinuitiesData\n'
+        rv += '   |> sort(columns: ["_time"], desc: true)\n'
+        rv += '   |> difference(columns: ["_step"])\n'
+        rv += f'   |> filter(fn: (r) => ' \
+              f'r._step > {-lower!r} or r._step < {-upper!r})\n'
+        rv += '])\n'
+        rv += ' |> drop(columns: ["_step"])\n'
+        rv += ' |> group()\n'
+        rv += ' |> sort(columns: ["_time"], desc: false)\n'
+        rv += ' |> unique(column: "_time")\n'
+        rv += self._reshape_output()
         return rv
-    
+
+
+class DecimatedFluxQueryBuilder(SimpleFluxQueryBuilder):
+    _strategy = TimeSeriesExporter.DECIMATED
+    # The bucket width depends on the time span, and is rendered into the
+    # script.
+    _span_in_script = True
+
+    def __init__(self, params, lone_value=False,
+                 method=INFLUXDB_DECIMATION_METHOD):
+        super(DecimatedFluxQueryBuilder, self).__init__(
+            params, lone_value=lone_value)
+        if method not in decimation_methods:
+            raise ValueError(f"Unsupported decimation method {method}. "
+                             f"Use one of {decimation_methods}.")
+        self._method = method
+        self._points = params.max_points or params.time_span.window_count
+
+    @property
+    def buckets(self):
+        # LTTB picks its points from the minmax reduction over as many
+        # buckets as points. Minmax keeps up to four points of each bucket,
+        # with one more for the open value.
+        if self._method == 'minmax':
+            return max(1, (self._points - 1) // 4)
+        return self._points
+
+    @property
+    def _bucket_bounds(self):
+        # Buckets are aligned to the start as rendered, in whole seconds.
+        start = _whole_seconds(self._time_span.start)
+        end = _whole_seconds(self._time_span.end)
+        width = bucket_width(start, end, self.buckets)
+        return start, width
+
+    def _render_body(self, prefix=''):
+        # Rows are reduced to the first, last, min and max rows of each
+        # bucket. Values are converted to floats, as by the windowed
+        # exporters. The rest of the decimation is done in the repacker.
+        start, width = self._bucket_bounds
+        every = _render_duration(width)
+        offset = _render_duration(bucket_offset(start, width))
+        rv = self._render_subqueries(prefix=prefix)
+        rv += f'{prefix}decimationData = '
+        rv += self._render_source(prefix=prefix)
+        rv += ' |> toFloat()\n'
+        rv += ' |> group()\n'
+        rv += ' |> sort(columns: ["_time"], desc: false)\n'
+        rv += f' |> window(every: {every}, offset: {offset}, ' \
+              f'createEmpty: false)\n\n'
+        rv += 'union(tables: [\n'
+        rv += ',\n'.join(f'  {prefix}decimationData |> {x}()'
+                         for x in ('first', 'last', 'min', 'max'))
+        rv += '\n])\n'
+        rv += ' |> group()\n'
+        rv += ' |> sort(columns: ["_time"], desc: false)\n'
+        rv += ' |> unique(column: "_time")\n'
+        rv += self._reshape_output()
+        return rv
+
+    def repack_frame(self, df):
+        colname = self._params.measurement
+        start, width = self._bucket_bounds
+        df = select_columns(df, ["_time", colname])
+        return decimate(df, colname, self._points, start, width,
+                        method=self._method).rows()
+
+    def stream_repacker(self):
+        # Points are selected from the whole series.
+        return BufferedStreamRepacker(self)
+
+
+class BatchedFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
+    # Renders the queries for several non-windowed items into a single
+    # script, with the output of each item yielded as a separately named
+    # result. The repacker splits the response back out by export name.
+    batched = True
+    _item_builders = {
+        TimeSeriesExporter.RAW: SimpleFluxQueryBuilder,
+        TimeSeriesExporter.CHANGES_ONLY: ChangesOnlyFluxQueryBuilder,
+        TimeSeriesExporter.DISCONTINUITIES_ONLY:
+            DiscontinuitiesOnlyFluxQueryBuilder,
+        TimeSeriesExporter.DECIMATED: DecimatedFluxQueryBuilder,
+    }
+
+    def __init__(self):
+        super().__init__()
+        self._builders = {}
+
+    def add_item(self, params: TimeSeriesQueryItemTModel, lone_value=False):
+        if not self._builders:
+            self.bucket = params.domain
+            self.time_span = params.time_span
+        elif not _buckets[params.domain] == self._bucket:
+            raise ValueError("We require all batched queries to have the "
+                             "same domain.")
+        if params.export_name in self._builders:
+            raise ValueError(f"Duplicate export name {params.export_name} "
+                             f"in batched query.")
+        if params.exporter not in self._item_builders:
+            raise ValueError(f"Exporter {params.exporter} cannot be batched.")
+        builder = self._item_builders[params.exporter](params,
+                                                       lone_value=lone_value)
+        # Item builders render into this builder's script, and can only
+        # refer to its params if they share its time span.
+        builder.use_params = self.use_params and \
+            params.time_span == self._time_span
+        self._builders[params.export_name] = builder
+        self._invalidate()
+
+    def _render(self):
+        return ''.join(f'{builder._render_body(prefix=f"{_escape(name)}_")}'
+                       f' |> yield(name: "{name}")\n\n'
+                       for name, builder in self._builders.items())
+
     def repacker(self, response):
-        df = polars.from_pandas(response)
-        try:
-            df = df.with_columns(polars.col("difference").shift(-1).alias("next_difference"))
-            df = df.with_columns(
-                polars.when((polars.col("difference") < self.step_size[0]) |
-                           (polars.col("difference") > self.step_size[1]) |
-                           (polars.col("next_difference") < self.step_size[0]) |
-                           (polars.col("next_difference") > self.step_size[1]))
-                      .then(True)
-                      .otherwise((polars.col("_time") == df["_time"].max()) |
-                                 (polars.col("_time") == df["_time"].min()))
-                      .alias("keep")
-            )
-            df = df.filter(polars.col("keep"))
-            df = df.drop(["keep", "difference", "next_difference", "result", "table"])
-            return [row for row in df.rows()]
-        except ColumnNotFoundError as e:
-            logger.warn(f"Expected column not found in query response.\n Error: {e} \n Query:\n {self.build()}")
+        return {name: builder.repack_frame(result_frame(response, name))
+                for name, builder in self._builders.items()}
+
+    def stream_repacker(self):
+        return BatchedStreamRepacker(
+            {name: builder.stream_repacker()
+             for name, builder in self._builders.items()})
+
+    @property
+    def strategy(self):
+        return {name: x.strategy for name, x in self._builders.items()}
+
+    @property
+    def response_columns(self):
+        return {name: x.response_columns for name, x in self._builders.items()}
 
 
 class AggregatedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
@@ -287,31 +626,211 @@ class AggregatedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
     def _render_logic(self):
         return self._render_aggregator(self._params.exporter)
 
+    @property
+    def _value_columns(self):
+        if self._params.exporter == TimeSeriesExporter.AGGREGATE_BAND:
+            return list(_band_statistics)
+        return ["_value"]
+
     def _reshape_output(self):
         # The idea is for _extra_columns to survive in the response. Typically,
         # this would be used as a dataframe for postprocessing in python/polars.
-        columns = ["_measurement", "_value"] + self._extra_columns
+        columns = ["_measurement"] + self._value_columns + self._extra_columns
         columns_str = ", ".join([f'"{x}"' for x in columns])
         rv = f' |> keep(columns: [{columns_str}])\n'
         return rv
 
     @property
     def response_columns(self):
+        if self._params.exporter == TimeSeriesExporter.AGGREGATE_BAND:
+            return _band_columns(self._params)
         return [self._params.export_name]
 
     def repacker(self, response):
-        rv = response.to_values(columns=['_value'])
+        rv = select_columns(result_frame(response), self._value_columns).rows()
+        if not rv:
+            logger.warn("Expected a single record, got none")
+            return None
         if len(rv) > 1:
             logger.warn(f"Expected only a single record, got {len(rv)}")
         return rv[0]
 
 
+class GroupedAggregateFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
+    # Computes several aggregate items of a domain from a shared scan. Items
+    # are filtered together, grouped by measurement, field and tags, and
+    # each requested aggregator is applied once to the grouped tables. The
+    # repacker picks out the row corresponding to each item.
+    batched = True
+
+    def __init__(self):
+        super().__init__()
+        self._items: List[TimeSeriesQueryItemTModel] = []
+
+    def add_item(self, params: TimeSeriesQueryItemTModel, lone_value=False):
+        if not self._items:
+            self.bucket = params.domain
+            self.time_span = params.time_span
+        elif not _buckets[params.domain] == self._bucket:
+            raise ValueError("We require all grouped aggregate queries to "
+                             "have the same domain.")
+        if not params.time_span == self._time_span:
+            raise ValueError("We require all grouped aggregate queries to "
+                             "have the same time span")
+        if not lone_value:
+            raise ValueError("We require all grouped aggregate queries to "
+                             "have lone_value type records")
+        if params.export_name in [x.export_name for x in self._items]:
+            raise ValueError(f"Duplicate export name {params.export_name} "
+                             f"in grouped aggregate query.")
+        self._items.append(params)
+        self._invalidate()
+
+    @staticmethod
+    def _branch_key(params: TimeSeriesQueryItemTModel):
+        # Items can only share grouped tables if they are grouped by the
+        # same tags and agree on whether the open value is included.
+        return params.include_ends, tuple(sorted(params.tags.keys()))
+
+    def _branches(self):
+        rv = {}
+        for item in self._items:
+            rv.setdefault(self._branch_key(item), []).append(item)
+        return rv
+
+    @staticmethod
+    def _render_item_predicate(params: TimeSeriesQueryItemTModel):
+        conditions = [f'r["_measurement"] == "{params.measurement}"']
+        for key, value in params.tags.items():
+            conditions.append(f'r["{key}"] == "{value}"')
+        for field in params.fields:
+            # TODO This breaks for not lone values
+            conditions.append(f'r["_field"] == "{field}"')
+        return f'({" and ".join(conditions)})'
+
+    def _render_branch_selectors(self, items, range=None):
+        predicates = dict.fromkeys(self._render_item_predicate(x)
+                                   for x in items)
+        rv = self._render_bucket()
+        rv += self._render_range(range=range)
+        rv += f' |> filter(fn: (r) => {" or ".join(predicates)})\n'
+        return rv
+
+    @staticmethod
+    def _group_columns(tag_keys):
+        return ["_measurement", "_field"] + list(tag_keys)
+
+    @staticmethod
+    def _result_name(branch_idx, aggregator):
+        return f'agg{branch_idx}_{aggregator}'
+
+    @staticmethod
+    def _aggregator(params: TimeSeriesQueryItemTModel):
+        if params.exporter == TimeSeriesExporter.AGGREGATE_BAND:
+            return 'band'
+        return _get_aggregator(params.exporter)
+
+    @staticmethod
+    def _value_columns(aggregator):
+        if aggregator == 'band':
+            return list(_band_statistics)
+        return ["_value"]
+
+    def _render_branch(self, branch_idx, key, items):
+        include_ends, tag_keys = key
+        name = f'agg{branch_idx}'
+        rv = ''
+        if include_ends:
+            rv += f'{name}_openValue = '
+            rv += self._render_branch_selectors(items, range='before')
+            rv += ' |> last()\n\n'
+            rv += f'{name}_rangeValues = '
+            rv += self._render_branch_selectors(items)
+            rv += '\n'
+            rv += f'{name} = union(tables: ' \
+                  f'[{name}_openValue, {name}_rangeValues])\n'
+        else:
+            rv += f'{name} = '
+            rv += self._render_branch_selectors(items)
+
+        group_columns = self._group_columns(tag_keys)
+        group_columns_str = ", ".join([f'"{x}"' for x in group_columns])
+        rv += f' |> group(columns: [{group_columns_str}])\n\n'
+
+        aggregators = dict.fromkeys(self._aggregator(x) for x in items)
+        for aggregator in aggregators:
+            keep_columns = group_columns + self._value_columns(aggregator)
+            keep_columns_str = ", ".join([f'"{x}"' for x in keep_columns])
+            rv += f'{name}\n'
+            if aggregator == 'band':
+                rv += _render_band_reduce()
+            else:
+                rv += f' |> {aggregator}()\n'
+            rv += f' |> keep(columns: [{keep_columns_str}])\n'
+            result_name = self._result_name(branch_idx, aggregator)
+            rv += f' |> yield(name: "{result_name}")\n\n'
+        return rv
+
+    def _render(self):
+        branches = self._branches().items()
+        return ''.join(self._render_branch(branch_idx, key, items)
+                       for branch_idx, (key, items) in enumerate(branches))
+
+    @staticmethod
+    def _item_selector(params: TimeSeriesQueryItemTModel):
+        rv = polars.col('_measurement') == params.measurement
+        if params.fields:
+            rv = rv & polars.col('_field').is_in(params.fields)
+        for key, value in params.tags.items():
+            rv = rv & (polars.col(key) == value)
+        return rv
+
+    def repacker(self, response):
+        rv = {}
+        for branch_idx, items in enumerate(self._branches().values()):
+            for item in items:
+                aggregator = self._aggregator(item)
+                df = result_frame(response,
+                                  self._result_name(branch_idx, aggregator))
+                matches = []
+                if not df.is_empty():
+                    matches = select_columns(
+                        df.filter(self._item_selector(item)),
+                        self._value_columns(aggregator)).rows()
+                if not matches:
+                    logger.warn(f"No aggregate value found for "
+                                f"{item.export_name}")
+                    rv[item.export_name] = None
+                    continue
+                if len(matches) > 1:
+                    logger.warn(f"Expected only a single record for "
+                                f"{item.export_name}, got {len(matches)}")
+                rv[item.export_name] = list(matches[0])
+        return rv
+
+    @property
+    def strategy(self):
+        return {x.export_name: x.exporter for x in self._items}
+
+    @property
+    def response_columns(self):
+        return {x.export_name: _band_columns(x)
+                if x.exporter == TimeSeriesExporter.AGGREGATE_BAND
+                else [x.export_name] for x in self._items}
+
+
 class WindowedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
+    # Window widths and rollup cutoffs are rendered into the script. Rollup
+    # cutoffs move with the present, so the rendered script is only reused
+    # while the rollups selected for the items are unchanged.
+    _span_in_script = True
+
     def __init__(self, common_tags):
         self._common_tags = common_tags
         self._inited = False
         self._items: List[TimeSeriesQueryItemTModel] = []
         self._channel_tables = []
+        self._rollups = {}
 
     def add_item(self, params: TimeSeriesQueryItemTModel, lone_value=False):
         if not self._inited:
@@ -323,11 +842,10 @@ class WindowedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
         if not lone_value:
             raise ValueError("We require all windowed queries to have lone_value type records")
         self._items.append(params)
+        self._invalidate()
 
-    def _render_channel_selectors(self, params: TimeSeriesQueryItemTModel, range=None):
-        rv = self._render_bucket()
-        rv += self._render_range(range=range)
-        rv += self._render_simple_filter('_measurement', params.measurement)
+    def _render_channel_filters(self, params: TimeSeriesQueryItemTModel):
+        rv = self._render_simple_filter('_measurement', params.measurement)
         for key, value in params.tags.items():
             rv += self._render_simple_filter(key, value)
         for field in params.fields:
@@ -335,6 +853,96 @@ class WindowedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
             rv += self._render_simple_filter('_field', field)
         return rv
 
+    def _render_channel_selectors(self, params: TimeSeriesQueryItemTModel, range=None):
+        rv = self._render_bucket()
+        rv += self._render_range(range=range)
+        rv += self._render_channel_filters(params)
+        return rv
+
+    def _render_channel_range(self, params: TimeSeriesQueryItemTModel):
+        # Windowed values over the time span, read from the coarsest usable
+        # rollup bucket up to its cutoff, and from the source bucket after.
+        rollup, cutoff = self._rollups[params.export_name]
+        if rollup is None:
+            rv = self._render_channel_selectors(params)
+            rv += self._render_channel_aggregator(params)
+            return rv
+
+        start = int(self._time_span.start.timestamp())
+        end = int(self._time_span.end.timestamp())
+        cutoff = int(cutoff.timestamp())
+        parts = [self._render_rollup(rollup, params, start, cutoff)]
+        if cutoff < end:
+            rv = self._render_bucket()
+            rv += f' |> range(start: {cutoff}, stop: {end})\n'
+            rv += self._render_channel_filters(params)
+            rv += self._render_channel_aggregator(params)
+            parts.append(rv)
+        if len(parts) == 1:
+            return parts[0]
+        parts = ",\n".join(x.rstrip("\n") for x in parts)
+        return f'union(tables: [\n{parts}\n])\n'
+
+    def _render_rollup_source(self, bucket, fn, params, start, stop):
+        every = _render_duration(self.time_span.window_width)
+        rv = f'from(bucket: "{bucket}")\n'
+        rv += f' |> range(start: {start}, stop: {stop})\n'
+        rv += self._render_channel_filters(params)
+        rv += f' |> aggregateWindow(every: {every}, fn: {fn}, ' \
+              f'createEmpty: false)\n'
+        return rv
+
+    def _render_band_rollup(self, rollup, params, start, stop):
+        # Each statistic is read from its own rollup, and the rows are
+        # pivoted into the columns the band aggregator produces.
+        parts = []
+        for statistic, source in rollup.statistics:
+            if statistic == 'mean':
+                rv = self._render_rollup(
+                    source, params, start, stop,
+                    exporter=TimeSeriesExporter.WINDOWED_MEAN)
+            else:
+                rv = self._render_rollup_source(source.bucket, statistic,
+                                                params, start, stop)
+            rv += ' |> keep(columns: ["_time", "_value"])\n'
+            rv += f' |> set(key: "_rollup", value: "{statistic}")'
+            parts.append(rv)
+        parts = ",\n".join(parts)
+        rv = f'union(tables: [\n{parts}\n])\n'
+        rv += ' |> pivot(rowKey: ["_time"], columnKey: ["_rollup"], ' \
+              'valueColumn: "_value")\n'
+        rv += ' |> filter(fn: (r) => ' \
+              'exists r.min and exists r.max and exists r.mean)\n'
+        rv += ' |> map(fn: (r) => ({_time: r._time, min: float(v: r.min), ' \
+              'mean: float(v: r.mean), max: float(v: r.max)}))\n'
+        return rv
+
+    def _render_rollup(self, rollup, params, start, stop, exporter=None):
+        # The rollup serves the exporter of the item, unless another is
+        # given.
+        if isinstance(rollup, BandRollup):
+            return self._render_band_rollup(rollup, params, start, stop)
+        fn = rollup.reaggregator(exporter or params.exporter)
+        if not isinstance(rollup, MeanRollup):
+            return self._render_rollup_source(rollup.bucket, fn, params,
+                                              start, stop)
+        parts = []
+        for source in rollup.sources:
+            rv = self._render_rollup_source(source.bucket, fn, params,
+                                            start, stop)
+            rv += ' |> keep(columns: ["_time", "_value"])\n'
+            rv += f' |> set(key: "_rollup", value: "{source.fn}")'
+            parts.append(rv)
+        parts = ",\n".join(parts)
+        rv = f'union(tables: [\n{parts}\n])\n'
+        rv += ' |> pivot(rowKey: ["_time"], columnKey: ["_rollup"], ' \
+              'valueColumn: "_value")\n'
+        rv += ' |> filter(fn: (r) => ' \
+              'exists r.sum and exists r.count and r.count > 0)\n'
+        rv += ' |> map(fn: (r) => ({_time: r._time, ' \
+              '_value: float(v: r.sum) / float(v: r.count)}))\n'
+        return rv
+
     def _render_channel_aggregator(self, params: TimeSeriesQueryItemTModel):
         rv = self._render_windowed_aggregator(params.exporter)
         return rv
@@ -355,25 +963,71 @@ class WindowedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
         rv += ' |> group()\n'
         return rv
 
-    def _prepare_channel_integration(self, params):
-        rv = f' |> set(key: "name", value:"{params.export_name}")\n'
+    def _prepare_channel_integration(self, params, name=None):
+        rv = f' |> set(key: "name", value:"{name or params.export_name}")\n'
         # rv += f' |> rename(columns: {{_value: "{params.export_name}"}})\n'
-        rv += f' |> keep(columns: ["_time", "_value", "name"])\n\n'
+        rv += ' |> keep(columns: ["_time", "_value", "name"])\n\n'
+        return rv
+
+    def _render_band_channel(self, params: TimeSeriesQueryItemTModel):
+        # The band statistics share one pass over the data. Each statistic
+        # is then split out as a separate channel, so that it becomes its
+        # own column in the pivoted output. Quantiles each need a pass of
+        # their own.
+        name = _escape(params.export_name)
+        rv = ''
+        if params.include_ends:
+            rv += f'{name}_openValue = '
+            rv += self._render_channel_selectors(params, range='before')
+            rv += ' |> last()\n'
+            rv += ' |> toFloat()\n\n'
+
+        sources = []
+        rv += f'{name}_rangeValues = '
+        rv += self._render_channel_range(params)
+        rv += '\n'
+        sources += [(x, f'{name}_rangeValues', x) for x in _band_statistics]
+
+        for q in params.quantiles or []:
+            statistic = _quantile_name(q)
+            variable = f'{name}_{statistic.replace(".", "_")}'
+            rv += f'{variable}_rangeValues = '
+            rv += self._render_channel_selectors(params)
+            rv += self._render_windowed_quantile(q)
+            rv += ' |> toFloat()\n\n'
+            sources.append((statistic, f'{variable}_rangeValues', None))
+
+        for statistic, source, value_column in sources:
+            column = f'{params.export_name}_{statistic}'
+            table = f'{_escape(column)}_band'
+            rv += f'{table} = {source}\n'
+            if value_column:
+                rv += f' |> map(fn: (r) => ' \
+                      f'({{r with _value: r.{value_column}}}))\n'
+            if params.include_ends:
+                rv += ' |> keep(columns: ["_time", "_value"])\n\n'
+                rv += f'{table}_ends = ' \
+                      f'union(tables: [{name}_openValue, {table}])\n'
+                rv += ' |> group()\n'
+                table = f'{table}_ends'
+            rv += self._prepare_channel_integration(params, name=column)
+            self._channel_tables.append(table)
         return rv
 
     def _render_channel(self, params: TimeSeriesQueryItemTModel):
+        if params.exporter == TimeSeriesExporter.WINDOWED_BAND:
+            return self._render_band_channel(params)
         rv = ''
         if params.include_ends:
             rv += f'{_escape(params.export_name)}_openValue = '
             rv += self._render_channel_selectors(params, range='before')
             rv += ' |> last()\n'
-            rv += f' |> toFloat()\n\n'
+            rv += ' |> toFloat()\n\n'
 
         rv += f'{_escape(params.export_name)}_rangeValues = '
-        rv += self._render_channel_selectors(params)
-        rv += self._render_channel_aggregator(params)
+        rv += self._render_channel_range(params)
         rv += self._render_channel_filler(params)
-        rv += f' |> toFloat()\n\n'
+        rv += ' |> toFloat()\n\n'
 
         if params.include_ends:
             rv += self._reintegrate_channel_data(params)
@@ -387,10 +1041,8 @@ class WindowedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
         return rv
 
     def _render_channels(self):
-        rv = ''
-        for item in self._items:
-            rv += self._render_channel(item)
-        return rv
+        self._channel_tables = []
+        return ''.join([self._render_channel(item) for item in self._items])
 
     def _render_channels_union(self):
         if len(self._channel_tables) > 1:
@@ -400,20 +1052,36 @@ class WindowedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
         return rv
 
     def _reshape_output(self):
-        rv = f' |> group(columns: ["_time"], mode: "by")\n'
-        rv += f' |> pivot(rowKey: ["_time"], columnKey: ["name"], valueColumn: "_value")\n'
-        rv += f' |> group()\n'
-        rv += f' |> sort(columns: ["_time"], desc: false)\n'
+        rv = ' |> group(columns: ["_time"], mode: "by")\n'
+        rv += ' |> pivot(rowKey: ["_time"], columnKey: ["name"], ' \
+              'valueColumn: "_value")\n'
+        rv += ' |> group()\n'
+        rv += ' |> sort(columns: ["_time"], desc: false)\n'
         return rv
 
+    def _select_rollups(self):
+        return {x.export_name: select_rollup(x.domain, x.exporter,
+                                             self._time_span)
+                for x in self._items}
+
     def build(self):
-        rv = self._render_channels()
-        rv += self._render_channels_union()
-        rv += self._reshape_output()
-        return rv
+        rollups = self._select_rollups()
+        if rollups != self._rollups:
+            self._invalidate()
+            self._rollups = rollups
+        return super().build()
+
+    def _render(self):
+        return ''.join([self._render_channels(),
+                        self._render_channels_union(),
+                        self._reshape_output()])
 
     def repacker(self, response):
-        return response.to_values(columns=self.response_columns)
+        return select_columns(result_frame(response),
+                              self.response_columns).rows()
+
+    def stream_repacker(self):
+        return ColumnsStreamRepacker(self.response_columns)
 
     @property
     def strategy(self):
@@ -421,4 +1089,10 @@ class WindowedFluxQueryBuilder(InfluxDBFluxQueryBuilder):
 
     @property
     def response_columns(self):
-        return ['_time'] + [x.export_name for x in self._items]
+        rv = ['_time']
+        for item in self._items:
+            if item.exporter == TimeSeriesExporter.WINDOWED_BAND:
+                rv.extend(_band_columns(item))
+            else:
+                rv.append(item.export_name)
+        return rv
@@ -0,0 +1,189 @@
+
+
+import io
+import re
+import polars
+import pyarrow
+from pyarrow import csv
+
+
+# Parses InfluxDB annotated CSV responses directly into arrow tables, which
+# are then handed over to polars without copying. This avoids creating a
+# FluxRecord (or a pandas row) for every point in the response.
+#
+# The response is returned as a dict of polars DataFrames, keyed by the
+# name of the flux result (the name given to yield(), or '_result').
+#
+# See https://docs.influxdata.com/influxdb/v2/reference/syntax/annotated-csv/
+
+_flux_types = {
+    'string': pyarrow.string(),
+    'long': pyarrow.int64(),
+    'unsignedLong': pyarrow.uint64(),
+    'double': pyarrow.float64(),
+    'boolean': pyarrow.bool_(),
+    'dateTime:RFC3339': pyarrow.timestamp('ns', tz='UTC'),
+    'dateTime:RFC3339Nano': pyarrow.timestamp('ns', tz='UTC'),
+    'duration': pyarrow.int64(),
+    'base64Binary': pyarrow.string(),
+}
+
+_block_separator = re.compile(rb'\r?\n\r?\n')
+_dropped_columns = ('', 'result', 'table')
+
+
+class FluxResponseError(Exception):
+    pass
+
+
+def _read_annotations(block):
+    annotations = {}
+    header = None
+    offset = 0
+    while offset < len(block):
+        end = block.find(b'\n', offset)
+        if end < 0:
+            end = len(block)
+        line = block[offset:end].rstrip(b'\r')
+        if not line.startswith(b'#'):
+            header = line
+            break
+        name, _, _ = line.partition(b',')
+        annotations[name[1:].decode()] = line
+        offset = end + 1
+    return annotations, header, len(annotations)
+
+
+def _split_annotation(line):
+    return [x.decode() for x in line.split(b',')[1:]]
+
+
+def _block_schema(annotations, header):
+    columns = [x.decode() for x in header.split(b',')]
+    datatypes = [''] + _split_annotation(annotations.get('datatype', b''))
+    defaults = [''] + _split_annotation(annotations.get('default', b''))
+    column_types = {}
+    for name, datatype in zip(columns, datatypes):
+        if name in _dropped_columns:
+            continue
+        column_types[name] = _flux_types.get(datatype, pyarrow.string())
+    result = dict(zip(columns, defaults)).get('result', '') or '_result'
+    return columns, result, column_types
+
+
+def _read_block(block, skip_rows, column_types):
+    return csv.read_csv(
+        io.BytesIO(block),
+        read_options=csv.ReadOptions(skip_rows=skip_rows),
+        convert_options=csv.ConvertOptions(
+            column_types=column_types,
+            include_columns=list(column_types.keys()),
+            strings_can_be_null=False,
+        ),
+    )
+
+
+def _raise_error(block, skip_rows):
+    table = csv.read_csv(
+        io.BytesIO(block),
+        read_options=csv.ReadOptions(skip_rows=skip_rows),
+        convert_options=csv.ConvertOptions(
+            include_columns=['error'],
+            column_types={'error': pyarrow.string()}),
+    )
+    errors = table.column('error').to_pylist()
+    raise FluxResponseError(f"Flux query failed : {errors}")
+
+
+def _parse_block(block):
+    annotations, header, skip_rows = _read_annotations(block)
+    if header is None:
+        return None, None
+    columns, result, column_types = _block_schema(annotations, header)
+    if 'error' in columns and 'reference' in columns:
+        _raise_error(block, skip_rows)
+    return result, _read_block(block, skip_rows, column_types)
+
+
+def parse_annotated_csv(response):
+    if isinstance(response, str):
+        response = response.encode()
+    frames = {}
+    for block in _block_separator.split(response):
+        if not block.strip():
+            continue
+        result, table = _parse_block(block)
+        if table is None:
+            continue
+        frames.setdefault(result, []).append(polars.from_arrow(table))
+
+    rv = {}
+    for result, parts in frames.items():
+        if len(parts) == 1:
+            rv[result] = parts[0]
+        else:
+            rv[result] = polars.concat(parts, how='diagonal_relaxed')
+    return rv
+
+
+async def iter_annotated_csv(lines, batch_rows):
+    # Incrementally parse an annotated CSV stream, given as an async
+    # iterable of lines, yielding (result, frame) pairs of at most
+    # batch_rows rows each. Frames never span two annotated blocks.
+    annotations = {}
+    header = None
+    schema = None
+    rows = []
+
+    def _flush():
+        block = header + b'\n' + b''.join(rows)
+        rows.clear()
+        return schema[1], polars.from_arrow(_read_block(block, 0, schema[2]))
+
+    async for line in lines:
+        stripped = line.rstrip(b'\r\n')
+        if not stripped:
+            if rows:
+                yield _flush()
+            annotations, header, schema = {}, None, None
+            continue
+        if header is None:
+            if stripped.startswith(b'#'):
+                name, _, _ = stripped.partition(b',')
+                annotations[name[1:].decode()] = stripped
+                continue
+            header = stripped
+            schema = _block_schema(annotations, header)
+            continue
+        if 'error' in schema[0] and 'reference' in schema[0]:
+            _raise_error(header + b'\n' + line, 0)
+        rows.append(line)
+        if len(rows) >= batch_rows:
+            yield _flush()
+    if rows:
+        yield _flush()
+
+
+def result_frame(response, name=None):
+    # Return the frame for the named result, or for the only result
+    # present if no name is given. Missing results are returned as
+    # empty frames so that repackers need not special case them.
+    if name is not None:
+        return response.get(name, polars.DataFrame())
+    if not response:
+        return polars.DataFrame()
+    if len(response) == 1:
+        return next(iter(response.values()))
+    return polars.concat(list(response.values()), how='diagonal_relaxed')
+
+
+def select_columns(df, columns):
+    # Pivoted responses only include columns for which data was present.
+    # Missing columns are filled in with nulls to keep the row shape stable.
+    if not df.width:
+        return polars.DataFrame(schema={x: polars.Null for x in columns})
+    missing = [polars.lit(None).alias(x)
+               for x in columns if x not in df.columns]
+    if missing:
+        df = df.with_columns(missing)
+    return df.select(columns)
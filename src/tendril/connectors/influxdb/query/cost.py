@@ -0,0 +1,269 @@
+
+
+import time
+from math import ceil
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from tendril import config
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.config import INFLUXDB_QUERY_DEFAULT_SAMPLE_RATE
+from tendril.config import INFLUXDB_QUERY_SAMPLE_RATE_WINDOW
+from tendril.config import INFLUXDB_QUERY_SAMPLE_RATE_TTL
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import QueryTimeSpanTModel
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+
+from .builder import InfluxDBFluxQueryBuilderBase
+from .columnar import result_frame
+from .columnar import select_columns
+from .rollups import select_rollup
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# Cost estimation for query items, and the per-domain limits applied to
+# them by the planner.
+#
+# The cost of an item is estimated as the number of points InfluxDB scans
+# to serve it, and the number of points it returns. Both are derived from
+# the length of the time span and the sample rate of the item's
+# measurement. Sample rates are probed from the recent data of each domain
+# (see SampleRateProbeFluxQueryBuilder) and cached, and a configured default
+# is assumed for measurements which have not been probed. Windowed items
+# served from rollups scan the rollup points instead of the source data.
+#
+# CHANGES_ONLY and DISCONTINUITIES_ONLY items are assumed to return every
+# point they scan, since how many are filtered out is not known in advance.
+# DECIMATED items return at most their max_points.
+
+_windowed_exporters = (TimeSeriesExporter.WINDOWED_MEAN,
+                       TimeSeriesExporter.WINDOWED_SUM,
+                       TimeSeriesExporter.WINDOWED_BAND,
+                       TimeSeriesExporter.WINDOWED_COUNT)
+
+_aggregate_exporters = (TimeSeriesExporter.AGGREGATE_MEAN,
+                        TimeSeriesExporter.AGGREGATE_SUM,
+                        TimeSeriesExporter.AGGREGATE_BAND,
+                        TimeSeriesExporter.AGGREGATE_COUNT)
+
+_limit_actions = ('reject', 'downgrade', 'split', 'warn')
+
+
+class QueryCost(object):
+    def __init__(self, scanned=0, returned=0):
+        self.scanned = int(scanned)
+        self.returned = int(returned)
+
+    def __add__(self, other):
+        return QueryCost(self.scanned + other.scanned,
+                         self.returned + other.returned)
+
+    def __repr__(self):
+        return f"<QueryCost scanned {self.scanned} returned {self.returned}>"
+
+
+class QueryLimits(object):
+    # Limits on the estimated cost of each query item of a domain, and the
+    # action taken for items which exceed them :
+    #
+    #   reject    : the item is not queried, and its result is an error
+    #   downgrade : RAW, CHANGES_ONLY and DISCONTINUITIES_ONLY items of
+    #               numeric (or undeclared) type are queried as WINDOWED_MEAN
+    #               over their time span instead
+    #   split     : RAW items are queried in consecutive chunks of their
+    #               time span, each of which is within the limits, and the
+    #               chunks are joined back into a single result
+    #   warn      : the item is queried anyway, and a warning is logged
+    #
+    # Items which the action cannot bring within the limits, or which would
+    # need more than max_chunks chunks, are rejected.
+    def __init__(self, max_points=None, max_scanned=None, action='reject',
+                 max_chunks=100):
+        if action not in _limit_actions:
+            raise ValueError(f"Unsupported query limit action {action}. "
+                             f"Use one of {_limit_actions}.")
+        self.max_points = max_points
+        self.max_scanned = max_scanned
+        self.action = action
+        self.max_chunks = max_chunks
+
+    def __repr__(self):
+        return f"<QueryLimits points {self.max_points} " \
+               f"scanned {self.max_scanned} {self.action}>"
+
+    def exceeded(self, cost: QueryCost):
+        if self.max_points is not None and cost.returned > self.max_points:
+            return True
+        if self.max_scanned is not None and cost.scanned > self.max_scanned:
+            return True
+        return False
+
+    def chunks(self, cost: QueryCost):
+        # Number of chunks an item needs to be split into for each chunk to
+        # be within the limits.
+        rv = 1
+        if self.max_points:
+            rv = max(rv, ceil(cost.returned / self.max_points))
+        if self.max_scanned:
+            rv = max(rv, ceil(cost.scanned / self.max_scanned))
+        return rv
+
+
+def _get_limits(domain):
+    limits = getattr(config, f'INFLUXDB_{domain.upper()}_QUERY_LIMITS', None)
+    if not limits:
+        return None
+    return QueryLimits(**limits)
+
+
+_limits = {x: _get_limits(x) for x in INFLUXDB_BUCKETS}
+
+
+def query_limits(domain):
+    return _limits.get(domain, None)
+
+
+class SampleRateCache(object):
+    # Sample rates of the measurements of each domain, in points per second.
+    # For each measurement, the highest rate of any of its series and the
+    # total rate across all its series are kept.
+    def __init__(self, default_rate, ttl):
+        self._default_rate = default_rate
+        self._ttl = ttl
+        self._rates = {}
+
+    def get(self, domain, measurement):
+        # Return the (peak, total) rates, or None if not known.
+        entry = self._rates.get((domain, measurement), None)
+        if entry is None:
+            return None
+        expires, rates = entry
+        if expires < time.monotonic():
+            del self._rates[(domain, measurement)]
+            return None
+        return rates
+
+    def set(self, domain, measurement, peak=None, total=None):
+        # Measurements without recent data are set without rates, so that
+        # they are not probed again until they expire.
+        expiry = time.monotonic() + self._ttl
+        self._rates[(domain, measurement)] = (expiry, (peak, total))
+
+    def missing(self, domain, measurements):
+        return sorted(x for x in set(measurements)
+                      if self.get(domain, x) is None)
+
+    def rate(self, item: TimeSeriesQueryItemTModel):
+        # Items without tag filters read every series of the measurement.
+        peak, total = self.get(item.domain, item.measurement) or (None, None)
+        rate = peak if item.tags else total
+        return rate if rate is not None else self._default_rate
+
+    def clear(self):
+        self._rates.clear()
+
+
+_sample_rates = SampleRateCache(INFLUXDB_QUERY_DEFAULT_SAMPLE_RATE,
+                                INFLUXDB_QUERY_SAMPLE_RATE_TTL)
+
+
+def sample_rates():
+    return _sample_rates
+
+
+class SampleRateProbeFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
+    # Counts the points of each series of the given measurements over the
+    # recent window, and reduces them to the peak and total count of each
+    # measurement. The repacker returns these as rates, as a dict of
+    # measurement to (peak, total).
+    _strategy = 'SampleRateProbe'
+    use_params = False
+
+    def __init__(self, domain, measurements,
+                 window=INFLUXDB_QUERY_SAMPLE_RATE_WINDOW, now=None):
+        super().__init__()
+        self.bucket = domain
+        self._measurements = list(measurements)
+        self._window = window
+        end = datetime.fromtimestamp(int(now or time.time()), tz=timezone.utc)
+        self.time_span = QueryTimeSpanTModel(end=end,
+                                             width=timedelta(seconds=window))
+
+    def _render(self):
+        predicates = " or ".join(f'r["_measurement"] == "{x}"'
+                                 for x in self._measurements)
+        rv = self._render_bucket()
+        rv += self._render_range()
+        rv += f' |> filter(fn: (r) => {predicates})\n'
+        rv += ' |> count()\n'
+        rv += ' |> group(columns: ["_measurement"])\n'
+        rv += ' |> reduce(identity: {peak: 0, total: 0}, ' \
+              'fn: (r, accumulator) => ({\n'
+        rv += '      peak: if r._value > accumulator.peak ' \
+              'then r._value else accumulator.peak,\n'
+        rv += '      total: accumulator.total + r._value,\n'
+        rv += '    }))\n'
+        rv += ' |> keep(columns: ["_measurement", "peak", "total"])\n'
+        return rv
+
+    def repacker(self, response):
+        df = select_columns(result_frame(response),
+                            ["_measurement", "peak", "total"])
+        return {measurement: (peak / self._window, total / self._window)
+                for measurement, peak, total in df.rows()
+                if measurement is not None}
+
+
+def estimate_cost(item: TimeSeriesQueryItemTModel, rate=None, now=None):
+    """
+    Estimate the cost of the query item. The sample rate, in points per
+    second, is taken from the sample rate cache if not given.
+    """
+    if rate is None:
+        rate = _sample_rates.rate(item)
+    start = item.time_span.start.timestamp()
+    end = item.time_span.end.timestamp()
+    scanned = rate * (end - start)
+    if item.exporter in _windowed_exporters:
+        rollup, cutoff = select_rollup(item.domain, item.exporter,
+                                       item.time_span, now=now)
+        if rollup is not None:
+            cutoff = cutoff.timestamp()
+            windows = (cutoff - start) / rollup.resolution
+            scanned = len(rollup.sources) * windows + rate * (end - cutoff)
+            # Band quantiles are still read from the source bucket.
+            scanned += len(item.quantiles or []) * rate * (cutoff - start)
+        returned = item.time_span.window_count
+    elif item.exporter in _aggregate_exporters:
+        returned = 1
+    elif item.exporter == TimeSeriesExporter.DECIMATED:
+        returned = min(scanned, item.max_points or item.time_span.window_count)
+    else:
+        returned = scanned
+    if item.include_ends:
+        scanned += 1
+        returned += 1
+    return QueryCost(ceil(scanned), ceil(returned))
+
+
+def split_time_span(time_span: QueryTimeSpanTModel, chunks):
+    """
+    Split the time span into the given number of consecutive time spans,
+    on whole second boundaries.
+    """
+    start = int(time_span.start.timestamp())
+    end = int(ceil(time_span.end.timestamp()))
+    width = max(1, ceil((end - start) / chunks))
+    rv = []
+    for chunk_start in range(start, end, width):
+        chunk_end = min(chunk_start + width, end)
+        rv.append(time_span.copy(update={
+            'start': datetime.fromtimestamp(chunk_start, tz=timezone.utc),
+            'end': datetime.fromtimestamp(chunk_end, tz=timezone.utc),
+            'width': timedelta(seconds=chunk_end - chunk_start),
+            'partial_window_end': None,
+        }))
+    return rv
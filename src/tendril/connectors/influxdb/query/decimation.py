@@ -0,0 +1,146 @@
+
+
+import numpy
+import polars
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# Decimation of series for plotting, used by the DECIMATED exporter. A
+# series is reduced to at most a given number of points which still look
+# like the full series when drawn as a line.
+#
+#   minmax : The time span is divided into buckets, and the first, last,
+#            min and max points of each are kept (M4). Drawn at one bucket
+#            per pixel column, this is indistinguishable from the full
+#            series.
+#   lttb   : Largest-triangle-three-buckets, which keeps one point from each
+#            bucket, chosen to make the largest triangle with the point kept
+#            from the previous bucket and the mean of the next. It is run on
+#            the minmax reduction of the series over as many buckets as the
+#            points requested (MinMaxLTTB), which gives nearly the same
+#            result as running it on the full series.
+#
+# Buckets are aligned to the start of the time span, at a whole number of
+# microseconds wide, so that the minmax reduction can be done by InfluxDB
+# (with window() and selectors) and repeated here to the same result. Rows
+# before the start, such as the open value, fall in buckets of their own.
+
+decimation_methods = ('lttb', 'minmax')
+
+_epoch = datetime.fromtimestamp(0, tz=timezone.utc)
+
+
+def bucket_width(start, end, buckets):
+    """
+    Width of the buckets, in whole microseconds, for the given number of
+    them starting at start to cover the time span.
+    """
+    span = (end - start) // timedelta(microseconds=1)
+    return timedelta(microseconds=max(1, -(-span // buckets)))
+
+
+def bucket_offset(start, width):
+    """
+    Offset of bucket boundaries aligned to start, from the unix epoch.
+    """
+    return (start - _epoch) % width
+
+
+def minmax_decimate(df, column, start, width):
+    """
+    Keep the first, last, min and max rows of each bucket of the frame,
+    which is sorted by _time.
+    """
+    if df.height <= 4:
+        return df
+    width = width // timedelta(microseconds=1)
+    position = (polars.col("_time") - polars.lit(start)) \
+        .dt.total_microseconds()
+    df = df.with_row_index("_row") \
+        .with_columns((position // width).alias("_bucket"))
+    selected = df.group_by("_bucket").agg(
+        polars.col("_row").first().alias("first"),
+        polars.col("_row").last().alias("last"),
+        polars.col("_row").get(polars.col(column).arg_min()).alias("min"),
+        polars.col("_row").get(polars.col(column).arg_max()).alias("max"),
+    )
+    rows = numpy.unique(selected.drop("_bucket").to_numpy().ravel())
+    return df[rows].drop(["_row", "_bucket"])
+
+
+def lttb_indices(x, y, threshold):
+    """
+    Indices of the points selected by largest-triangle-three-buckets from
+    the points (x, y), ordered by x.
+    """
+    n = len(x)
+    if threshold >= n:
+        return numpy.arange(n)
+    if threshold < 3:
+        return numpy.array([0, n - 1][:threshold], dtype=numpy.int64)
+    # Bucket i covers the points from edges[i] to edges[i + 1], leaving out
+    # the first and last points, which are always selected.
+    every = (n - 2) / (threshold - 2)
+    edges = (numpy.arange(threshold - 1) * every).astype(numpy.int64) + 1
+    edges[-1] = n - 1
+    counts = numpy.diff(edges)
+    mean_x = numpy.add.reduceat(x[:-1], edges[:-1]) / counts
+    mean_y = numpy.add.reduceat(y[:-1], edges[:-1]) / counts
+    mean_x = numpy.append(mean_x, x[-1])
+    mean_y = numpy.append(mean_y, y[-1])
+    # The area of the triangle of a point (xj, yj) with the selected point
+    # (ax, ay) and the mean (cx, cy) of the next bucket is half of
+    # |ax (yj - cy) + ay (cx - xj) + (xj cy - cx yj)|. The coefficients are
+    # computed for all points at once, leaving only the selection, which
+    # depends on the previous one, to be done bucket by bucket.
+    next_x = numpy.repeat(mean_x[1:], counts)
+    next_y = numpy.repeat(mean_y[1:], counts)
+    inner = slice(1, n - 1)
+    p = y[inner] - next_y
+    q = next_x - x[inner]
+    r = x[inner] * next_y - next_x * y[inner]
+
+    rv = numpy.empty(threshold, dtype=numpy.int64)
+    rv[0] = 0
+    rv[-1] = n - 1
+    selected = 0
+    for idx in range(threshold - 2):
+        lo, hi = edges[idx] - 1, edges[idx + 1] - 1
+        area = numpy.abs(x[selected] * p[lo:hi] +
+                         y[selected] * q[lo:hi] + r[lo:hi])
+        selected = edges[idx] + int(area.argmax())
+        rv[idx + 1] = selected
+    return rv
+
+
+def lttb_decimate(df, column, threshold):
+    """
+    Keep the rows selected by largest-triangle-three-buckets from the
+    frame, which is sorted by _time.
+    """
+    if df.height <= threshold:
+        return df
+    times = df["_time"].dt.epoch("ns").to_numpy()
+    x = (times - times[0]).astype(numpy.float64)
+    y = df[column].cast(polars.Float64).to_numpy()
+    return df[lttb_indices(x, y, threshold)]
+
+
+def decimate(df, column, points, start, width, method='lttb'):
+    """
+    Decimate the frame of (_time, column) rows, sorted by _time, to at most
+    the given number of points, with buckets of the given width aligned to
+    start. Rows without values are dropped.
+    """
+    if df.is_empty():
+        return df
+    df = df.drop_nulls(column)
+    df = minmax_decimate(df, column, start, width)
+    if method == 'lttb':
+        df = lttb_decimate(df, column, points)
+    return df
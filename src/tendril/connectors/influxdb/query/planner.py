@@ -1,13 +1,45 @@
 
 
+from tendril.config import INFLUXDB_SEGMENT_CACHE_ENABLED
+from tendril.config import INFLUXDB_QUERY_SHARDS
+from tendril.config import INFLUXDB_QUERY_SHARD_MIN_SPAN
 from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.constants import TimeSeriesFundamentalType
 from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
 
 from .builder import SimpleFluxQueryBuilder
 from .builder import ChangesOnlyFluxQueryBuilder
 from .builder import DiscontinuitiesOnlyFluxQueryBuilder
+from .builder import DecimatedFluxQueryBuilder
 from .builder import WindowedFluxQueryBuilder
 from .builder import AggregatedFluxQueryBuilder
+from .builder import BatchedFluxQueryBuilder
+from .builder import GroupedAggregateFluxQueryBuilder
+from .builder import _band_columns
+from .segments import SegmentCachedFluxQueryBuilder
+from .shared import SharedScanFluxQueryBuilder
+from .sharded import ShardedFluxQueryBuilder
+from .cost import estimate_cost
+from .cost import query_limits
+from .cost import split_time_span
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+_windowed_exporters = (TimeSeriesExporter.WINDOWED_MEAN,
+                       TimeSeriesExporter.WINDOWED_SUM,
+                       TimeSeriesExporter.WINDOWED_BAND,
+                       TimeSeriesExporter.WINDOWED_COUNT)
+
+_aggregate_exporters = (TimeSeriesExporter.AGGREGATE_MEAN,
+                        TimeSeriesExporter.AGGREGATE_SUM,
+                        TimeSeriesExporter.AGGREGATE_BAND,
+                        TimeSeriesExporter.AGGREGATE_COUNT)
+
+_downgradable_exporters = (TimeSeriesExporter.RAW,
+                           TimeSeriesExporter.CHANGES_ONLY,
+                           TimeSeriesExporter.DISCONTINUITIES_ONLY)
 
 
 def intersect_dicts(a, b):
@@ -26,75 +58,407 @@ def subtract_dicts(a, b):
     return a
 
 
+def _span_key(time_span):
+    return time_span.start, time_span.end, time_span.window_width
+
+
 class InfluxDBQueryPlanner(object):
-    def __init__(self):
+    """
+    Groups query items into as few queries as possible.
+
+    Items may have different time spans. Items are grouped by domain and
+    time span, and the items of each group are batched together as they
+    would be if they were planned on their own. Where several time spans
+    are present in a domain, RAW and windowed items reading the same series
+    over overlapping time spans share a single scan (see
+    SharedScanFluxQueryBuilder).
+
+    Windowed items produce a table for each time span, named 'windowed' for
+    the first time span added to the planner and 'windowed_<n>' for the
+    n-th time span after it.
+
+    Items which differ from an item already added only in their export name
+    are not queried again. Their results are filled in from those of the
+    first such item by resolve_duplicates().
+
+    Items of domains with query limits (INFLUXDB_<DOMAIN>_QUERY_LIMITS)
+    are checked against them when the domain's queries are first generated,
+    using the sample rates cached at that time. Items may then be rejected,
+    downgraded to WINDOWED_MEAN, or split into chunks of their time span.
+    Downgraded items are queried on their own and returned under their
+    own export names, with the WINDOWED_MEAN strategy. The results of
+    rejected, downgraded and split items are filled in by resolve_limits().
+
+    If shards is more than 1, the batched and windowed queries of time spans
+    of at least shard_min_span seconds are split into that many time shards,
+    which are queried concurrently (see ShardedFluxQueryBuilder). Items
+    served from the segment cache or through a shared scan are not sharded.
+    """
+    def __init__(self, segment_cache=INFLUXDB_SEGMENT_CACHE_ENABLED,
+                 shards=INFLUXDB_QUERY_SHARDS,
+                 shard_min_span=INFLUXDB_QUERY_SHARD_MIN_SPAN):
+        self._segment_cache = segment_cache
+        self._shards = shards
+        self._shard_min_span = shard_min_span
         self._items = {}
-        self._time_span = None
+        self._spans = []
         self._common_tags = None
         self._windowed_builder = None
+        self._item_keys = {}
+        self._duplicates = {}
+        self._limited = set()
+        self._rejected = {}
+        self._downgrades = {}
+        self._splits = {}
+
+    @property
+    def time_spans(self):
+        return list(self._spans)
 
     def add_item(self, item: TimeSeriesQueryItemTModel):
-        if not self._time_span:
-            self._time_span = item.time_span
-        else:
-            if self._time_span != item.time_span:
-                raise ValueError(f"{self.__class__.__name__} does not support different time spans. "
-                                 f"Use a separate instance of the planner instead. If there is a "
-                                 f"clearly articulated use case for this, implementation may be "
-                                 f"considered.")
+        key = item.json(exclude={'export_name'})
+        if key in self._item_keys:
+            self._duplicates.setdefault(item.domain, []).append(
+                (item, self._item_keys[key]))
+            return
+        self._item_keys[key] = item
+        if item.time_span not in self._spans:
+            self._spans.append(item.time_span)
         if self._common_tags is None:
             self._common_tags = item.tags
         else:
             self._common_tags = intersect_dicts(self._common_tags, item.tags)
         if item.domain not in self._items:
             self._items[item.domain] = {}
-        if item.exporter not in self._items[item.domain].keys():
-            self._items[item.domain][item.exporter] = []
-        self._items[item.domain][item.exporter].append(item)
+        key = _span_key(item.time_span)
+        if key not in self._items[item.domain]:
+            self._items[item.domain][key] = {}
+        if item.exporter not in self._items[item.domain][key].keys():
+            self._items[item.domain][key][item.exporter] = []
+        self._items[item.domain][key][item.exporter].append(item)
 
     def query_domains(self):
         for domain in self._items.keys():
             yield domain
 
+    def _domain_items(self, domain):
+        for exporters in self._items[domain].values():
+            for items in exporters.values():
+                yield from items
+
+    def measurements(self, domain):
+        return {x.measurement for x in self._domain_items(domain)}
+
+    def estimate_cost(self, domain=None, now=None):
+        """
+        Estimate the cost of the items of the domain, or of all domains, as
+        a dict of export name to QueryCost. Duplicate items are not queried
+        and are not included.
+        """
+        domains = [domain] if domain else self._items.keys()
+        return {x.export_name: estimate_cost(x, now=now)
+                for d in domains for x in self._domain_items(d)}
+
+    @staticmethod
+    def _split_item(item, chunks):
+        time_spans = split_time_span(item.time_span, chunks)
+        return [item.copy(update={
+            'export_name': f'{item.export_name}__chunk{idx}',
+            'time_span': time_span,
+            'include_ends': item.include_ends and not idx,
+        }) for idx, time_span in enumerate(time_spans)]
+
+    def _limit_item(self, domain, limits, item):
+        # Returns the item to be queried in place of the given item, or None
+        # if it is not to be queried as part of its group.
+        cost = estimate_cost(item)
+        if not limits.exceeded(cost):
+            return item
+        reason = f"Estimated cost of {item.export_name} " \
+                 f"({cost.scanned} points scanned, {cost.returned} " \
+                 f"returned) exceeds the query limits of {domain}"
+        if limits.action == 'warn':
+            logger.warning(reason)
+            return item
+
+        if limits.action == 'downgrade' and \
+                item.exporter in _downgradable_exporters and \
+                item.value_type in (None, TimeSeriesFundamentalType.NUMERIC):
+            downgraded = item.copy(update={
+                'export_name': f'{item.export_name}__downgraded',
+                'exporter': TimeSeriesExporter.WINDOWED_MEAN,
+            })
+            if not limits.exceeded(estimate_cost(downgraded)):
+                logger.info(f"{reason}. Querying it as WINDOWED_MEAN instead.")
+                self._downgrades.setdefault(domain, []) \
+                    .append((item, downgraded))
+                return None
+
+        if limits.action == 'split' and \
+                item.exporter == TimeSeriesExporter.RAW:
+            # Chunks are split on whole seconds, so they can come out
+            # slightly over an even share.
+            chunks = limits.chunks(cost)
+            while chunks <= limits.max_chunks:
+                items = self._split_item(item, chunks)
+                if not any(limits.exceeded(estimate_cost(x)) for x in items):
+                    logger.info(f"{reason}. Querying it in "
+                                f"{len(items)} chunks.")
+                    self._splits.setdefault(domain, []).append((item, items))
+                    return None
+                chunks += 1
+
+        logger.warning(f"{reason}. Rejecting it.")
+        self._rejected.setdefault(domain, []).append((item, reason))
+        return None
+
+    def _apply_limits(self, domain):
+        # Applied once for each domain, so that the items can be added
+        # before the sample rates are probed.
+        if domain in self._limited:
+            return
+        self._limited.add(domain)
+        limits = query_limits(domain)
+        if limits is None:
+            return
+        for key, exporters in self._items[domain].items():
+            limited = {}
+            for items in exporters.values():
+                for item in items:
+                    item = self._limit_item(domain, limits, item)
+                    if item is not None:
+                        limited.setdefault(item.exporter, []).append(item)
+            self._items[domain][key] = limited
+
+    @staticmethod
+    def _whole_seconds(value):
+        # The segment cache works on whole second window boundaries.
+        return value.total_seconds() >= 1 and not value.microseconds
+
     def _special_tags(self, tags):
         return subtract_dicts(tags, self._common_tags)
 
+    def _windowed_name(self, time_span):
+        idx = [_span_key(x) for x in self._spans].index(_span_key(time_span))
+        return f'windowed_{idx}' if idx else 'windowed'
+
+    def _segment_cacheable(self, windowed_items):
+        # Band items produce several columns each, which the segment cache
+        # does not handle.
+        return self._segment_cache and \
+            self._whole_seconds(windowed_items[0].time_span.window_width) and \
+            not any(x.exporter == TimeSeriesExporter.WINDOWED_BAND
+                    for x in windowed_items)
+
+    def _shardable(self, items, windowed=False):
+        # Windowed items are sharded on window boundaries, which are only
+        # rendered to whole seconds.
+        time_span = items[0].time_span
+        if self._shards < 2:
+            return False
+        # Decimation buckets are aligned to the start of the whole span.
+        if any(x.exporter == TimeSeriesExporter.DECIMATED for x in items):
+            return False
+        span = (time_span.end - time_span.start).total_seconds()
+        if span < self._shard_min_span:
+            return False
+        return not windowed or self._whole_seconds(time_span.window_width)
+
     def generate_queries(self, domain):
-        windowed_items = []
-        for exporter, items in self._items[domain].items():
+        self._apply_limits(domain)
+        groups = [dict(x) for x in self._items[domain].values() if x]
+        shared = len(groups) > 1
 
-            if exporter == TimeSeriesExporter.CHANGES_ONLY:
-                for item in items:
-                    builder = ChangesOnlyFluxQueryBuilder(item, lone_value=True)
-                    yield item.export_name, builder
+        raw_items = []
+        windowed_groups = []
+        for exporters in groups:
+            if shared and not self._segment_cache:
+                raw_items.extend(exporters.pop(TimeSeriesExporter.RAW, []))
+            windowed_items = [x for exporter, items in exporters.items()
+                              if exporter in _windowed_exporters
+                              for x in items]
+            if shared and windowed_items and \
+                    not self._segment_cacheable(windowed_items):
+                name = self._windowed_name(windowed_items[0].time_span)
+                windowed_groups.append((name, windowed_items))
+                for exporter in _windowed_exporters:
+                    exporters.pop(exporter, None)
 
-            elif exporter == TimeSeriesExporter.DISCONTINUITIES_ONLY:
-                for item in items:
-                    builder = DiscontinuitiesOnlyFluxQueryBuilder(item, lone_value=True)
-                    yield item.export_name, builder
+        if raw_items:
+            yield "shared", SharedScanFluxQueryBuilder([(None, raw_items)],
+                                                       windowed=False)
+        if windowed_groups:
+            yield "windowed_shared", \
+                SharedScanFluxQueryBuilder(windowed_groups, windowed=True)
+        for exporters in groups:
+            yield from self._generate_span_queries(exporters)
+        # Chunks of split items are queried separately, so that they are not
+        # merged back into a single scan.
+        for _, chunks in self._splits.get(domain, []):
+            for chunk in chunks:
+                yield from self._generate_single_query(chunk)
+        # Downgraded items are queried separately as well, so that their
+        # results are not merged into the windowed table of their group.
+        for _, downgraded in self._downgrades.get(domain, []):
+            builder = WindowedFluxQueryBuilder(self._common_tags)
+            builder.add_item(downgraded, lone_value=True)
+            yield downgraded.export_name, builder
 
-            elif exporter == TimeSeriesExporter.RAW:
-                for item in items:
-                    builder = SimpleFluxQueryBuilder(item, lone_value=True)
-                    yield item.export_name, builder
+    def _generate_span_queries(self, exporters):
+        windowed_items = []
+        batched_items = []
+        aggregate_items = []
+        raw_items = []
+        for exporter, items in exporters.items():
+
+            if exporter == TimeSeriesExporter.RAW and self._segment_cache:
+                raw_items.extend(items)
+
+            elif exporter in (TimeSeriesExporter.RAW,
+                              TimeSeriesExporter.CHANGES_ONLY,
+                              TimeSeriesExporter.DISCONTINUITIES_ONLY,
+                              TimeSeriesExporter.DECIMATED):
+                batched_items.extend(items)
 
             elif exporter in (TimeSeriesExporter.AGGREGATE_MEAN,
                               TimeSeriesExporter.AGGREGATE_SUM,
                               TimeSeriesExporter.AGGREGATE_BAND,
                               TimeSeriesExporter.AGGREGATE_COUNT):
-                for item in items:
-                    builder = AggregatedFluxQueryBuilder(item, lone_value=True)
-                    yield item.export_name, builder
+                aggregate_items.extend(items)
 
-            elif exporter in (TimeSeriesExporter.WINDOWED_MEAN,
-                              TimeSeriesExporter.WINDOWED_SUM,
-                              TimeSeriesExporter.WINDOWED_BAND,
-                              TimeSeriesExporter.WINDOWED_COUNT):
+            elif exporter in _windowed_exporters:
                 for item in items:
                     windowed_items.append(item)
 
-        if len(windowed_items):
+        if len(batched_items) and self._shardable(batched_items):
+            yield "batched", ShardedFluxQueryBuilder(batched_items,
+                                                     windowed=False,
+                                                     shards=self._shards)
+        elif len(batched_items) == 1:
+            yield from self._generate_single_query(batched_items[0])
+        elif len(batched_items):
+            batched_builder = BatchedFluxQueryBuilder()
+            for item in batched_items:
+                batched_builder.add_item(item, lone_value=True)
+            yield "batched", batched_builder
+
+        if len(aggregate_items) == 1:
+            builder = AggregatedFluxQueryBuilder(aggregate_items[0],
+                                                 lone_value=True)
+            yield aggregate_items[0].export_name, builder
+        elif len(aggregate_items):
+            aggregate_builder = GroupedAggregateFluxQueryBuilder()
+            for item in aggregate_items:
+                aggregate_builder.add_item(item, lone_value=True)
+            yield "aggregates", aggregate_builder
+
+        if len(raw_items):
+            yield "raw", SegmentCachedFluxQueryBuilder(raw_items,
+                                                       windowed=False)
+
+        if not len(windowed_items):
+            return
+        name = self._windowed_name(windowed_items[0].time_span)
+        if self._segment_cacheable(windowed_items):
+            yield name, SegmentCachedFluxQueryBuilder(windowed_items,
+                                                      windowed=True)
+        elif self._shardable(windowed_items, windowed=True):
+            yield name, ShardedFluxQueryBuilder(windowed_items, windowed=True,
+                                                shards=self._shards,
+                                                common_tags=self._common_tags)
+        else:
             windowed_builder = WindowedFluxQueryBuilder(self._common_tags)
             for item in windowed_items:
                 windowed_builder.add_item(item, lone_value=True)
-            yield "windowed", windowed_builder
+            yield name, windowed_builder
+
+    @staticmethod
+    def _item_columns(item):
+        if item.exporter in (TimeSeriesExporter.WINDOWED_BAND,
+                             TimeSeriesExporter.AGGREGATE_BAND):
+            return _band_columns(item)
+        return [item.export_name]
+
+    def _response_columns(self, item):
+        if item.exporter in _aggregate_exporters:
+            return self._item_columns(item)
+        return ['_time'] + self._item_columns(item)
+
+    def resolve_limits(self, domain, results):
+        """
+        Join the results of the chunks of split items of the domain into a
+        result for each item, return the results of downgraded items under
+        their own export names, and add error results for rejected items, in
+        its results as returned for the queries generated by
+        generate_queries().
+        """
+        for item, downgraded in self._downgrades.get(domain, []):
+            part = results.pop(downgraded.export_name)
+            result = {'strategy': downgraded.exporter,
+                      'columns': ['_time', item.export_name],
+                      'data': part['data']}
+            if part.get('error'):
+                result['error'] = part['error']
+            results[item.export_name] = result
+        for item, chunks in self._splits.get(domain, []):
+            parts = [results.pop(x.export_name) for x in chunks]
+            result = {'strategy': item.exporter,
+                      'columns': self._response_columns(item),
+                      'data': None}
+            errors = [x['error'] for x in parts if x.get('error')]
+            if errors:
+                result['error'] = errors[0]
+            else:
+                result['data'] = [row for x in parts
+                                  for row in x['data'] or []]
+            results[item.export_name] = result
+        for item, reason in self._rejected.get(domain, []):
+            results[item.export_name] = {
+                'strategy': item.exporter,
+                'columns': self._response_columns(item),
+                'data': None,
+                'error': reason
+            }
+        return results
+
+    def resolve_duplicates(self, domain, results):
+        """
+        Add the results of duplicate items of the domain to its results,
+        as returned for the queries generated by generate_queries().
+        """
+        for item, original in self._duplicates.get(domain, []):
+            renames = dict(zip(self._item_columns(original),
+                               self._item_columns(item)))
+            if original.export_name in results:
+                result = dict(results[original.export_name])
+                result['columns'] = [renames.get(x, x)
+                                     for x in result['columns']]
+                results[item.export_name] = result
+                continue
+            for result in results.values():
+                # Windowed items are columns of a table, whose strategy
+                # lists the exporter of each.
+                strategy = result['strategy']
+                if not isinstance(strategy, dict) or \
+                        original.export_name not in strategy:
+                    continue
+                indices = [result['columns'].index(x) for x in renames.keys()]
+                strategy[item.export_name] = strategy[original.export_name]
+                result['columns'] = result['columns'] + list(renames.values())
+                if result['data'] is not None:
+                    result['data'] = [
+                        tuple(row) + tuple(row[x] for x in indices)
+                        for row in result['data']]
+        return results
+
+    def _generate_single_query(self, item):
+        if item.exporter == TimeSeriesExporter.CHANGES_ONLY:
+            builder = ChangesOnlyFluxQueryBuilder(item, lone_value=True)
+        elif item.exporter == TimeSeriesExporter.DISCONTINUITIES_ONLY:
+            builder = DiscontinuitiesOnlyFluxQueryBuilder(item,
+                                                          lone_value=True)
+        elif item.exporter == TimeSeriesExporter.DECIMATED:
+            builder = DecimatedFluxQueryBuilder(item, lone_value=True)
+        else:
+            builder = SimpleFluxQueryBuilder(item, lone_value=True)
+        yield item.export_name, builder
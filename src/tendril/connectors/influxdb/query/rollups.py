@@ -0,0 +1,218 @@
+
+
+import time
+from datetime import datetime
+from datetime import timezone
+
+from tendril import config
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import QueryTimeSpanTModel
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# Rollup buckets hold downsampled copies of a domain's data, written by
+# periodic tasks. Each rollup holds the result of a single aggregate
+# function applied over windows of its resolution, with the same
+# measurements, tags and fields as the source data. Points are expected to
+# be timestamped at the start of their window, so that rollup windows fall
+# within the windows of any coarser aggregation which is a multiple of the
+# resolution.
+#
+# Windowed queries can be served from a rollup if the rollup function can be
+# re-aggregated into the requested exporter. Rollup tasks lag behind the
+# source data, so the part of the time span after the rollup's delay is
+# still read from the source bucket.
+#
+# The mean of the means of rollup windows is only the mean over the coarser
+# window if every rollup window holds the same number of points. Mean
+# rollups are therefore only used if they are declared uniform. Otherwise,
+# WINDOWED_MEAN is served from a sum and a count rollup of the same
+# resolution, as the total of the sums over the total of the counts (see
+# MeanRollup).
+#
+# WINDOWED_BAND is served from a min, a max and a mean serving rollup of the
+# same resolution together (see BandRollup). Band quantiles cannot be
+# re-aggregated, and are always read from the source bucket.
+
+# (exporter, rollup function) -> function used to re-aggregate rollup values
+_reaggregators = {
+    (TimeSeriesExporter.WINDOWED_MEAN, 'mean'): 'mean',
+    (TimeSeriesExporter.WINDOWED_SUM, 'sum'): 'sum',
+    (TimeSeriesExporter.WINDOWED_COUNT, 'count'): 'sum',
+}
+
+
+class RollupBucket(object):
+    def __init__(self, domain, bucket, resolution, fn,
+                 retention=None, delay=None, uniform=False):
+        self.domain = domain
+        self.bucket = bucket
+        # Window width of the rollup, in seconds.
+        self.resolution = int(resolution)
+        self.fn = fn
+        # Time in seconds for which rollup data is kept. None if forever.
+        self.retention = retention
+        # Time in seconds by which the rollup may lag behind the source
+        # data. Defaults to twice the resolution.
+        self.delay = delay if delay is not None else 2 * self.resolution
+        # Whether every window of the source data holds the same number of
+        # points, which is needed for mean rollups to be re-aggregated.
+        self.uniform = uniform
+
+    def __repr__(self):
+        return f"<RollupBucket {self.bucket} {self.fn} {self.resolution}s>"
+
+    @property
+    def sources(self):
+        # The rollup buckets read to serve queries from the rollup.
+        return [self]
+
+    def reaggregator(self, exporter):
+        if self.fn == 'mean' and not self.uniform:
+            return None
+        return _reaggregators.get((exporter, self.fn), None)
+
+    def can_serve(self, exporter, time_span: QueryTimeSpanTModel, now):
+        if self.reaggregator(exporter) is None:
+            return False
+        window_width = time_span.window_width
+        if window_width.microseconds or \
+                window_width.total_seconds() < self.resolution:
+            return False
+        if int(window_width.total_seconds()) % self.resolution:
+            return False
+        if self.retention is not None and \
+                time_span.start.timestamp() < now - self.retention:
+            return False
+        return True
+
+    def cutoff(self, time_span: QueryTimeSpanTModel, now):
+        # The rollup serves the span up to the last complete window of the
+        # query before its delay. Returns None if that leaves nothing.
+        width = int(time_span.window_width.total_seconds())
+        cutoff = int(now - self.delay)
+        cutoff -= cutoff % width
+        cutoff = min(cutoff, int(time_span.end.timestamp()))
+        if cutoff <= int(time_span.start.timestamp()):
+            return None
+        return datetime.fromtimestamp(cutoff, tz=timezone.utc)
+
+
+class MeanRollup(RollupBucket):
+    # Serves WINDOWED_MEAN from a sum and a count rollup of the same
+    # resolution. Both are re-aggregated with sum, and the mean of each
+    # window is the ratio of the two.
+    def __init__(self, sums, counts):
+        retentions = [x.retention for x in (sums, counts)
+                      if x.retention is not None]
+        super().__init__(sums.domain, None, sums.resolution, 'mean',
+                         retention=min(retentions) if retentions else None,
+                         delay=max(sums.delay, counts.delay))
+        self.sums = sums
+        self.counts = counts
+
+    def __repr__(self):
+        return f"<MeanRollup {self.sums.bucket} / {self.counts.bucket} " \
+               f"{self.resolution}s>"
+
+    @property
+    def sources(self):
+        return [self.sums, self.counts]
+
+    def reaggregator(self, exporter):
+        if exporter == TimeSeriesExporter.WINDOWED_MEAN:
+            return 'sum'
+        return None
+
+
+class BandRollup(RollupBucket):
+    # Serves the band statistics of WINDOWED_BAND from a min and a max
+    # rollup, re-aggregated with min and max, and a rollup which can serve
+    # WINDOWED_MEAN, all of the same resolution.
+    def __init__(self, minimum, maximum, mean):
+        parts = (minimum, maximum, mean)
+        retentions = [x.retention for x in parts if x.retention is not None]
+        super().__init__(minimum.domain, None, minimum.resolution, 'band',
+                         retention=min(retentions) if retentions else None,
+                         delay=max(x.delay for x in parts))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.mean = mean
+
+    def __repr__(self):
+        return f"<BandRollup {self.minimum.bucket} / {self.maximum.bucket} " \
+               f"/ {self.mean!r} {self.resolution}s>"
+
+    @property
+    def sources(self):
+        return [self.minimum, self.maximum] + self.mean.sources
+
+    @property
+    def statistics(self):
+        # (band statistic, rollup it is read from)
+        return [('min', self.minimum), ('max', self.maximum),
+                ('mean', self.mean)]
+
+    def reaggregator(self, exporter):
+        if exporter == TimeSeriesExporter.WINDOWED_BAND:
+            return 'band'
+        return None
+
+
+def _get_rollups(domain):
+    rollups = getattr(config, f'INFLUXDB_{domain.upper()}_ROLLUPS')
+    return sorted([RollupBucket(domain, **x) for x in rollups],
+                  key=lambda x: x.resolution, reverse=True)
+
+
+def _get_mean_rollups(rollups):
+    counts = {x.resolution: x for x in rollups if x.fn == 'count'}
+    return [MeanRollup(x, counts[x.resolution]) for x in rollups
+            if x.fn == 'sum' and x.resolution in counts]
+
+
+def _get_band_rollups(rollups, mean_rollups):
+    # Uniform mean rollups are preferred over those derived from sums and
+    # counts, which need two rollups to be read.
+    means = {}
+    for x in mean_rollups + [x for x in rollups
+                             if x.fn == 'mean' and x.uniform]:
+        means[x.resolution] = x
+    minimums = {x.resolution: x for x in rollups if x.fn == 'min'}
+    return [BandRollup(minimums[x.resolution], x, means[x.resolution])
+            for x in rollups if x.fn == 'max' and
+            x.resolution in minimums and x.resolution in means]
+
+
+def _get_serving_rollups(rollups):
+    means = _get_mean_rollups(rollups)
+    return sorted(rollups + means + _get_band_rollups(rollups, means),
+                  key=lambda x: x.resolution, reverse=True)
+
+
+_rollups = {x: _get_rollups(x) for x in INFLUXDB_BUCKETS}
+
+# Rollups which can serve queries, including those derived from others.
+# Of those with the same resolution, the configured rollups are preferred.
+_serving_rollups = {x: _get_serving_rollups(y) for x, y in _rollups.items()}
+
+
+def select_rollup(domain, exporter, time_span: QueryTimeSpanTModel, now=None):
+    """
+    Return the coarsest rollup of the domain which can serve the exporter
+    over the time span, along with the time up to which it should be used.
+    Returns (None, None) if the source bucket should be used throughout.
+    """
+    if now is None:
+        now = time.time()
+    for rollup in _serving_rollups.get(domain, []):
+        if not rollup.can_serve(exporter, time_span, now):
+            continue
+        cutoff = rollup.cutoff(time_span, now)
+        if cutoff is None:
+            continue
+        return rollup, cutoff
+    return None, None
@@ -1,11 +1,11 @@
 
 
 from .builder import InfluxDBFluxQueryBuilderBase
+from .columnar import result_frame
 
 
 class DistinctTagsFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
     _strategy = 'DistinctTagsExtraction'
-    want_data_frame = True
 
     def __init__(self, bucket, measurement, field, tag,
                  filters=None, time_span=None):
@@ -29,8 +29,8 @@ class DistinctTagsFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
         if self.time_span:
             rv += f'  start: {int(self.time_span.start.timestamp())},\n'
             rv += f'  stop: {int(self.time_span.end.timestamp())},\n'
-        rv += f')\n\n'
-        rv += f' |> distinct(column: "_value")\n'
+        rv += ')\n\n'
+        rv += ' |> distinct(column: "_value")\n'
         return rv
 
     def _build_filtered(self):
@@ -40,13 +40,14 @@ class DistinctTagsFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
         rv += f' |> distinct(column: "{self._tag}")\n'
         return rv
 
-    def build(self):
+    def _render(self):
         if not self._simple_filters:
             return self._build_unfiltered()
         else:
             return self._build_filtered()
 
     def repacker(self, response):
-        if '_value' not in response.keys():
+        df = result_frame(response)
+        if '_value' not in df.columns:
             return []
-        return response['_value'].to_list()
+        return df['_value'].to_list()
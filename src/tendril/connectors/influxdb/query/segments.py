@@ -0,0 +1,380 @@
+
+
+import time
+import polars
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from collections import OrderedDict
+from typing import List
+
+from tendril.config import INFLUXDB_SEGMENT_CACHE_MAX_ROWS
+from tendril.config import INFLUXDB_QUERY_CACHE_LIVE_MARGIN
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+
+from .builder import InfluxDBFluxQueryBuilderBase
+from .builder import BatchedFluxQueryBuilder
+from .builder import WindowedFluxQueryBuilder
+from .builder import _buckets
+from .builder import _escape
+from .columnar import result_frame
+from .columnar import select_columns
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# Incremental range caching for RAW and WINDOWED items. The data already
+# fetched for each series is held as a set of covered time segments. When a
+# new time span is requested, only the parts of it which are not covered are
+# queried from the server, and the results are stitched together with the
+# cached rows.
+#
+# All segment boundaries are in integer epoch seconds, which is the
+# resolution at which the builders render ranges. For windowed items, the
+# boundaries are aligned to the window width so that every cached window is
+# complete, and rows are assigned to segments by the start of their window
+# (aggregateWindow places _time at the window stop). Nothing newer than the
+# live margin is stored, since data for it may still be arriving, and
+# neither is the last window of a time span with a partial_window_end.
+
+
+def _to_datetime(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc)
+
+
+def _normalize(df):
+    # Columns missing from a response come back untyped.
+    return df.with_columns(
+        polars.col("_time").cast(polars.Datetime("ns", "UTC")))
+
+
+def _subtract_intervals(start, end, intervals):
+    rv = []
+    cursor = start
+    for a, b in intervals:
+        if b <= cursor:
+            continue
+        if a >= end:
+            break
+        if a > cursor:
+            rv.append((cursor, a))
+        cursor = max(cursor, b)
+    if cursor < end:
+        rv.append((cursor, end))
+    return rv
+
+
+def _merge_intervals(intervals):
+    rv = []
+    for a, b in sorted(intervals):
+        if rv and a <= rv[-1][1]:
+            rv[-1] = (rv[-1][0], max(rv[-1][1], b))
+        else:
+            rv.append((a, b))
+    return rv
+
+
+class _SeriesSegments(object):
+    def __init__(self, offset):
+        # Offset (in seconds) from the row _time to the point used to
+        # assign the row to a segment. This is the window width for
+        # windowed series and 0 for raw series.
+        self.offset = offset
+        self.intervals = []
+        self.frame = None
+
+    @property
+    def rows(self):
+        return 0 if self.frame is None else self.frame.height
+
+    def _membership(self, start, end):
+        position = polars.col("_time") - timedelta(seconds=self.offset)
+        return (position >= _to_datetime(start)) & \
+            (position < _to_datetime(end))
+
+    def rows_in(self, start, end):
+        if self.frame is None:
+            return None
+        return self.frame.filter(self._membership(start, end))
+
+    def add(self, start, end, df):
+        df = df.filter(self._membership(start, end))
+        if self.frame is None:
+            self.frame = df
+        else:
+            self.frame = polars.concat(
+                [self.frame.filter(~self._membership(start, end)), df],
+                how='diagonal_relaxed'
+            ).sort("_time")
+        self.intervals = _merge_intervals(self.intervals + [(start, end)])
+
+
+class SegmentStore(object):
+    def __init__(self, max_rows):
+        self._max_rows = max_rows
+        self._series = OrderedDict()
+
+    def get(self, key, offset):
+        if key not in self._series:
+            self._series[key] = _SeriesSegments(offset)
+        self._series.move_to_end(key)
+        return self._series[key]
+
+    def trim(self):
+        total = sum(x.rows for x in self._series.values())
+        while total > self._max_rows and len(self._series) > 1:
+            _, series = self._series.popitem(last=False)
+            total -= series.rows
+
+    def clear(self):
+        self._series.clear()
+
+
+segment_store = SegmentStore(INFLUXDB_SEGMENT_CACHE_MAX_ROWS)
+
+
+class OpenValuesFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
+    # Fetches the last value before the start of the time span for each
+    # item, with each yielded as a separate result. Fields are only filtered
+    # on if requested, mirroring the windowed and raw builders respectively.
+    def __init__(self, items: List[TimeSeriesQueryItemTModel], stop,
+                 filter_fields=True):
+        super().__init__()
+        self._items = items
+        self._stop = stop
+        self._filter_fields = filter_fields
+        if items:
+            self.bucket = items[0].domain
+
+    @staticmethod
+    def result_name(params: TimeSeriesQueryItemTModel):
+        return f'{params.export_name}__openValue'
+
+    def _render_item(self, params: TimeSeriesQueryItemTModel):
+        rv = f'{_escape(params.export_name)}_openValue = '
+        rv += self._render_bucket()
+        rv += f' |> range(start: -inf, stop: {self._stop})\n'
+        rv += self._render_simple_filter('_measurement', params.measurement)
+        for key, value in params.tags.items():
+            rv += self._render_simple_filter(key, value)
+        if self._filter_fields:
+            for field in params.fields:
+                # TODO This breaks for not lone values
+                rv += self._render_simple_filter('_field', field)
+        rv += ' |> last()\n'
+        rv += ' |> keep(columns: ["_time", "_value"])\n'
+        rv += f' |> yield(name: "{self.result_name(params)}")\n\n'
+        return rv
+
+    def _render(self):
+        return ''.join([self._render_item(x) for x in self._items])
+
+
+class SegmentCachedFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
+    # Composite builder which produces the same output as the batched RAW
+    # or the windowed builder for its items, but uses the segment store to
+    # only query the parts of the time span not already fetched. Composite
+    # builders are executed by calling execute() with a function which runs
+    # a flux script and returns the columnar response.
+    composite = True
+    # The scripts run depend on the state of the segment store, and are
+    # run through execute() without params.
+    use_params = False
+
+    def __init__(self, items: List[TimeSeriesQueryItemTModel], windowed,
+                 store=segment_store,
+                 live_margin=INFLUXDB_QUERY_CACHE_LIVE_MARGIN):
+        super().__init__()
+        self._items = items
+        self._windowed = windowed
+        self._store = store
+        self._live_margin = live_margin
+        self.bucket = items[0].domain
+        self.time_span = items[0].time_span
+        for item in items:
+            if not _buckets[item.domain] == self._bucket:
+                raise ValueError("We require all segment cached queries to "
+                                 "have the same domain.")
+            if not item.time_span == self._time_span:
+                raise ValueError("We require all segment cached queries to "
+                                 "have the same time span")
+
+    @property
+    def batched(self):
+        return not self._windowed
+
+    @property
+    def window(self):
+        if not self._windowed:
+            return 1
+        return int(self._time_span.window_width.total_seconds())
+
+    def _offset(self):
+        return self.window if self._windowed else 0
+
+    def _series_key(self, params: TimeSeriesQueryItemTModel):
+        return (params.domain, params.measurement,
+                tuple(sorted(params.tags.items())), tuple(params.fields),
+                params.exporter.value, self._offset())
+
+    def _bounds(self):
+        w = self.window
+        start = int(self._time_span.start.timestamp())
+        end = int(self._time_span.end.timestamp())
+        horizon = int(time.time()) - self._live_margin
+        start -= start % w
+        if end % w:
+            end += w - end % w
+        if self._time_span.partial_window_end is not None:
+            horizon = min(horizon, end - w)
+        horizon -= horizon % w
+        return start, end, horizon
+
+    def _gap_item(self, params, start, end):
+        time_span = params.time_span.copy(update={
+            'start': _to_datetime(start), 'end': _to_datetime(end),
+            'width': timedelta(seconds=end - start)
+        })
+        return params.copy(update={'time_span': time_span,
+                                   'include_ends': False})
+
+    def _gap_builder(self, start, end):
+        items = [self._gap_item(x, start, end) for x in self._items]
+        if self._windowed:
+            builder = WindowedFluxQueryBuilder(None)
+            builder.use_params = False
+            for item in items:
+                builder.add_item(item, lone_value=True)
+            return builder
+        builder = BatchedFluxQueryBuilder()
+        builder.use_params = False
+        for item in items:
+            builder.add_item(item, lone_value=True)
+        return builder
+
+    def _gap_frames(self, response):
+        # Per-item long frames of (_time, _value) from a gap response.
+        rv = {}
+        for item in self._items:
+            if self._windowed:
+                df = select_columns(result_frame(response, 'windowed'),
+                                    ['_time', item.export_name])
+                df = df.rename({item.export_name: "_value"})
+            else:
+                df = select_columns(result_frame(response, item.export_name),
+                                    ['_time', item.measurement])
+                df = df.rename({item.measurement: "_value"})
+            rv[item.export_name] = _normalize(df).drop_nulls("_value")
+        return rv
+
+    def build(self):
+        # Only used for logging and as a description. The executed scripts
+        # depend on the state of the segment store.
+        start, end, _ = self._bounds()
+        return self._gap_builder(start, end).build()
+
+    def _render_gap(self, start, end):
+        rv = self._gap_builder(start, end).build()
+        if self._windowed:
+            rv += ' |> yield(name: "windowed")\n\n'
+        return rv
+
+    async def execute(self, fetch):
+        start, end, horizon = self._bounds()
+        cacheable_end = min(end, horizon)
+
+        series = {x.export_name: self._store.get(self._series_key(x),
+                                                 self._offset())
+                  for x in self._items}
+
+        gaps = []
+        for item in self._items:
+            if cacheable_end > start:
+                intervals = series[item.export_name].intervals
+                gaps.extend(_subtract_intervals(start, cacheable_end,
+                                                intervals))
+        if end > max(start, horizon):
+            gaps.append((max(start, horizon), end))
+        gaps = _merge_intervals(gaps)
+
+        open_items = [x for x in self._items if x.include_ends]
+        scripts = [self._render_gap(a, b) for a, b in gaps]
+        if open_items:
+            open_script = OpenValuesFluxQueryBuilder(
+                open_items, int(self._time_span.start.timestamp()),
+                filter_fields=self._windowed).build()
+            if scripts:
+                scripts[0] += open_script
+            else:
+                scripts.append(open_script)
+
+        fetched = {x.export_name: [] for x in self._items}
+        open_values = {}
+        for idx, script in enumerate(scripts):
+            response = await fetch(script)
+            if idx < len(gaps):
+                a, b = gaps[idx]
+                for name, df in self._gap_frames(response).items():
+                    fetched[name].append(df)
+                    if min(b, cacheable_end) > a:
+                        series[name].add(a, min(b, cacheable_end), df)
+            for item in open_items:
+                df = result_frame(
+                    response, OpenValuesFluxQueryBuilder.result_name(item))
+                if not df.is_empty():
+                    open_values[item.export_name] = _normalize(df)
+        self._store.trim()
+
+        logger.debug(f"Segment cache fetched {gaps} for span {start}-{end}")
+        frames = {}
+        for item in self._items:
+            cached = series[item.export_name].rows_in(start, end)
+            parts = [x for x in [open_values.get(item.export_name), cached]
+                     + fetched[item.export_name] if x is not None]
+            frames[item.export_name] = self._stitch(parts, start, end)
+        return self._assemble(frames)
+
+    def _stitch(self, parts, start, end):
+        parts = [x.select(["_time", "_value"])
+                 for x in parts if not x.is_empty()]
+        if self._windowed:
+            # The windowed builder converts all values to float in flux.
+            value = polars.col("_value").cast(polars.Float64)
+            parts = [x.with_columns(value) for x in parts]
+        if not parts:
+            return polars.DataFrame(
+                schema={"_time": polars.Datetime("ns", "UTC"),
+                        "_value": polars.Float64})
+        df = polars.concat(parts, how='diagonal_relaxed')
+        if not self._windowed:
+            # Raw rows are limited to the requested span, except for the
+            # open value, which is the only row allowed before the start.
+            first = _to_datetime(int(self._time_span.start.timestamp()))
+            last = _to_datetime(int(self._time_span.end.timestamp()))
+            df = df.filter(polars.col("_time") < last)
+            before = df.filter(polars.col("_time") < first) \
+                .sort("_time").tail(1)
+            after = df.filter(polars.col("_time") >= first)
+            df = polars.concat([before, after])
+        return df.unique(subset=["_time"], keep='last').sort("_time")
+
+    def _assemble(self, frames):
+        if not self._windowed:
+            return {name: df.rows() for name, df in frames.items()}
+        times = polars.concat([x.select("_time") for x in frames.values()]) \
+            .unique().sort("_time")
+        for name, df in frames.items():
+            times = times.join(df.rename({"_value": name}),
+                               on="_time", how="left")
+        return times.select(self.response_columns).rows()
+
+    @property
+    def strategy(self):
+        return {x.export_name: x.exporter for x in self._items}
+
+    @property
+    def response_columns(self):
+        if self._windowed:
+            return ['_time'] + [x.export_name for x in self._items]
+        return {x.export_name: ['_time', x.export_name] for x in self._items}
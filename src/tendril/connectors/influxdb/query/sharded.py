@@ -0,0 +1,274 @@
+
+
+import asyncio
+import polars
+from math import ceil
+from datetime import timedelta
+from typing import List
+
+from tendril.config import INFLUXDB_QUERY_SHARDS
+from tendril.config import INFLUXDB_QUERY_SHARD_CONCURRENCY
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+
+from .builder import InfluxDBFluxQueryBuilderBase
+from .builder import BatchedFluxQueryBuilder
+from .builder import SimpleFluxQueryBuilder
+from .builder import ChangesOnlyFluxQueryBuilder
+from .builder import WindowedFluxQueryBuilder
+from .builder import _band_columns
+from .builder import _buckets
+from .builder import _escape
+from .columnar import result_frame
+from .columnar import select_columns
+from .segments import _to_datetime
+from .segments import _normalize
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# Time sharded execution of long range queries. The time span of the items
+# is split into consecutive shards, the query for each shard is run
+# concurrently, and the results are merged back in order. At most
+# concurrency shards of a query are in flight at a time. Each shard is a
+# separate Flux execution with its own response, so a long range query is
+# no longer limited to what a single query worker on the server can do.
+#
+# Shard boundaries are in integer epoch seconds, which is the resolution at
+# which the builders render ranges. For windowed items, the boundaries
+# between shards are aligned to the window width, which is where
+# aggregateWindow places its window boundaries, so that every window falls
+# entirely within one shard and the shards produce exactly the windows of
+# the unsharded query. Only the first shard fetches the open values of
+# items with include_ends.
+#
+# CHANGES_ONLY and DISCONTINUITIES_ONLY items are filtered within each
+# shard, which always keeps the first and last rows of the shard. These are
+# resolved across the seams between shards when the results are merged :
+#
+#   CHANGES_ONLY          : The changes filter is applied again over the
+#                           merged rows. Rows dropped within a shard have the
+#                           same value as the row before them, so the rows
+#                           kept by the shards are enough to find the changes
+#                           over the whole span.
+#   DISCONTINUITIES_ONLY  : Each shard also returns its first two and last
+#                           two rows. The first and last rows of each shard
+#                           are then only kept if the steps to the rows on
+#                           either side of them, which may be in the
+#                           neighbouring shards, are discontinuities.
+
+
+class ShardBatchedFluxQueryBuilder(BatchedFluxQueryBuilder):
+    # Batched builder for a single shard. If edges is set, the first two and
+    # last two rows of each DISCONTINUITIES_ONLY item are also yielded, as a
+    # separate result named by edges_name().
+    use_params = False
+
+    def __init__(self, edges=False):
+        super().__init__()
+        self._edges = edges
+        self.edge_builders = {}
+
+    @staticmethod
+    def edges_name(name):
+        return f'{name}__edges'
+
+    def add_item(self, params: TimeSeriesQueryItemTModel, lone_value=False):
+        super().add_item(params, lone_value=lone_value)
+        if self._edges and \
+                params.exporter == TimeSeriesExporter.DISCONTINUITIES_ONLY:
+            builder = SimpleFluxQueryBuilder(params, lone_value=lone_value)
+            builder.use_params = False
+            self.edge_builders[params.export_name] = builder
+
+    def _render_edges(self, name, builder):
+        prefix = f'{_escape(name)}_edges_'
+        rv = builder._render_subqueries(prefix=prefix)
+        rv += f'{prefix}rows = '
+        rv += builder._render_source(prefix=prefix)
+        rv += builder._render_logic()
+        rv += builder._reshape_output()
+        rv += '\n'
+        rv += f'union(tables: [{prefix}rows |> limit(n: 2), ' \
+              f'{prefix}rows |> tail(n: 2)])\n'
+        rv += f' |> yield(name: "{self.edges_name(name)}")\n\n'
+        return rv
+
+    def _render(self):
+        rv = super()._render()
+        rv += ''.join(self._render_edges(name, builder)
+                      for name, builder in self.edge_builders.items())
+        return rv
+
+
+class ShardedFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
+    # Composite builder which produces the same output as the batched or
+    # the windowed builder for its items, with the time span split into
+    # shards which are queried concurrently.
+    composite = True
+    # The shard scripts are run through execute() without params.
+    use_params = False
+
+    def __init__(self, items: List[TimeSeriesQueryItemTModel], windowed,
+                 shards=INFLUXDB_QUERY_SHARDS, common_tags=None,
+                 concurrency=INFLUXDB_QUERY_SHARD_CONCURRENCY):
+        super().__init__()
+        self._items = items
+        self._windowed = windowed
+        self._shards = shards
+        self._concurrency = concurrency
+        self._common_tags = common_tags
+        self.bucket = items[0].domain
+        self.time_span = items[0].time_span
+        for item in items:
+            if not _buckets[item.domain] == self._bucket:
+                raise ValueError("We require all sharded queries to have "
+                                 "the same domain.")
+            if not item.time_span == self._time_span:
+                raise ValueError("We require all sharded queries to have "
+                                 "the same time span")
+
+    @property
+    def batched(self):
+        return not self._windowed
+
+    def shard_bounds(self):
+        """
+        Return the (start, end) of each shard, in epoch seconds.
+        """
+        start = int(self._time_span.start.timestamp())
+        end = int(self._time_span.end.timestamp())
+        if self._windowed:
+            width = int(self._time_span.window_width.total_seconds())
+            origin = start - start % width
+            step = ceil(ceil((end - origin) / width) / self._shards) * width
+        else:
+            origin = start
+            step = ceil((end - start) / self._shards)
+        step = max(step, 1)
+        bounds = [start] + list(range(origin + step, end, step)) + [end]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _shard_item(self, params, idx, start, end):
+        time_span = params.time_span.copy(update={
+            'start': _to_datetime(start), 'end': _to_datetime(end),
+            'width': timedelta(seconds=end - start),
+            'partial_window_end': None,
+        })
+        include_ends = params.include_ends and not idx
+        return params.copy(update={'time_span': time_span,
+                                   'include_ends': include_ends})
+
+    def shard_builders(self):
+        """
+        Return the builder for each shard, in order.
+        """
+        bounds = self.shard_bounds()
+        rv = []
+        for idx, (start, end) in enumerate(bounds):
+            if self._windowed:
+                builder = WindowedFluxQueryBuilder(self._common_tags)
+                builder.use_params = False
+            else:
+                builder = ShardBatchedFluxQueryBuilder(edges=len(bounds) > 1)
+            for item in self._items:
+                builder.add_item(self._shard_item(item, idx, start, end),
+                                 lone_value=True)
+            rv.append(builder)
+        return rv
+
+    def _render(self):
+        # Only used for logging and as a description.
+        return '\n'.join(x.build() for x in self.shard_builders())
+
+    async def execute(self, fetch):
+        builders = self.shard_builders()
+        limit = asyncio.Semaphore(self._concurrency)
+
+        async def _fetch(builder):
+            async with limit:
+                return await fetch(builder.build())
+
+        responses = await asyncio.gather(*[_fetch(x) for x in builders])
+        logger.debug(f"Fetched {len(builders)} shards for span "
+                     f"{self._time_span.start} - {self._time_span.end}")
+        if self._windowed:
+            return self._merge_windowed(responses)
+        return {x.export_name: self._merge_item(x, builders[0], responses)
+                for x in self._items}
+
+    def _merge_windowed(self, responses):
+        # Windows are complete within each shard, and the open value can
+        # only be in the first.
+        frames = [select_columns(result_frame(x), self.response_columns)
+                  for x in responses]
+        frames = [x for x in frames if not x.is_empty()]
+        if not frames:
+            return []
+        return polars.concat(frames, how='diagonal_relaxed').rows()
+
+    @staticmethod
+    def _item_frame(response, name, column):
+        return _normalize(select_columns(result_frame(response, name),
+                                         ['_time', column]))
+
+    def _merge_item(self, params, builder, responses):
+        name = params.export_name
+        column = params.measurement
+        frames = [self._item_frame(x, name, column) for x in responses]
+        df = polars.concat(frames, how='diagonal_relaxed')
+        if params.exporter == TimeSeriesExporter.CHANGES_ONLY:
+            changes = ChangesOnlyFluxQueryBuilder(params, lone_value=True,
+                                                  server_side=False)
+            return changes.repack_frame(df)
+        if params.exporter == TimeSeriesExporter.DISCONTINUITIES_ONLY and \
+                len(frames) > 1:
+            edges = polars.concat(
+                [self._item_frame(x, builder.edges_name(name), column)
+                 for x in responses],
+                how='diagonal_relaxed')
+            df = self._resolve_seams(df, frames, edges, column,
+                                     builder._builders[name].step_size)
+        return df.rows()
+
+    @staticmethod
+    def _resolve_seams(df, frames, edges, column, step_size):
+        # The rows on either side of each seam row are amongst the edge rows
+        # of its own and the neighbouring shards.
+        if df.is_empty():
+            return df
+        lower, upper = (float(x) for x in step_size)
+        seams = set()
+        for frame in frames:
+            if not frame.is_empty():
+                seams.update([frame['_time'][0], frame['_time'][-1]])
+        seams -= {df['_time'][0], df['_time'][-1]}
+
+        value = polars.col(column).cast(polars.Float64, strict=False)
+        before = value - value.shift(1)
+        after = value.shift(-1) - value
+        step = (before < lower) | (before > upper) | \
+            (after < lower) | (after > upper)
+        edges = edges.unique(subset=["_time"]).sort("_time") \
+            .with_columns(step.fill_null(False).alias("_step"))
+        dropped = edges.filter(polars.col("_time").is_in(list(seams)) &
+                               ~polars.col("_step"))
+        return df.filter(
+            ~polars.col("_time").is_in(dropped["_time"].to_list()))
+
+    @property
+    def strategy(self):
+        return {x.export_name: x.exporter for x in self._items}
+
+    @property
+    def response_columns(self):
+        if self._windowed:
+            rv = ['_time']
+            for item in self._items:
+                if item.exporter == TimeSeriesExporter.WINDOWED_BAND:
+                    rv.extend(_band_columns(item))
+                else:
+                    rv.append(item.export_name)
+            return rv
+        return {x.export_name: ['_time', x.export_name] for x in self._items}
@@ -0,0 +1,292 @@
+
+
+import polars
+from datetime import timedelta
+from typing import List
+
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+
+from .builder import InfluxDBFluxQueryBuilderBase
+from .builder import BatchedFluxQueryBuilder
+from .builder import WindowedFluxQueryBuilder
+from .builder import _band_columns
+from .columnar import result_frame
+from .columnar import select_columns
+from .segments import OpenValuesFluxQueryBuilder
+from .segments import _normalize
+from .segments import _to_datetime
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# Shared scans for items of a single domain which have different time
+# spans. Items reading the same series over overlapping time spans are
+# served from a single query over the union of their spans, and each item's
+# rows are sliced out of its result client-side.
+#
+# Raw series can always be sliced. Windowed series are only merged if their
+# time spans are aligned to their window width, since aggregateWindow
+# windows are aligned to the epoch and only then are the windows of the
+# covering scan identical to those of each item. Other windowed items are
+# scanned over their own time span, but are still rendered into the same
+# script. Open values of windowed items are fetched separately for each
+# distinct start, since the covering scan only has one for its own start.
+#
+# All scans are rendered into one script, so the builder is executed like
+# any other, and results go through the query cache as usual.
+
+
+def _bounds(item: TimeSeriesQueryItemTModel):
+    return int(item.time_span.start.timestamp()), \
+        int(item.time_span.end.timestamp())
+
+
+def _aligned(item: TimeSeriesQueryItemTModel):
+    width = item.time_span.window_width
+    if width.microseconds or width.total_seconds() < 1:
+        return False
+    width = int(width.total_seconds())
+    start = item.time_span.start.timestamp()
+    end = item.time_span.end.timestamp()
+    return start % width == 0 and end % width == 0
+
+
+class _Scan(object):
+    def __init__(self, name, start, end, items):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.items = items
+
+    def covering_span(self):
+        return self.items[0].time_span.copy(update={
+            'start': _to_datetime(self.start), 'end': _to_datetime(self.end),
+            'width': timedelta(seconds=self.end - self.start),
+            'partial_window_end': None,
+        })
+
+    def covering_item(self, include_ends, time_span=None):
+        return self.items[0].copy(update={
+            'time_span': time_span or self.covering_span(),
+            'export_name': self.name, 'include_ends': include_ends
+        })
+
+
+class SharedScanFluxQueryBuilder(InfluxDBFluxQueryBuilderBase):
+    """
+    Batched builder for RAW or windowed items of a single domain with
+    differing time spans, which shares scans of overlapping series.
+
+    Windowed items are passed in as a list of ``(name, items)`` groups,
+    each of which produces one windowed table under its name, in the same
+    form as a WindowedFluxQueryBuilder for those items would. RAW items are
+    passed in as a single group, and each produces its own result under its
+    export name, like a BatchedFluxQueryBuilder.
+    """
+    batched = True
+    # Scans have differing time spans, so they are always rendered with
+    # literal bounds.
+    use_params = False
+
+    def __init__(self, groups, windowed):
+        super().__init__()
+        self._groups = groups
+        self._windowed = windowed
+        items = [x for _, group in groups for x in group]
+        self.bucket = items[0].domain
+        self._plan(items)
+
+    def _series_key(self, params: TimeSeriesQueryItemTModel):
+        rv = (params.measurement, tuple(sorted(params.tags.items())),
+              tuple(params.fields))
+        if self._windowed:
+            rv += (params.exporter, params.time_span.window_width,
+                   tuple(params.quantiles or []))
+        return rv
+
+    def _mergeable(self, params):
+        return not self._windowed or _aligned(params)
+
+    def _plan(self, items: List[TimeSeriesQueryItemTModel]):
+        series = {}
+        for item in items:
+            series.setdefault(self._series_key(item), []).append(item)
+
+        self._scans = []
+        self._item_scans = {}
+        for series_items in series.values():
+            # Mergeable items are merged into the last scan they overlap,
+            # which is the only candidate since they are sorted by start.
+            # Other items share a scan only with items of the same span.
+            scans, merged = [], None
+            for item in sorted(series_items, key=_bounds):
+                start, end = _bounds(item)
+                if self._mergeable(item):
+                    if merged and start <= merged.end:
+                        merged.end = max(merged.end, end)
+                        merged.items.append(item)
+                        continue
+                    merged = _Scan(None, start, end, [item])
+                    scans.append(merged)
+                    continue
+                for scan in scans:
+                    if scan is not merged and \
+                            (scan.start, scan.end) == (start, end):
+                        scan.items.append(item)
+                        break
+                else:
+                    scans.append(_Scan(None, start, end, [item]))
+            for scan in scans:
+                scan.name = f'scan{len(self._scans)}'
+                self._scans.append(scan)
+                for item in scan.items:
+                    self._item_scans[id(item)] = scan
+
+        # Open values of windowed items, for each distinct series and start.
+        self._open_values = {}
+        if self._windowed:
+            for item in items:
+                if not item.include_ends:
+                    continue
+                key = (self._series_key(item)[:3], _bounds(item)[0])
+                if key not in self._open_values:
+                    name = f'open{len(self._open_values)}'
+                    self._open_values[key] = item.copy(
+                        update={'export_name': name})
+
+        starts = [x.start for x in self._scans]
+        ends = [x.end for x in self._scans]
+        self.time_span = items[0].time_span.copy(update={
+            'start': _to_datetime(min(starts)), 'end': _to_datetime(max(ends)),
+            'width': timedelta(seconds=max(ends) - min(starts))
+        })
+        logger.debug(f"Sharing {len(items)} items across "
+                     f"{len(self._scans)} scans")
+
+    def _scan_builders(self):
+        # Raw scans can all go into a single batched builder, since each of
+        # its items is rendered with its own time span. Windowed builders
+        # need a single time span for all their items.
+        if not self._windowed:
+            builder = BatchedFluxQueryBuilder()
+            builder.use_params = False
+            for scan in self._scans:
+                include_ends = any(x.include_ends for x in scan.items)
+                builder.add_item(scan.covering_item(include_ends),
+                                 lone_value=True)
+            yield None, self._scans, builder
+            return
+        spans = {}
+        for scan in self._scans:
+            key = (scan.start, scan.end, scan.items[0].time_span.window_width)
+            spans.setdefault(key, []).append(scan)
+        for idx, scans in enumerate(spans.values()):
+            builder = WindowedFluxQueryBuilder(None)
+            builder.use_params = False
+            time_span = scans[0].covering_span()
+            for scan in scans:
+                builder.add_item(scan.covering_item(False, time_span),
+                                 lone_value=True)
+            yield f'scans{idx}', scans, builder
+
+    def _render(self):
+        parts = []
+        for name, _, builder in self._scan_builders():
+            parts.append(builder.build())
+            if self._windowed:
+                parts.append(f' |> yield(name: "{name}")\n\n')
+        stops = {}
+        for (_, start), item in self._open_values.items():
+            stops.setdefault(start, []).append(item)
+        for stop, items in stops.items():
+            parts.append(OpenValuesFluxQueryBuilder(items, stop).build())
+        return ''.join(parts)
+
+    def _item_columns(self, params: TimeSeriesQueryItemTModel):
+        if params.exporter == TimeSeriesExporter.WINDOWED_BAND:
+            return _band_columns(params)
+        return [params.export_name]
+
+    def _slice_raw(self, df, params: TimeSeriesQueryItemTModel):
+        start, end = (_to_datetime(x) for x in _bounds(params))
+        df = _normalize(df)
+        rv = df.filter((polars.col("_time") >= start) &
+                       (polars.col("_time") < end))
+        if params.include_ends:
+            before = df.filter(polars.col("_time") < start).tail(1)
+            rv = polars.concat([before, rv])
+        return rv.rows()
+
+    def _slice_windowed(self, df, scan, response,
+                        params: TimeSeriesQueryItemTModel):
+        # aggregateWindow places _time at the window stop.
+        start, end = (_to_datetime(x) for x in _bounds(params))
+        columns = self._item_columns(params)
+        scan_columns = self._item_columns(scan.covering_item(False))
+        df = _normalize(select_columns(df, ['_time'] + scan_columns))
+        df = df.filter((polars.col("_time") > start) &
+                       (polars.col("_time") <= end)) \
+            .rename(dict(zip(scan_columns, columns)))
+        df = df.with_columns([polars.col(x).cast(polars.Float64)
+                              for x in columns]) \
+            .filter(polars.any_horizontal(polars.col(columns).is_not_null()))
+        if params.include_ends:
+            key = (self._series_key(params)[:3], _bounds(params)[0])
+            item = self._open_values[key]
+            open_value = result_frame(
+                response, OpenValuesFluxQueryBuilder.result_name(item))
+            if not open_value.is_empty():
+                value = polars.col("_value").cast(polars.Float64)
+                open_value = _normalize(open_value).select(
+                    [polars.col("_time")] + [value.alias(x) for x in columns])
+                df = polars.concat([open_value, df], how='diagonal_relaxed')
+        return df
+
+    def repacker(self, response):
+        frames = {}
+        for name, scans, _ in self._scan_builders():
+            for scan in scans:
+                result = name if self._windowed else scan.name
+                frames[scan.name] = result_frame(response, result)
+
+        if not self._windowed:
+            rv = {}
+            for item in self._groups[0][1]:
+                scan = self._item_scans[id(item)]
+                df = select_columns(frames[scan.name],
+                                    ['_time', item.measurement])
+                rv[item.export_name] = self._slice_raw(df, item)
+            return rv
+
+        rv = {}
+        for name, items in self._groups:
+            parts = []
+            for item in items:
+                scan = self._item_scans[id(item)]
+                parts.append(self._slice_windowed(frames[scan.name], scan,
+                                                  response, item))
+            times = polars.concat([x.select("_time") for x in parts]) \
+                .unique().sort("_time")
+            for df in parts:
+                times = times.join(df, on="_time", how="left")
+            rv[name] = select_columns(times,
+                                      self.response_columns[name]).rows()
+        return rv
+
+    @property
+    def strategy(self):
+        if not self._windowed:
+            return {x.export_name: x.exporter for x in self._groups[0][1]}
+        return {name: {x.export_name: x.exporter for x in items}
+                for name, items in self._groups}
+
+    @property
+    def response_columns(self):
+        if not self._windowed:
+            return {x.export_name: ['_time', x.export_name]
+                    for x in self._groups[0][1]}
+        return {name: ['_time'] + [c for x in items
+                                   for c in self._item_columns(x)]
+                for name, items in self._groups}
@@ -0,0 +1,101 @@
+
+
+import polars
+from .columnar import select_columns
+
+
+# Chunk-wise counterparts of the builder repackers, used when a query is
+# executed as a stream. Each is fed (result, frame) pairs as they are parsed
+# from the response, and returns whatever rows can already be emitted. The
+# remainder is returned by finish() once the response is exhausted.
+
+
+class BufferedStreamRepacker(object):
+    # Fallback for builders which can only be repacked once the entire
+    # response is available. This preserves the streaming interface, but
+    # not its memory characteristics.
+    def __init__(self, builder):
+        self._builder = builder
+        self._frames = {}
+
+    def feed(self, result, df):
+        self._frames.setdefault(result, []).append(df)
+        return None
+
+    def finish(self):
+        response = {k: polars.concat(v, how='diagonal_relaxed')
+                    for k, v in self._frames.items()}
+        return self._builder.repacker(response)
+
+
+class ColumnsStreamRepacker(object):
+    def __init__(self, columns):
+        self._columns = columns
+
+    def feed(self, result, df):
+        return select_columns(df, self._columns).rows()
+
+    def finish(self):
+        return []
+
+
+class _HoldbackStreamRepacker(object):
+    # Holds back the last row seen, since whether it is kept may depend on
+    # the row after it, or on whether it is the last row of the response.
+    def __init__(self, colname):
+        self._colname = colname
+        self._pending = None
+
+    def _prepare(self, df):
+        df = select_columns(df, self._columns())
+        if self._pending is not None:
+            df = polars.concat([self._pending, df], how='diagonal_relaxed')
+        return df
+
+    def _columns(self):
+        return ["_time", self._colname]
+
+    def finish(self):
+        if self._pending is None or self._pending.is_empty():
+            return []
+        return self._pending.select(["_time", self._colname]).rows()
+
+
+class ChangesOnlyStreamRepacker(_HoldbackStreamRepacker):
+    def __init__(self, colname):
+        super().__init__(colname)
+        self._prev_value = None
+
+    def feed(self, result, df):
+        df = self._prepare(df)
+        if df.is_empty():
+            return []
+        prev_value = df[self._colname].shift(1, fill_value=self._prev_value)
+        keep = df[self._colname].ne_missing(prev_value)
+        rv = df.head(-1).filter(keep.head(-1)) \
+            .select(["_time", self._colname]).rows()
+        if df.height > 1:
+            self._prev_value = df[self._colname][-2]
+        self._pending = df.tail(1)
+        return rv
+
+
+class BatchedStreamRepacker(object):
+    def __init__(self, repackers):
+        self._repackers = repackers
+
+    def feed(self, result, df):
+        if result not in self._repackers:
+            return None
+        rows = self._repackers[result].feed(result, df)
+        if not rows:
+            return None
+        return {result: rows}
+
+    def finish(self):
+        rv = {}
+        for name, repacker in self._repackers.items():
+            rows = repacker.finish()
+            if rows:
+                rv[name] = rows
+        return rv
@@ -0,0 +1,274 @@
+
+
+import os
+import mmap
+import struct
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# On-disk write-ahead spool for the async writer. Encoded line protocol
+# payloads which cannot be written to InfluxDB are appended to memory-mapped
+# segment files, one sequence of segments per domain, and are read back in
+# order once the server is able to accept them again.
+#
+# Segments are preallocated to a fixed size and filled with records, each a
+# header containing the payload length and line count followed by the
+# payload. The payload is written before its header, so a record is only
+# visible once it is complete. Unwritten space in a segment is zero, which
+# terminates the record scan when segments are reopened.
+#
+# Appends are not synced to disk as they are made. Segments appended to are
+# synced by sync_files(), which blocks and is meant to be run off the event
+# loop, with the file descriptors from detach_dirty(). Appended records are
+# in the page cache as soon as they are written, so they survive the process
+# crashing, but not the machine, until they are synced.
+#
+# Delivery is at least once. Read positions are only held in memory, so
+# records of partially drained segments are written again after a restart.
+# InfluxDB overwrites points with identical series and timestamps, so this
+# is harmless.
+
+_header = struct.Struct('<II')
+_default_domain = '_default'
+
+
+def sync_files(fds):
+    """
+    Sync and close the file descriptors returned by
+    WriteSpool.detach_dirty(). This blocks, and may be called from another
+    thread.
+    """
+    for fd in fds:
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class _Segment(object):
+    def __init__(self, path, size=None):
+        self.path = path
+        if size is not None:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.size = len(self._map)
+        self.read_offset = 0
+        self.write_offset = 0
+        self.records = 0
+        self.lines = 0
+        self.dirty = False
+        self._scan()
+
+    def _scan(self):
+        while self.write_offset + _header.size <= self.size:
+            length, lines = _header.unpack_from(self._map, self.write_offset)
+            end = self.write_offset + _header.size + length
+            if not length or end > self.size:
+                break
+            self.write_offset += _header.size + length
+            self.records += 1
+            self.lines += lines
+
+    @property
+    def drained(self):
+        return self.read_offset >= self.write_offset
+
+    @property
+    def pending_bytes(self):
+        return self.write_offset - self.read_offset
+
+    def append(self, lines, payload):
+        end = self.write_offset + _header.size + len(payload)
+        if end > self.size:
+            return False
+        self._map[self.write_offset + _header.size:end] = payload
+        _header.pack_into(self._map, self.write_offset, len(payload), lines)
+        self.dirty = True
+        self.write_offset = end
+        self.records += 1
+        self.lines += lines
+        return True
+
+    def read(self, offset):
+        length, lines = _header.unpack_from(self._map, offset)
+        start = offset + _header.size
+        return lines, bytes(self._map[start:start + length])
+
+    def advance(self):
+        length, lines = _header.unpack_from(self._map, self.read_offset)
+        self.read_offset += _header.size + length
+        self.records -= 1
+        self.lines -= lines
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+class WriteSpool(object):
+    """
+    Append-only on-disk spool of encoded line protocol payloads.
+
+    :param directory: Directory in which segment files are kept. Segments
+                      left over from earlier runs are picked up from here.
+    :param max_bytes: Maximum total size of all segment files. Appends
+                      which would exceed this are refused.
+    :param segment_bytes: Size of each segment file. Payloads larger than
+                          this get a segment of their own.
+    """
+    def __init__(self, directory, max_bytes, segment_bytes):
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._segment_bytes = segment_bytes
+        self._segments = {}
+        self._next_sequence = {}
+        self._load()
+
+    def _domain_directory(self, domain):
+        return os.path.join(self._directory, domain or _default_domain)
+
+    def _load(self):
+        os.makedirs(self._directory, exist_ok=True)
+        for name in sorted(os.listdir(self._directory)):
+            path = os.path.join(self._directory, name)
+            if not os.path.isdir(path):
+                continue
+            domain = None if name == _default_domain else name
+            segments = []
+            for fname in sorted(os.listdir(path)):
+                if fname.endswith('.seg'):
+                    segments.append(_Segment(os.path.join(path, fname)))
+            self._segments[domain] = segments
+            self._next_sequence[domain] = 0
+            if segments:
+                last = os.path.basename(segments[-1].path)[:-4]
+                self._next_sequence[domain] = int(last) + 1
+                logger.info(f"Recovered {sum(x.lines for x in segments)} "
+                            f"spooled points for {name} from {path}")
+
+    def _all_segments(self):
+        for segments in self._segments.values():
+            yield from segments
+
+    @property
+    def size(self):
+        return sum(x.size for x in self._all_segments())
+
+    @property
+    def depth(self):
+        return sum(x.lines for x in self._all_segments())
+
+    @property
+    def depth_bytes(self):
+        return sum(x.pending_bytes for x in self._all_segments())
+
+    def __bool__(self):
+        return any(x.records for x in self._all_segments())
+
+    def _new_segment(self, domain, size):
+        if self.size + size > self._max_bytes:
+            return None
+        directory = self._domain_directory(domain)
+        os.makedirs(directory, exist_ok=True)
+        sequence = self._next_sequence.get(domain, 0)
+        self._next_sequence[domain] = sequence + 1
+        segment = _Segment(os.path.join(directory, f'{sequence:020d}.seg'),
+                           size)
+        self._segments.setdefault(domain, []).append(segment)
+        return segment
+
+    def append(self, domain, lines, payload):
+        """
+        Append a payload of ``lines`` lines of line protocol for the given
+        domain. Returns False if the spool is full.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        segments = self._segments.get(domain)
+        if segments and segments[-1].append(lines, payload):
+            return True
+        segment = self._new_segment(
+            domain, max(self._segment_bytes, _header.size * 2 + len(payload)))
+        if segment is None:
+            return False
+        return segment.append(lines, payload)
+
+    def peek(self, max_lines):
+        """
+        Return the oldest spooled records of a domain, as a tuple of
+        ``(domain, records, lines, payload)``, or None if the spool is
+        empty. Consecutive records are combined into a single payload until
+        ``max_lines`` is reached. The records remain in the spool until
+        ack() is called.
+        """
+        for domain, segments in self._segments.items():
+            records, lines, payloads = 0, 0, []
+            for segment in segments:
+                offset = segment.read_offset
+                while offset < segment.write_offset:
+                    record_lines, payload = segment.read(offset)
+                    if payloads and lines + record_lines > max_lines:
+                        return domain, records, lines, b'\n'.join(payloads)
+                    records += 1
+                    lines += record_lines
+                    payloads.append(payload)
+                    offset += _header.size + len(payload)
+            if payloads:
+                return domain, records, lines, b'\n'.join(payloads)
+        return None
+
+    def ack(self, domain, records):
+        """
+        Remove the given number of records, as last returned by peek(),
+        for the domain. Fully drained segments, other than the one
+        currently being appended to, are deleted.
+        """
+        segments = self._segments[domain]
+        for segment in segments:
+            while records and not segment.drained:
+                segment.advance()
+                records -= 1
+        while len(segments) > 1 and segments[0].drained:
+            segments.pop(0).remove()
+
+    def detach_dirty(self):
+        """
+        Return duplicates of the file descriptors of the segments appended
+        to since the last call, to be passed to sync_files(). Duplicates
+        remain valid if the segments are closed or removed meanwhile.
+        """
+        rv = []
+        for segment in self._all_segments():
+            if segment.dirty:
+                rv.append(os.dup(segment.fileno()))
+                segment.dirty = False
+        return rv
+
+    def stats(self):
+        return {'depth': self.depth,
+                'depth_bytes': self.depth_bytes,
+                'size': self.size,
+                'segments': sum(len(x) for x in self._segments.values())}
+
+    def close(self):
+        sync_files(self.detach_dirty())
+        for domain, segments in self._segments.items():
+            # Segments with nothing left to drain are not needed across
+            # restarts.
+            for segment in segments:
+                if segment.drained:
+                    segment.remove()
+                else:
+                    segment.close()
+        self._segments = {}
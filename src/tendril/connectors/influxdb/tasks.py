@@ -0,0 +1,302 @@
+
+
+import asyncio
+import time
+from datetime import datetime
+from datetime import timezone
+from influxdb_client import TaskCreateRequest
+from influxdb_client import TaskUpdateRequest
+from influxdb_client.service.tasks_service import TasksService
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+from tendril.config import INFLUXDB_ORG
+from tendril.config import INFLUXDB_ORG_TOKEN
+from tendril.config import INFLUXDB_ROLLUP_TASK_OFFSET
+from tendril.config import INFLUXDB_ROLLUP_TASK_LOOKBACK
+from tendril.config import INFLUXDB_ROLLUP_BACKFILL_CHUNK
+from tendril.config import INFLUXDB_ROLLUP_BACKFILL_CONCURRENCY
+from tendril.core.tsdb.constants import TimeSeriesExporter
+
+from .aio import _influxdb_url
+from .query.builder import InfluxDBFluxQueryBuilder
+from .query.builder import _buckets
+from .query.builder import _band_statistics
+from .query.rollups import _rollups
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+# Downsampling tasks which feed the rollup buckets. There is one task per
+# rollup bucket, named after it, which periodically aggregates the most
+# recent windows of the domain's source bucket with the rollup function and
+# writes the result to the rollup bucket. The same Flux, with an explicit
+# range, is used to backfill rollups over historical data.
+#
+# Tasks are recognized by their name prefix. Tasks with the prefix which do
+# not correspond to any configured rollup are considered stale.
+#
+# Rewriting a window which has already been written replaces its points, so
+# overlapping task runs and backfills are harmless.
+#
+# Each window is aggregated with the aggregator the query builders render
+# for the corresponding AGGREGATE exporter, and its points are timestamped
+# at the start of the window. Min and max rollups take the statistic from
+# the band aggregator.
+
+_task_prefix = 'tendril-rollup-'
+
+# Columns the band aggregator leaves besides the group key.
+_band_reduce_columns = ('count', 'sum') + _band_statistics
+
+# Rollup function -> exporter whose aggregator it is rendered with
+_rollup_exporters = {
+    'mean': TimeSeriesExporter.AGGREGATE_MEAN,
+    'sum': TimeSeriesExporter.AGGREGATE_SUM,
+    'count': TimeSeriesExporter.AGGREGATE_COUNT,
+    'min': TimeSeriesExporter.AGGREGATE_BAND,
+    'max': TimeSeriesExporter.AGGREGATE_BAND,
+}
+
+
+def rollup_task_name(rollup):
+    return f'{_task_prefix}{rollup.bucket}'
+
+
+def _render_rollup_pipeline(rollup, start, stop, org):
+    if rollup.fn not in _rollup_exporters:
+        raise ValueError(f"Unsupported rollup function {rollup.fn} for "
+                         f"{rollup.bucket}. Use one of "
+                         f"{tuple(_rollup_exporters.keys())}.")
+    exporter = _rollup_exporters[rollup.fn]
+    rv = f'from(bucket: "{_buckets[rollup.domain]}")\n'
+    rv += f' |> range(start: {start}, stop: {stop})\n'
+    if rollup.fn != 'count':
+        rv += ' |> filter(fn: (r) => types.isNumeric(v: r._value))\n'
+    rv += f' |> window(every: {rollup.resolution}s, createEmpty: false)\n'
+    rv += InfluxDBFluxQueryBuilder._render_aggregator(exporter)
+    if exporter == TimeSeriesExporter.AGGREGATE_BAND:
+        columns = ", ".join(f'"{x}"' for x in _band_reduce_columns)
+        rv += f' |> map(fn: (r) => ({{r with _value: r.{rollup.fn}}}))\n'
+        rv += f' |> drop(columns: [{columns}])\n'
+    rv += ' |> duplicate(column: "_start", as: "_time")\n'
+    rv += ' |> window(every: inf)\n'
+    rv += f' |> to(bucket: "{rollup.bucket}", org: "{org}")\n'
+    return rv
+
+
+def render_rollup_flux(rollup, start, stop, org=INFLUXDB_ORG):
+    """
+    Render the Flux which downsamples the rollup's source data between the
+    given start and stop Flux expressions into the rollup bucket. Windows
+    are aligned to the epoch, so start and stop should be multiples of the
+    rollup resolution.
+    """
+    return 'import "types"\n\n' + \
+        _render_rollup_pipeline(rollup, start, stop, org)
+
+
+def render_rollup_task(rollup, offset=INFLUXDB_ROLLUP_TASK_OFFSET,
+                       lookback=INFLUXDB_ROLLUP_TASK_LOOKBACK,
+                       org=INFLUXDB_ORG):
+    """
+    Render the Flux of the task which maintains the rollup. Each run
+    recomputes the last ``lookback`` windows before its scheduled time, so
+    that points arriving up to ``offset`` seconds late in the previous
+    windows are picked up.
+    """
+    rv = 'import "types"\n\n'
+    rv += f'option task = {{name: "{rollup_task_name(rollup)}", ' \
+          f'every: {rollup.resolution}s, offset: {offset}s}}\n\n'
+    start = f'-{lookback * rollup.resolution}s'
+    rv += _render_rollup_pipeline(rollup, start=start, stop='now()', org=org)
+    return rv
+
+
+class RollupTaskManager(object):
+    """
+    Generates, installs and verifies the downsampling tasks for the rollup
+    buckets configured for each domain (see INFLUXDB_<DOMAIN>_ROLLUPS), and
+    backfills rollups over historical data.
+
+    Tasks are managed with the organization token, which needs to be able
+    to manage tasks, read the source buckets and write the rollup buckets.
+
+    Use as an async context manager, or call close() when done.
+    """
+    def __init__(self, domains=None, url=_influxdb_url,
+                 token=INFLUXDB_ORG_TOKEN, org=INFLUXDB_ORG,
+                 offset=INFLUXDB_ROLLUP_TASK_OFFSET,
+                 lookback=INFLUXDB_ROLLUP_TASK_LOOKBACK):
+        self._domains = domains or list(_rollups.keys())
+        self._org = org
+        self._offset = offset
+        self._lookback = lookback
+        self._client = InfluxDBClientAsync(url=url, token=token, org=org)
+        self._service = TasksService(self._client.api_client)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        await self._client.close()
+
+    def rollups(self):
+        for domain in self._domains:
+            yield from _rollups.get(domain, [])
+
+    def generate(self):
+        """
+        Return the desired tasks, as a dict of task name to task Flux.
+        """
+        return {rollup_task_name(x): render_rollup_task(
+                    x, offset=self._offset, lookback=self._lookback,
+                    org=self._org)
+                for x in self.rollups()}
+
+    async def installed(self):
+        """
+        Return the installed rollup tasks, as a dict of task name to Task.
+        """
+        rv = {}
+        after = None
+        while True:
+            kwargs = {'org': self._org, 'limit': 500}
+            if after:
+                kwargs['after'] = after
+            tasks = (await self._service.get_tasks_async(**kwargs)).tasks or []
+            for task in tasks:
+                if task.name and task.name.startswith(_task_prefix):
+                    rv[task.name] = task
+            if len(tasks) < 500:
+                return rv
+            after = tasks[-1].id
+
+    @staticmethod
+    def _diff(desired, installed):
+        rv = {'create': [], 'update': [], 'delete': [], 'unchanged': []}
+        for name, flux in desired.items():
+            task = installed.get(name)
+            if task is None:
+                rv['create'].append(name)
+            elif task.flux.strip() != flux.strip() or task.status != 'active':
+                rv['update'].append(name)
+            else:
+                rv['unchanged'].append(name)
+        rv['delete'] = [x for x in installed.keys() if x not in desired]
+        return rv
+
+    async def diff(self):
+        """
+        Compare the installed tasks with the desired tasks. Returns a dict
+        with lists of task names to 'create', 'update' and 'delete', and
+        those which are 'unchanged'. Inactive tasks are updated.
+        """
+        return self._diff(self.generate(), await self.installed())
+
+    async def install(self, prune=False):
+        """
+        Create or update the tasks so that they match the configured
+        rollups. Stale tasks are deleted if ``prune`` is True. Returns the
+        diff which was applied.
+        """
+        desired = self.generate()
+        installed = await self.installed()
+        diff = self._diff(desired, installed)
+        for name in diff['create']:
+            logger.info(f"Creating rollup task {name}")
+            await self._service.post_tasks_async(TaskCreateRequest(
+                org=self._org, flux=desired[name], status='active',
+                description='Tendril rollup downsampling task'))
+        for name in diff['update']:
+            logger.info(f"Updating rollup task {name}")
+            await self._service.patch_tasks_id_async(
+                installed[name].id,
+                TaskUpdateRequest(flux=desired[name], status='active'))
+        if prune:
+            for name in diff['delete']:
+                logger.info(f"Deleting stale rollup task {name}")
+                await self._service.delete_tasks_id_async(installed[name].id)
+        else:
+            diff['delete'] = []
+        return diff
+
+    async def verify(self):
+        """
+        Check the installed tasks. Returns a dict of task name to a list of
+        problems, which is empty for tasks which are installed as
+        configured, active, and whose last run succeeded.
+        """
+        desired = self.generate()
+        installed = await self.installed()
+        rv = {}
+        for name, flux in desired.items():
+            problems = []
+            task = installed.get(name)
+            if task is None:
+                rv[name] = ['missing']
+                continue
+            if task.flux.strip() != flux.strip():
+                problems.append('outdated')
+            if task.status != 'active':
+                problems.append(task.status)
+            if task.last_run_status and task.last_run_status != 'success':
+                problem = f'last run {task.last_run_status}'
+                if task.last_run_error:
+                    problem += f': {task.last_run_error}'
+                problems.append(problem)
+            rv[name] = problems
+        return rv
+
+    async def backfill(self, rollup, start, end=None,
+                       chunk=INFLUXDB_ROLLUP_BACKFILL_CHUNK,
+                       concurrency=INFLUXDB_ROLLUP_BACKFILL_CONCURRENCY):
+        """
+        Downsample source data between start and end (datetimes, or unix
+        timestamps) into the rollup bucket. The range is widened to whole
+        windows and split into chunks of about ``chunk`` seconds, of which
+        up to ``concurrency`` are run at a time. If end is not given, the
+        backfill runs up to the last complete window.
+
+        Returns a list of the (start, stop) unix timestamps of the chunks
+        which failed, so that they can be retried.
+        """
+        if isinstance(start, datetime):
+            start = start.timestamp()
+        if end is None:
+            end = time.time()
+        elif isinstance(end, datetime):
+            end = end.timestamp()
+        resolution = rollup.resolution
+        start = int(start) - int(start) % resolution
+        end = int(end) - int(end) % resolution
+        chunk = max(resolution, int(chunk) - int(chunk) % resolution)
+
+        limit = asyncio.Semaphore(concurrency)
+        query_api = self._client.query_api()
+
+        async def _run(chunk_start, chunk_stop):
+            async with limit:
+                since = datetime.fromtimestamp(chunk_start, tz=timezone.utc)
+                until = datetime.fromtimestamp(chunk_stop, tz=timezone.utc)
+                logger.debug(f"Backfilling {rollup.bucket} from {since} "
+                             f"to {until}")
+                await query_api.query_raw(render_rollup_flux(
+                    rollup, chunk_start, chunk_stop, org=self._org))
+
+        chunks = [(x, min(x + chunk, end)) for x in range(start, end, chunk)]
+        results = await asyncio.gather(*[_run(*x) for x in chunks],
+                                       return_exceptions=True)
+        failed = []
+        for span, result in zip(chunks, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"Backfill of {rollup.bucket} for {span} "
+                               f"failed : {result}")
+                failed.append(span)
+        done = len(chunks) - len(failed)
+        logger.info(f"Backfilled {rollup.bucket} in {done} "
+                    f"of {len(chunks)} chunks")
+        return failed
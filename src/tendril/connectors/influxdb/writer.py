@@ -0,0 +1,430 @@
+
+
+import random
+import asyncio
+from aiohttp import ClientError
+from influxdb_client.rest import ApiException
+from influxdb_client.client.influxdb_client_async import InfluxDBClientAsync
+
+from tendril import config
+from tendril.config import INFLUXDB_ORG
+from tendril.config import INFLUXDB_DEFAULT_BUCKET
+from tendril.config import INFLUXDB_DEFAULT_BUCKET_TOKEN
+from tendril.config import INFLUXDB_WRITER_BATCH_SIZE
+from tendril.config import INFLUXDB_WRITER_FLUSH_INTERVAL
+from tendril.config import INFLUXDB_WRITER_MAX_PENDING
+from tendril.config import INFLUXDB_WRITER_MAX_RETRIES
+from tendril.config import INFLUXDB_WRITER_RETRY_INTERVAL
+from tendril.config import INFLUXDB_WRITER_MAX_RETRY_DELAY
+from tendril.config import INFLUXDB_WRITER_GZIP
+from tendril.config import INFLUXDB_WRITER_SPOOL_DIRECTORY
+from tendril.config import INFLUXDB_WRITER_SPOOL_MAX_BYTES
+from tendril.config import INFLUXDB_WRITER_SPOOL_SEGMENT_BYTES
+from tendril.config import INFLUXDB_WRITER_SPOOL_DRAIN_RATE
+
+from .aio import _influxdb_url
+from .aio import _connection_parameters
+from .lineprotocol import encode_point
+from .lineprotocol import LineProtocolEncoder
+from .spool import WriteSpool
+from .spool import sync_files
+
+from tendril.utils import log
+logger = log.get_logger(__name__)
+
+
+def _get_bucket(domain):
+    if domain is None:
+        return INFLUXDB_DEFAULT_BUCKET
+    return getattr(config, f'INFLUXDB_{domain.upper()}_BUCKET')
+
+
+def _get_connection_parameters(domain):
+    if domain is None:
+        return {'url': _influxdb_url,
+                'token': INFLUXDB_DEFAULT_BUCKET_TOKEN,
+                'org': INFLUXDB_ORG}
+    return _connection_parameters[domain]
+
+
+class WriteFailedError(Exception):
+    pass
+
+
+class InfluxDBAsyncWriter(object):
+    """
+    Batching asyncio writer for InfluxDB.
+
+    Points are encoded to line protocol as they are written, and buffered per
+    domain (bucket, as listed in INFLUXDB_BUCKETS, or the default bucket for
+    a domain of None). Buffers are flushed when they reach batch_size, or
+    flush_interval seconds after their oldest line was buffered, whichever
+    comes first. Each domain is flushed by its own task, so that a domain
+    whose writes are failing does not hold up the others.
+
+    At most max_pending lines are held in memory. Once this is reached,
+    write() waits until enough pending lines have been flushed. Failed
+    writes are retried with jittered exponential backoff, and dropped if
+    they still fail after max_retries, or are rejected outright by the
+    server.
+
+    If a spool_directory is provided, lines are instead spooled to disk
+    when max_pending is reached, and batches which still fail after
+    max_retries with transient errors are spooled rather than dropped.
+    Lines overflowing max_pending are collected into batch_size records
+    before they are spooled, and the spool is synced to disk in an
+    executor. Spooled lines are drained in the background at up to
+    drain_rate lines per second, or without a limit if it is 0, once the
+    server accepts writes again. See WriteSpool.
+
+    Use as an async context manager, or call start() and close().
+    """
+    def __init__(self, batch_size=INFLUXDB_WRITER_BATCH_SIZE,
+                 flush_interval=INFLUXDB_WRITER_FLUSH_INTERVAL,
+                 max_pending=INFLUXDB_WRITER_MAX_PENDING,
+                 max_retries=INFLUXDB_WRITER_MAX_RETRIES,
+                 retry_interval=INFLUXDB_WRITER_RETRY_INTERVAL,
+                 max_retry_delay=INFLUXDB_WRITER_MAX_RETRY_DELAY,
+                 gzip=INFLUXDB_WRITER_GZIP,
+                 spool_directory=INFLUXDB_WRITER_SPOOL_DIRECTORY,
+                 spool_max_bytes=INFLUXDB_WRITER_SPOOL_MAX_BYTES,
+                 spool_segment_bytes=INFLUXDB_WRITER_SPOOL_SEGMENT_BYTES,
+                 drain_rate=INFLUXDB_WRITER_SPOOL_DRAIN_RATE):
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._max_retries = max_retries
+        self._retry_interval = retry_interval
+        self._max_retry_delay = max_retry_delay
+        self._gzip = gzip
+        self._spool_directory = spool_directory
+        self._spool_max_bytes = spool_max_bytes
+        self._spool_segment_bytes = spool_segment_bytes
+        self._drain_rate = drain_rate
+
+        self._clients = {}
+        self._buffers = {}
+        # Lines over max_pending, waiting to be spooled.
+        self._overflow = {}
+        # Loop time by which each domain with buffered or overflowing lines
+        # is to be flushed.
+        self._deadlines = {}
+        self._flush_tasks = {}
+        self._pending = 0
+        self._space = None
+        self._flush_needed = None
+        self._flusher = None
+        self._closing = False
+        self._spool = None
+        self._spooled = None
+        self._drainer = None
+        self._syncer = None
+
+        self.written = 0
+        self.dropped = 0
+        self.spooled = 0
+
+    async def start(self):
+        self._space = asyncio.Condition()
+        self._flush_needed = asyncio.Event()
+        self._closing = False
+        self._flusher = asyncio.create_task(self._flush_loop())
+        if self._spool_directory:
+            self._spool = WriteSpool(self._spool_directory,
+                                     self._spool_max_bytes,
+                                     self._spool_segment_bytes)
+            self._spooled = asyncio.Event()
+            self._drainer = asyncio.create_task(self._drain_loop())
+        return self
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def _client(self, domain):
+        if domain not in self._clients:
+            self._clients[domain] = InfluxDBClientAsync(
+                **_get_connection_parameters(domain), enable_gzip=self._gzip)
+        return self._clients[domain]
+
+    async def write(self, measurement, fields, tags=None, ts=None,
+                    domain=None):
+        line = encode_point(measurement, fields, tags, ts)
+        if line is None:
+            return
+        await self.write_lines([line], domain=domain)
+
+    async def write_frame(self, measurement, data, fields, tags=None,
+                          tag_columns=None, time_column='_time', domain=None):
+        # Bulk writes of columnar data. These bypass the buffers, and are
+        # sent in batch_size chunks as they are encoded. The call returns
+        # once all chunks have been written or dropped.
+        encoder = LineProtocolEncoder(measurement, fields, tags=tags,
+                                      tag_columns=tag_columns,
+                                      time_column=time_column,
+                                      chunk_rows=self._batch_size)
+        for lines, payload in encoder.chunks(data):
+            await self._write_payload(domain, lines, payload)
+
+    async def write_lines(self, lines, domain=None):
+        # Lines must already be encoded line protocol, with nanosecond
+        # precision timestamps.
+        if self._flusher is None:
+            raise RuntimeError("The writer has not been started.")
+        async with self._space:
+            overflow = self._spool is not None and self._pending and \
+                self._pending + len(lines) > self._max_pending
+            if not overflow:
+                await self._space.wait_for(
+                    lambda: (self._pending + len(lines) <= self._max_pending
+                             or not self._pending))
+                self._pending += len(lines)
+        self._set_deadline(domain)
+        if overflow:
+            self._add_overflow(domain, lines)
+            return
+        buffer = self._buffers.setdefault(domain, [])
+        buffer.extend(lines)
+        if len(buffer) >= self._batch_size:
+            self._flush_needed.set()
+
+    def _set_deadline(self, domain):
+        if domain not in self._deadlines:
+            self._deadlines[domain] = \
+                asyncio.get_running_loop().time() + self._flush_interval
+
+    def _settle(self, domain):
+        if not self._buffers.get(domain) and not self._overflow.get(domain):
+            self._deadlines.pop(domain, None)
+
+    def _add_overflow(self, domain, lines):
+        overflow = self._overflow.setdefault(domain, [])
+        overflow.extend(lines)
+        while len(overflow) >= self._batch_size:
+            batch = overflow[:self._batch_size]
+            del overflow[:self._batch_size]
+            self._spill(domain, len(batch), '\n'.join(batch))
+        self._settle(domain)
+
+    def _spill_overflow(self, due_only):
+        now = asyncio.get_running_loop().time()
+        for domain in list(self._overflow.keys()):
+            if due_only and now < self._deadlines.get(domain, now):
+                continue
+            lines = self._overflow.pop(domain)
+            if lines:
+                self._spill(domain, len(lines), '\n'.join(lines))
+            self._settle(domain)
+
+    def _flushing(self, domain):
+        task = self._flush_tasks.get(domain)
+        return task is not None and not task.done()
+
+    async def _flush_loop(self):
+        # Waits until the earliest deadline of the buffers not already
+        # being flushed, or until a buffer fills up or a flush completes.
+        loop = asyncio.get_running_loop()
+        while not self._closing:
+            deadlines = [x for domain, x in self._deadlines.items()
+                         if not self._flushing(domain) or
+                         self._overflow.get(domain)]
+            timeout = self._flush_interval
+            if deadlines:
+                timeout = max(0, min(deadlines) - loop.time())
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(),
+                                       timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            self._spill_overflow(due_only=True)
+            for domain in list(self._buffers.keys()):
+                self._start_flush(domain, full_only=True)
+
+    def _ready(self, domain, full_only):
+        buffer = self._buffers.get(domain)
+        if not buffer:
+            return False
+        if not full_only or len(buffer) >= self._batch_size:
+            return True
+        deadline = self._deadlines.get(domain)
+        return deadline is not None and \
+            asyncio.get_running_loop().time() >= deadline
+
+    def _start_flush(self, domain, full_only):
+        if self._flushing(domain) or not self._ready(domain, full_only):
+            return
+        self._flush_tasks[domain] = asyncio.create_task(
+            self._flush_domain(domain, full_only))
+
+    async def _flush_domain(self, domain, full_only):
+        try:
+            while self._ready(domain, full_only):
+                buffer = self._buffers[domain]
+                batch = buffer[:self._batch_size]
+                del buffer[:self._batch_size]
+                self._settle(domain)
+                try:
+                    await self._write_payload(domain, len(batch),
+                                              '\n'.join(batch))
+                finally:
+                    async with self._space:
+                        self._pending -= len(batch)
+                        self._space.notify_all()
+        finally:
+            # Buffers skipped while this flush was running are due now.
+            if self._flush_needed is not None:
+                self._flush_needed.set()
+
+    async def flush(self, full_only=False):
+        # Flush the buffers of all domains concurrently, and wait for
+        # them. Flushes already running are waited for as well.
+        if not full_only:
+            self._spill_overflow(due_only=False)
+        while True:
+            for domain in list(self._buffers.keys()):
+                self._start_flush(domain, full_only)
+            tasks = [x for x in self._flush_tasks.values() if not x.done()]
+            if not tasks:
+                break
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._flush_tasks = {}
+
+    async def _write_payload(self, domain, lines, payload):
+        try:
+            await self._write_batch(domain, payload)
+            self.written += lines
+        except Exception as e:
+            if self._spool is not None and self._retryable(e.__cause__):
+                self._spill(domain, lines, payload)
+                return
+            self.dropped += lines
+            logger.error(f"Dropping {lines} points for "
+                         f"{_get_bucket(domain)} : {e!r}")
+
+    def _spill(self, domain, lines, payload):
+        if self._spool.append(domain, lines, payload):
+            self.spooled += lines
+            self._spooled.set()
+            if self._syncer is None or self._syncer.done():
+                self._syncer = asyncio.create_task(self._sync_spool())
+            return
+        self.dropped += lines
+        logger.error(f"Dropping {lines} points for {_get_bucket(domain)} : "
+                     f"The write spool is full")
+
+    async def _sync_spool(self):
+        # Segments appended to while a sync is running are synced by the
+        # next pass.
+        loop = asyncio.get_running_loop()
+        while self._spool is not None:
+            fds = self._spool.detach_dirty()
+            if not fds:
+                return
+            await loop.run_in_executor(None, sync_files, fds)
+
+    async def _drain_loop(self):
+        attempt = 0
+        while not self._closing:
+            record = self._spool.peek(self._batch_size)
+            if record is None:
+                self._spooled.clear()
+                try:
+                    await asyncio.wait_for(self._spooled.wait(),
+                                           timeout=self._flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            domain, records, lines, payload = record
+            try:
+                await self._send(domain, payload)
+            except Exception as e:
+                if self._retryable(e):
+                    attempt += 1
+                    await asyncio.sleep(self._retry_delay(attempt, e))
+                    continue
+                self.dropped += lines
+                logger.error(f"Dropping {lines} spooled points for "
+                             f"{_get_bucket(domain)} : {e!r}")
+            else:
+                self.written += lines
+            attempt = 0
+            self._spool.ack(domain, records)
+            if self._drain_rate:
+                await asyncio.sleep(lines / self._drain_rate)
+
+    def _retry_delay(self, attempt, error):
+        retry_after = None
+        if isinstance(error, ApiException) and error.headers:
+            retry_after = error.headers.get('Retry-After', None)
+        if retry_after:
+            try:
+                return min(float(retry_after), self._max_retry_delay)
+            except ValueError:
+                pass
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self._max_retry_delay,
+                                     self._retry_interval * 2 ** attempt))
+
+    @staticmethod
+    def _retryable(error):
+        if isinstance(error, ApiException):
+            return error.status in (408, 429) or (error.status or 0) >= 500
+        return isinstance(error, (ClientError, asyncio.TimeoutError, OSError))
+
+    async def _send(self, domain, payload):
+        await self._client(domain).write_api().write(
+            bucket=_get_bucket(domain), record=payload)
+
+    async def _write_batch(self, domain, payload):
+        attempt = 0
+        while True:
+            try:
+                await self._send(domain, payload)
+                return
+            except Exception as e:
+                if not self._retryable(e) or attempt >= self._max_retries:
+                    raise WriteFailedError(f"Write failed after "
+                                           f"{attempt + 1} attempts") from e
+                delay = self._retry_delay(attempt, e)
+                logger.warning(f"Write to {_get_bucket(domain)} failed, "
+                               f"retrying in {delay:.2f}s : {e!r}")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self._flusher is None:
+            return
+        self._closing = True
+        self._flush_needed.set()
+        await self._flusher
+        self._flusher = None
+        await self.flush()
+        if self._drainer is not None:
+            # Anything not yet drained stays in the spool for the next run.
+            self._drainer.cancel()
+            try:
+                await self._drainer
+            except asyncio.CancelledError:
+                pass
+            self._drainer = None
+            if self._syncer is not None:
+                await self._syncer
+                self._syncer = None
+            self._spool.close()
+            self._spool = None
+        for client in self._clients.values():
+            await client.close()
+        self._clients = {}
+
+    def stats(self):
+        rv = {'written': self.written, 'dropped': self.dropped,
+              'spooled': self.spooled, 'pending': self._pending}
+        if self._spool is not None:
+            rv['spool'] = self._spool.stats()
+        return rv
+
+
+TSDBAsyncWriter = InfluxDBAsyncWriter
@@ -1,6 +1,15 @@
 
 
 from tendril.connectors.influxdb.aio import influxdb_execute_query_plan
+from tendril.connectors.influxdb.aio import influxdb_stream_query
+from tendril.connectors.influxdb.aio import influxdb_close_clients
+from tendril.connectors.influxdb.writer import TSDBAsyncWriter
 
 
 tsdb_execute_query_plan = influxdb_execute_query_plan
+tsdb_stream_query = influxdb_stream_query
+tsdb_close_connections = influxdb_close_clients
+
+
+__all__ = ['tsdb_execute_query_plan', 'tsdb_stream_query',
+           'tsdb_close_connections', 'TSDBAsyncWriter']
@@ -22,3 +22,4 @@ class TimeSeriesExporter(Enum):
     AGGREGATE_SUM = "AGGREGATE_SUM"
     AGGREGATE_COUNT = "AGGREGATE_COUNT"
     AGGREGATE_BAND = "AGGREGATE_BAND"
+    DECIMATED = "DECIMATED"
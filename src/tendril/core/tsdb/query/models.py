@@ -1,25 +1,44 @@
 
 
-
 from math import ceil
 from typing import Dict
 from typing import List
+from typing import Tuple
 from pydantic import root_validator
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
 from tendril.utils.pydantic import TendrilTBaseModel
 from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.constants import TimeSeriesFundamentalType
 from tendril.utils import log
 logger = log.get_logger(__name__, log.DEFAULT)
 
 
+# Window widths which aligned time spans are snapped to. Widths larger than
+# the last of these are rounded up to a whole number of days.
+_nice_window_widths = [timedelta(seconds=x) for x in (
+    1, 2, 5, 10, 15, 30,
+    60, 2 * 60, 5 * 60, 10 * 60, 15 * 60, 30 * 60,
+    3600, 2 * 3600, 3 * 3600, 6 * 3600, 12 * 3600,
+    86400, 2 * 86400, 7 * 86400
+)]
+
+
 class QueryTimeSpanTModel(TendrilTBaseModel):
     start: datetime = None
     end: datetime = None
     width: timedelta = None
     window_count: int = 240
     window_width: timedelta = None
+    # If align is set, the window width is snapped up to a nice width and
+    # the start and end are snapped outward to multiples of it, so that
+    # consecutive queries share window boundaries.
+    align: bool = False
+    # Set by alignment when the end had to be moved forward. Data in the
+    # last window is then only complete up to this (the requested) end, and
+    # the query caches treat that window as live.
+    partial_window_end: datetime = None
 
     @classmethod
     def _die(cls):
@@ -133,6 +152,38 @@ class QueryTimeSpanTModel(TendrilTBaseModel):
                 cls._die()
 
         values = cls._fill_remainder(values)
+        if values.get('align', False):
+            values = cls._align(values)
+        return values
+
+    @classmethod
+    def _snap(cls, value, width, up=False):
+        seconds = width.total_seconds()
+        ts = value.timestamp()
+        snapped = (ts // seconds) * seconds
+        if up and snapped < ts:
+            snapped += seconds
+        return datetime.fromtimestamp(snapped, tz=value.tzinfo)
+
+    @classmethod
+    def _align(cls, values):
+        window_width = values['window_width']
+        for width in _nice_window_widths:
+            if width >= window_width:
+                break
+        else:
+            width = timedelta(days=ceil(window_width / timedelta(days=1)))
+
+        start = cls._snap(values['start'], width)
+        end = cls._snap(values['end'], width, up=True)
+        if end != values['end']:
+            values['partial_window_end'] = values['end']
+
+        values['start'] = start
+        values['end'] = end
+        values['width'] = end - start
+        values['window_width'] = width
+        values['window_count'] = int(round((end - start) / width))
         return values
 
 
@@ -145,3 +196,15 @@ class TimeSeriesQueryItemTModel(TendrilTBaseModel):
     fields: List[str]
     exporter: TimeSeriesExporter
     include_ends: bool = True
+    # The type of the values, if known. Some exporters can do more of their
+    # work in the database when this is declared.
+    value_type: TimeSeriesFundamentalType = None
+    # Range of steps between consecutive values which are not treated as
+    # discontinuities by DISCONTINUITIES_ONLY. Defaults to the exporter's.
+    step_size: Tuple[float, float] = None
+    # Quantiles (between 0 and 1) to be included with the min, mean and max
+    # of each window by WINDOWED_BAND. Each needs an additional pass.
+    quantiles: List[float] = None
+    # Maximum number of points returned by DECIMATED. Defaults to the
+    # window count of the time span.
+    max_points: int = None
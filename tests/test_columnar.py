@@ -0,0 +1,80 @@
+
+
+import asyncio
+import pytest
+from datetime import datetime
+from datetime import timezone
+
+from tendril.connectors.influxdb.query.columnar import FluxResponseError
+from tendril.connectors.influxdb.query.columnar import parse_annotated_csv
+from tendril.connectors.influxdb.query.columnar import iter_annotated_csv
+
+
+def _block(result, rows):
+    lines = ['#datatype,string,long,dateTime:RFC3339,double,string',
+             '#group,false,false,false,false,true',
+             f'#default,{result},,,,',
+             ',result,table,_time,_value,device']
+    lines += [f',,{table},2024-01-01T00:00:{second:02d}Z,{value},{device}'
+              for table, second, value, device in rows]
+    return '\r\n'.join(lines) + '\r\n'
+
+
+_response = '\r\n'.join([
+    _block('a', [(0, 0, 1.5, 'x'), (0, 10, 2.5, 'x')]),
+    _block('b', [(0, 0, 3.0, 'y')]),
+    _block('a', [(1, 20, 4.5, 'z')]),
+]) + '\r\n'
+
+_error = '\r\n'.join([
+    '#datatype,string,string',
+    '#group,true,true',
+    '#default,,',
+    ',error,reference',
+    ',failed to compile query,897',
+]) + '\r\n\r\n'
+
+
+def test_parse_annotated_csv_results():
+    rv = parse_annotated_csv(_response)
+    assert sorted(rv.keys()) == ['a', 'b']
+    assert rv['a'].columns == ['_time', '_value', 'device']
+    assert rv['a']['_value'].to_list() == [1.5, 2.5, 4.5]
+    assert rv['a']['device'].to_list() == ['x', 'x', 'z']
+    assert rv['a']['_time'][2] == datetime(2024, 1, 1, 0, 0, 20,
+                                           tzinfo=timezone.utc)
+    assert rv['b']['_value'].to_list() == [3.0]
+
+
+def test_parse_annotated_csv_empty():
+    assert parse_annotated_csv(b'\r\n') == {}
+
+
+def test_parse_annotated_csv_error():
+    with pytest.raises(FluxResponseError, match='failed to compile query'):
+        parse_annotated_csv(_error)
+
+
+async def _lines(response):
+    for line in response.encode().splitlines(keepends=True):
+        yield line
+
+
+async def _collect(response, batch_rows):
+    return [(result, df['_value'].to_list()) async for result, df
+            in iter_annotated_csv(_lines(response), batch_rows)]
+
+
+def test_iter_annotated_csv_batches():
+    rv = asyncio.run(_collect(_response, 1))
+    assert rv == [('a', [1.5]), ('a', [2.5]), ('b', [3.0]), ('a', [4.5])]
+
+
+def test_iter_annotated_csv_does_not_span_blocks():
+    rv = asyncio.run(_collect(_response, 10))
+    assert rv == [('a', [1.5, 2.5]), ('b', [3.0]), ('a', [4.5])]
+
+
+def test_iter_annotated_csv_error():
+    with pytest.raises(FluxResponseError, match='failed to compile query'):
+        asyncio.run(_collect(_error, 10))
@@ -0,0 +1,79 @@
+
+
+import pytest
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import QueryTimeSpanTModel
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+from tendril.connectors.influxdb.query import cost
+from tendril.connectors.influxdb.query.planner import InfluxDBQueryPlanner
+
+
+pytestmark = pytest.mark.skipif(not INFLUXDB_BUCKETS,
+                                reason="No InfluxDB buckets configured")
+
+
+@pytest.fixture
+def domain(monkeypatch):
+    domain = INFLUXDB_BUCKETS[0]
+    limits = cost.QueryLimits(max_points=1000, action='downgrade')
+    monkeypatch.setitem(cost._limits, domain, limits)
+    cost.sample_rates().set(domain, 'channel0', 10.0, 10.0)
+    yield domain
+    cost.sample_rates().clear()
+
+
+def _item(domain, export_name):
+    end = datetime(2024, 1, 2, tzinfo=timezone.utc)
+    time_span = QueryTimeSpanTModel(end=end, width=timedelta(days=1),
+                                    window_count=240)
+    return TimeSeriesQueryItemTModel(domain=domain, export_name=export_name,
+                                     measurement='channel0',
+                                     tags={'device': export_name},
+                                     fields=['value'],
+                                     exporter=TimeSeriesExporter.RAW,
+                                     time_span=time_span)
+
+
+def test_downgraded_items_keep_their_export_names(domain):
+    planner = InfluxDBQueryPlanner(segment_cache=False, shards=1)
+    planner.add_item(_item(domain, 'a'))
+    planner.add_item(_item(domain, 'b'))
+
+    queries = dict(planner.generate_queries(domain))
+    assert sorted(queries.keys()) == ['a__downgraded', 'b__downgraded']
+
+    results = {}
+    for name, builder in queries.items():
+        assert builder.response_columns == ['_time', name]
+        results[name] = {'strategy': builder.strategy,
+                         'columns': builder.response_columns,
+                         'data': [(name, 1.0)]}
+    planner.resolve_limits(domain, results)
+
+    assert results == {
+        'a': {'strategy': TimeSeriesExporter.WINDOWED_MEAN,
+              'columns': ['_time', 'a'],
+              'data': [('a__downgraded', 1.0)]},
+        'b': {'strategy': TimeSeriesExporter.WINDOWED_MEAN,
+              'columns': ['_time', 'b'],
+              'data': [('b__downgraded', 1.0)]},
+    }
+
+
+def test_downgraded_item_errors_are_kept(domain):
+    planner = InfluxDBQueryPlanner(segment_cache=False, shards=1)
+    planner.add_item(_item(domain, 'a'))
+    names = [name for name, _ in planner.generate_queries(domain)]
+    assert names == ['a__downgraded']
+
+    results = {'a__downgraded': {'strategy': {},
+                                 'columns': ['_time', 'a__downgraded'],
+                                 'data': None, 'error': 'failed'}}
+    planner.resolve_limits(domain, results)
+    assert results['a']['error'] == 'failed'
+    assert results['a']['data'] is None
@@ -0,0 +1,183 @@
+
+
+import re
+import asyncio
+import pytest
+from aiohttp import web
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import QueryTimeSpanTModel
+from tendril.connectors.influxdb import tasks
+from tendril.connectors.influxdb.query.rollups import RollupBucket
+from tendril.connectors.influxdb.query.rollups import BandRollup
+from tendril.connectors.influxdb.query.rollups import _get_serving_rollups
+
+
+pytestmark = pytest.mark.skipif(not INFLUXDB_BUCKETS,
+                                reason="No InfluxDB buckets configured")
+
+
+def _rollup(fn, resolution=3600, bucket=None):
+    return RollupBucket(INFLUXDB_BUCKETS[0], bucket or f'rollup_{fn}',
+                        resolution, fn)
+
+
+class _StandIn(object):
+    # Stands in for the InfluxDB tasks and query APIs. Tasks are held by
+    # id, and queries whose range starts at a time in fail_starts fail.
+    def __init__(self, fail_starts=()):
+        self.tasks = {}
+        self.queries = []
+        self.fail_starts = fail_starts
+        self._runner = None
+
+    def add_task(self, name, flux, status='active'):
+        task_id = f'{len(self.tasks) + 1:016x}'
+        self.tasks[task_id] = {'id': task_id, 'orgID': '0' * 16,
+                               'name': name, 'flux': flux, 'status': status}
+        return task_id
+
+    async def _get_tasks(self, request):
+        return web.json_response({'tasks': list(self.tasks.values())})
+
+    async def _post_task(self, request):
+        body = await request.json()
+        name = re.search(r'name: "([^"]+)"', body['flux']).group(1)
+        task_id = self.add_task(name, body['flux'], body['status'])
+        return web.json_response(self.tasks[task_id], status=201)
+
+    async def _patch_task(self, request):
+        body = await request.json()
+        task = self.tasks[request.match_info['id']]
+        task.update({k: v for k, v in body.items()
+                     if k in ('flux', 'status')})
+        return web.json_response(task)
+
+    async def _delete_task(self, request):
+        self.tasks.pop(request.match_info['id'])
+        return web.Response(status=204)
+
+    async def _query(self, request):
+        query = (await request.json())['query']
+        self.queries.append(query)
+        start = int(re.search(r'range\(start: (\d+),', query).group(1))
+        if start in self.fail_starts:
+            return web.json_response({'code': 'internal', 'message': 'x'},
+                                     status=500)
+        return web.Response(text='', content_type='text/csv')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/api/v2/tasks', self._get_tasks)
+        app.router.add_post('/api/v2/tasks', self._post_task)
+        app.router.add_patch('/api/v2/tasks/{id}', self._patch_task)
+        app.router.add_delete('/api/v2/tasks/{id}', self._delete_task)
+        app.router.add_post('/api/v2/query', self._query)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        host, port = self._runner.addresses[0][:2]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+@pytest.fixture
+def rollups(monkeypatch):
+    rv = [_rollup('mean'), _rollup('max', resolution=86400)]
+    monkeypatch.setitem(tasks._rollups, INFLUXDB_BUCKETS[0], rv)
+    return rv
+
+
+@pytest.mark.parametrize('fn', ['min', 'max'])
+def test_band_statistic_rollup_flux(fn):
+    flux = tasks.render_rollup_flux(_rollup(fn), 0, 7200, org='org')
+    assert f'r with _value: r.{fn}' in flux
+    assert 'reduce(' in flux
+    assert '|> to(bucket: "rollup_{}", org: "org")'.format(fn) in flux
+
+
+def test_unsupported_rollup_function():
+    with pytest.raises(ValueError):
+        tasks.render_rollup_flux(_rollup('last'), 0, 3600)
+
+
+def test_band_rollups_serve_windowed_band():
+    configured = [_rollup(x) for x in ('min', 'max', 'sum', 'count')]
+    serving = _get_serving_rollups(configured)
+    band = [x for x in serving if isinstance(x, BandRollup)]
+    assert len(band) == 1
+    assert band[0].sources == [configured[0], configured[1],
+                               configured[2], configured[3]]
+    time_span = QueryTimeSpanTModel(
+        start=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        width=timedelta(days=1), window_count=24)
+    now = time_span.end.timestamp() + 86400
+    assert band[0].can_serve(TimeSeriesExporter.WINDOWED_BAND, time_span,
+                             now)
+    assert not configured[0].can_serve(TimeSeriesExporter.WINDOWED_BAND,
+                                       time_span, now)
+
+
+def test_install_diff_and_verify(rollups):
+    async def run():
+        stand_in = _StandIn()
+        url = await stand_in.start()
+        stale = stand_in.add_task('tendril-rollup-stale', 'stale')
+        try:
+            async with tasks.RollupTaskManager(
+                    domains=[INFLUXDB_BUCKETS[0]], url=url, token='t',
+                    org='org') as manager:
+                names = sorted(manager.generate().keys())
+                assert names == ['tendril-rollup-rollup_max',
+                                 'tendril-rollup-rollup_mean']
+                diff = await manager.diff()
+                assert sorted(diff['create']) == names
+                assert diff['delete'] == ['tendril-rollup-stale']
+
+                diff = await manager.install()
+                assert diff['delete'] == []
+                assert stale in stand_in.tasks
+                diff = await manager.install(prune=True)
+                assert diff['create'] == [] and diff['update'] == []
+                assert stale not in stand_in.tasks
+
+                diff = await manager.diff()
+                assert sorted(diff['unchanged']) == names
+                assert await manager.verify() == {x: [] for x in names}
+
+                task = next(x for x in stand_in.tasks.values()
+                            if x['name'] == names[0])
+                task['status'] = 'inactive'
+                assert (await manager.diff())['update'] == [names[0]]
+                assert (await manager.verify())[names[0]] == ['inactive']
+                await manager.install()
+                assert task['status'] == 'active'
+        finally:
+            await stand_in.stop()
+    asyncio.run(run())
+
+
+def test_backfill_reports_failed_chunks(rollups):
+    async def run():
+        day = 86400
+        stand_in = _StandIn(fail_starts=(2 * day,))
+        url = await stand_in.start()
+        try:
+            async with tasks.RollupTaskManager(
+                    domains=[INFLUXDB_BUCKETS[0]], url=url, token='t',
+                    org='org') as manager:
+                failed = await manager.backfill(rollups[1], 100, 6 * day + 5,
+                                                chunk=2 * day, concurrency=2)
+        finally:
+            await stand_in.stop()
+        starts = sorted(int(re.search(r'range\(start: (\d+),', x).group(1))
+                        for x in stand_in.queries)
+        assert starts == [0, 2 * day, 4 * day]
+        assert failed == [(2 * day, 4 * day)]
+    asyncio.run(run())
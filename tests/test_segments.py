@@ -0,0 +1,125 @@
+
+
+import re
+import time
+import asyncio
+import polars
+import pytest
+from datetime import datetime
+from datetime import timezone
+
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import QueryTimeSpanTModel
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+from tendril.connectors.influxdb.query.segments import SegmentStore
+from tendril.connectors.influxdb.query.segments import \
+    SegmentCachedFluxQueryBuilder
+
+
+pytestmark = pytest.mark.skipif(not INFLUXDB_BUCKETS,
+                                reason="No InfluxDB buckets configured")
+
+
+_rate = 10
+_range = re.compile(r'range\(start: (-inf|\d+), stop: (\d+)\)')
+
+
+def _to_datetime(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc)
+
+
+class _Fetch(object):
+    # Answers gap scripts with a raw series sampled every _rate seconds,
+    # valued at its epoch time, and open value scripts with the last
+    # sample before their stop. Records the ranges asked for.
+    def __init__(self, export_name='a', measurement='channel0'):
+        self.export_name = export_name
+        self.measurement = measurement
+        self.gaps = []
+
+    @staticmethod
+    def _frame(start, end, column):
+        times = list(range(start + (-start % _rate), end, _rate))
+        return polars.DataFrame({
+            '_time': [_to_datetime(x) for x in times],
+            column: [float(x) for x in times],
+        })
+
+    async def __call__(self, script):
+        rv = {}
+        for start, stop in _range.findall(script):
+            stop = int(stop)
+            if start == '-inf':
+                last = (stop - 1) - (stop - 1) % _rate
+                rv[f'{self.export_name}__openValue'] = \
+                    self._frame(last, last + 1, '_value')
+            else:
+                self.gaps.append((int(start), stop))
+                rv[self.export_name] = self._frame(int(start), stop,
+                                                   self.measurement)
+        return rv
+
+
+def _builder(store, start, end, include_ends=False, live_margin=60):
+    time_span = QueryTimeSpanTModel(start=_to_datetime(start),
+                                    end=_to_datetime(end))
+    item = TimeSeriesQueryItemTModel(domain=INFLUXDB_BUCKETS[0],
+                                     export_name='a', measurement='channel0',
+                                     tags={}, fields=['value'],
+                                     exporter=TimeSeriesExporter.RAW,
+                                     time_span=time_span,
+                                     include_ends=include_ends)
+    return SegmentCachedFluxQueryBuilder([item], windowed=False, store=store,
+                                         live_margin=live_margin)
+
+
+def _expected(start, end):
+    return [(_to_datetime(x), float(x)) for x in range(start, end, _rate)]
+
+
+_start = 1704067200
+
+
+def test_cached_span_is_not_fetched_again():
+    store = SegmentStore(10000)
+    fetch = _Fetch()
+    end = _start + 3600
+    first = asyncio.run(_builder(store, _start, end).execute(fetch))
+    second = asyncio.run(_builder(store, _start, end).execute(fetch))
+    assert first == second == {'a': _expected(_start, end)}
+    assert fetch.gaps == [(_start, end)]
+
+
+def test_only_uncovered_parts_are_fetched():
+    store = SegmentStore(10000)
+    fetch = _Fetch()
+    asyncio.run(_builder(store, _start + 600, _start + 1200).execute(fetch))
+    rv = asyncio.run(_builder(store, _start, _start + 1800).execute(fetch))
+    assert rv == {'a': _expected(_start, _start + 1800)}
+    assert fetch.gaps == [(_start + 600, _start + 1200),
+                          (_start, _start + 600),
+                          (_start + 1200, _start + 1800)]
+
+
+def test_open_value_is_stitched_before_the_start():
+    store = SegmentStore(10000)
+    fetch = _Fetch()
+    end = _start + 600
+    builder = _builder(store, _start + 5, end, include_ends=True)
+    rv = asyncio.run(builder.execute(fetch))
+    assert rv == {'a': _expected(_start, end)}
+
+
+def test_live_margin_is_always_fetched():
+    store = SegmentStore(10000)
+    fetch = _Fetch()
+    now = int(time.time())
+    start = now - 600
+    horizon = now - 60
+    asyncio.run(_builder(store, start, now).execute(fetch))
+    asyncio.run(_builder(store, start, now).execute(fetch))
+    assert fetch.gaps[0] == (start, now)
+    assert len(fetch.gaps) == 2
+    assert fetch.gaps[1][0] >= horizon - 1
+    assert fetch.gaps[1][1] == now
@@ -0,0 +1,143 @@
+
+
+import re
+import asyncio
+import polars
+import pytest
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import QueryTimeSpanTModel
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+from tendril.connectors.influxdb.query.sharded import \
+    ShardBatchedFluxQueryBuilder
+from tendril.connectors.influxdb.query.sharded import ShardedFluxQueryBuilder
+
+
+pytestmark = pytest.mark.skipif(not INFLUXDB_BUCKETS,
+                                reason="No InfluxDB buckets configured")
+
+
+_start = 1704067200
+_rate = 10
+_range = re.compile(r'range\(start: (\d+), stop: (\d+)\)')
+_step_size = (0, 150)
+
+
+def _to_datetime(ts):
+    return datetime.fromtimestamp(ts, tz=timezone.utc)
+
+
+def _item(export_name, exporter, width, start=_start, window_count=240):
+    time_span = QueryTimeSpanTModel(start=_to_datetime(start),
+                                    width=timedelta(seconds=width),
+                                    window_count=window_count)
+    return TimeSeriesQueryItemTModel(domain=INFLUXDB_BUCKETS[0],
+                                     export_name=export_name,
+                                     measurement=f'{export_name}_channel',
+                                     tags={}, fields=['value'],
+                                     exporter=exporter, time_span=time_span,
+                                     include_ends=False)
+
+
+def _series(export_name, start, end):
+    # Values of the changes series repeat, and the discontinuities series
+    # has both small steps and steps outside _step_size.
+    times = list(range(start + (-start % _rate), end, _rate))
+    if export_name == 'changes':
+        values = [float((x // 40) % 3) for x in times]
+    else:
+        values = [float((x // _rate % 37) * 5 + 300 * (x // 500 % 2))
+                  for x in times]
+    return polars.DataFrame({
+        '_time': [_to_datetime(x) for x in times],
+        f'{export_name}_channel': values,
+    }).with_columns(polars.col('_time').cast(polars.Datetime('ns', 'UTC')))
+
+
+def _changes(df):
+    # As the server side changes filter, which keeps the first and last
+    # rows.
+    column = df.columns[1]
+    keep = df[column].ne_missing(df[column].shift(1))
+    keep[df.height - 1] = True
+    return df.filter(keep)
+
+
+def _discontinuities(df):
+    # As the flux discontinuities filter, which keeps the first and last
+    # rows.
+    value = polars.col(df.columns[1])
+    lower, upper = _step_size
+    before = value - value.shift(1)
+    after = value.shift(-1) - value
+    step = (before < lower) | (before > upper) | \
+        (after < lower) | (after > upper)
+    keep = step.fill_null(True)
+    return df.filter(keep)
+
+
+class _Fetch(object):
+    # Answers each shard script with the filtered rows of its range for
+    # each item, and the edge rows of the discontinuities item.
+    def __init__(self):
+        self.shards = []
+
+    async def __call__(self, script):
+        start, end = (int(x) for x in _range.search(script).groups())
+        self.shards.append((start, end))
+        rv = {}
+        for name, filter_rows in (('changes', _changes),
+                                  ('discontinuities', _discontinuities)):
+            df = _series(name, start, end)
+            rv[name] = filter_rows(df)
+            edges = polars.concat([df.head(2), df.tail(2)])
+            rv[ShardBatchedFluxQueryBuilder.edges_name(name)] = edges
+        return rv
+
+
+@pytest.mark.parametrize('shards', [1, 2, 3, 7, 13])
+def test_raw_shard_bounds(shards):
+    builder = ShardedFluxQueryBuilder(
+        [_item('a', TimeSeriesExporter.RAW, 3605)], windowed=False,
+        shards=shards)
+    bounds = builder.shard_bounds()
+    assert len(bounds) == shards
+    assert bounds[0][0] == _start
+    assert bounds[-1][1] == _start + 3605
+    assert all(a[1] == b[0] for a, b in zip(bounds[:-1], bounds[1:]))
+    assert all(a < b for a, b in bounds)
+
+
+@pytest.mark.parametrize('shards', [1, 2, 3, 7])
+def test_windowed_shard_bounds_are_aligned(shards):
+    start = _start + 25
+    item = _item('a', TimeSeriesExporter.WINDOWED_MEAN, 3600, start=start,
+                 window_count=60)
+    builder = ShardedFluxQueryBuilder([item], windowed=True, shards=shards)
+    bounds = builder.shard_bounds()
+    assert bounds[0][0] == start
+    assert bounds[-1][1] == start + 3600
+    assert all(a[1] == b[0] for a, b in zip(bounds[:-1], bounds[1:]))
+    assert all(a % 60 == 0 for a, _ in bounds[1:])
+    assert len(bounds) <= shards
+
+
+@pytest.mark.parametrize('shards', [2, 3, 7])
+def test_seams_are_resolved_as_unsharded(shards):
+    items = [_item('changes', TimeSeriesExporter.CHANGES_ONLY, 3600),
+             _item('discontinuities',
+                   TimeSeriesExporter.DISCONTINUITIES_ONLY, 3600)]
+    builder = ShardedFluxQueryBuilder(items, windowed=False, shards=shards)
+    fetch = _Fetch()
+    rv = asyncio.run(builder.execute(fetch))
+    assert len(fetch.shards) == shards
+    end = _start + 3600
+    assert rv == {
+        'changes': _changes(_series('changes', _start, end)).rows(),
+        'discontinuities':
+            _discontinuities(_series('discontinuities', _start, end)).rows(),
+    }
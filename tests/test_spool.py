@@ -0,0 +1,149 @@
+
+
+import os
+import asyncio
+import pytest
+from influxdb_client.rest import ApiException
+
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.connectors.influxdb.spool import WriteSpool
+from tendril.connectors.influxdb.spool import sync_files
+from tendril.connectors.influxdb.writer import InfluxDBAsyncWriter
+
+
+def _payload(count, prefix='m'):
+    return '\n'.join(f'{prefix} value={idx}' for idx in range(count))
+
+
+def _segment_files(directory):
+    return sorted(name for _, _, names in os.walk(directory)
+                  for name in names if name.endswith('.seg'))
+
+
+def test_peek_combines_records_until_ack(tmp_path):
+    spool = WriteSpool(str(tmp_path), 1 << 20, 4096)
+    assert spool.peek(10) is None
+    for prefix in 'abc':
+        assert spool.append('ops', 4, _payload(4, prefix))
+    assert spool.depth == 12
+
+    domain, records, lines, payload = spool.peek(10)
+    assert (domain, records, lines) == ('ops', 2, 8)
+    assert payload == '\n'.join([_payload(4, 'a'), _payload(4, 'b')]).encode()
+    assert spool.peek(10) == (domain, records, lines, payload)
+
+    spool.ack(domain, records)
+    assert spool.peek(10) == ('ops', 1, 4, _payload(4, 'c').encode())
+    spool.ack('ops', 1)
+    assert spool.peek(10) is None
+    assert not spool
+    spool.close()
+    assert _segment_files(tmp_path) == []
+
+
+def test_oversized_payloads_are_returned_alone(tmp_path):
+    spool = WriteSpool(str(tmp_path), 1 << 20, 4096)
+    spool.append('ops', 100, _payload(100))
+    spool.append('ops', 1, _payload(1))
+    assert spool.peek(10)[1:3] == (1, 100)
+    spool.close()
+
+
+def test_segments_are_rolled_and_removed_once_drained(tmp_path):
+    spool = WriteSpool(str(tmp_path), 1 << 20, 256)
+    for prefix in 'abcdef':
+        spool.append('ops', 10, _payload(10, prefix))
+    assert len(_segment_files(tmp_path)) > 1
+    while True:
+        record = spool.peek(10)
+        if record is None:
+            break
+        spool.ack(record[0], record[1])
+    assert len(_segment_files(tmp_path)) == 1
+    spool.close()
+
+
+def test_full_spool_refuses_appends(tmp_path):
+    spool = WriteSpool(str(tmp_path), 512, 256)
+    assert spool.append('ops', 4, _payload(4))
+    appended = [spool.append('ops', 4, _payload(4)) for _ in range(100)]
+    assert appended[-1] is False
+    assert spool.size <= 512
+    spool.close()
+
+
+def test_unacked_records_are_recovered(tmp_path):
+    spool = WriteSpool(str(tmp_path), 1 << 20, 4096)
+    spool.append('ops', 2, _payload(2, 'a'))
+    spool.append('ops', 2, _payload(2, 'b'))
+    spool.append('monitors', 3, _payload(3, 'c'))
+    spool.ack('ops', 1)
+    spool.close()
+
+    # Read positions are not persisted, so delivery is at least once.
+    spool = WriteSpool(str(tmp_path), 1 << 20, 4096)
+    assert spool.depth == 7
+    rv = {}
+    while True:
+        record = spool.peek(100)
+        if record is None:
+            break
+        rv[record[0]] = record[3]
+        spool.ack(record[0], record[1])
+    assert rv == {
+        'ops': '\n'.join([_payload(2, 'a'), _payload(2, 'b')]).encode(),
+        'monitors': _payload(3, 'c').encode(),
+    }
+    spool.close()
+    assert _segment_files(tmp_path) == []
+
+
+def test_appended_segments_are_synced_once(tmp_path):
+    spool = WriteSpool(str(tmp_path), 1 << 20, 4096)
+    assert spool.detach_dirty() == []
+    spool.append('ops', 1, _payload(1))
+    spool.append('monitors', 1, _payload(1))
+    fds = spool.detach_dirty()
+    assert len(fds) == 2
+    assert spool.detach_dirty() == []
+    sync_files(fds)
+    for fd in fds:
+        with pytest.raises(OSError):
+            os.fstat(fd)
+    spool.close()
+
+
+@pytest.mark.skipif(not INFLUXDB_BUCKETS,
+                    reason="No InfluxDB buckets configured")
+def test_writer_spools_failed_writes_and_drains_them(tmp_path, monkeypatch):
+    domain = INFLUXDB_BUCKETS[0]
+    sent = []
+    available = asyncio.Event()
+
+    async def _send(domain, payload):
+        if not available.is_set():
+            raise ApiException(status=503)
+        sent.append(payload)
+
+    async def run():
+        writer = InfluxDBAsyncWriter(batch_size=5, flush_interval=0.05,
+                                     max_retries=0, retry_interval=0.001,
+                                     max_retry_delay=0.01,
+                                     spool_directory=str(tmp_path),
+                                     drain_rate=0)
+        monkeypatch.setattr(writer, '_send', _send)
+        async with writer:
+            await writer.write_lines(_payload(10).split('\n'), domain=domain)
+            await writer.flush()
+            assert writer.stats()['spooled'] == 10
+            available.set()
+            for _ in range(100):
+                if writer.stats()['written'] == 10:
+                    break
+                await asyncio.sleep(0.02)
+        assert writer.stats()['written'] == 10
+        assert writer.stats()['dropped'] == 0
+        assert b'\n'.join(x if isinstance(x, bytes) else x.encode()
+                          for x in sent) == _payload(10).encode()
+    asyncio.run(run())
+    assert _segment_files(tmp_path) == []
@@ -0,0 +1,93 @@
+
+
+import polars
+import pytest
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.core.tsdb.constants import TimeSeriesExporter
+from tendril.core.tsdb.query.models import QueryTimeSpanTModel
+from tendril.core.tsdb.query.models import TimeSeriesQueryItemTModel
+from tendril.connectors.influxdb.query.builder import SimpleFluxQueryBuilder
+from tendril.connectors.influxdb.query.builder import \
+    ChangesOnlyFluxQueryBuilder
+from tendril.connectors.influxdb.query.streaming import BatchedStreamRepacker
+
+
+pytestmark = pytest.mark.skipif(not INFLUXDB_BUCKETS,
+                                reason="No InfluxDB buckets configured")
+
+
+_start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def _item(exporter):
+    time_span = QueryTimeSpanTModel(start=_start, width=timedelta(hours=1))
+    return TimeSeriesQueryItemTModel(domain=INFLUXDB_BUCKETS[0],
+                                     export_name='a', measurement='channel0',
+                                     tags={}, fields=['value'],
+                                     exporter=exporter, time_span=time_span)
+
+
+def _frame(values):
+    times = [_start + timedelta(seconds=10 * idx)
+             for idx in range(len(values))]
+    return polars.DataFrame({'_time': times, 'channel0': values})
+
+
+def _stream(repacker, df, chunk_rows):
+    rv = []
+    for offset in range(0, df.height, chunk_rows):
+        rv.extend(repacker.feed('_result', df.slice(offset, chunk_rows)))
+    rv.extend(repacker.finish())
+    return rv
+
+
+_series = [
+    [1.0, 1.0, 2.0, 2.0, 2.0, 3.0, 1.0, 1.0],
+    [1.0, 1.0, 1.0, 1.0],
+    [1.0, None, None, 2.0, 2.0],
+    [5.0],
+]
+
+
+@pytest.mark.parametrize('values', _series)
+@pytest.mark.parametrize('chunk_rows', [1, 2, 3, 100])
+def test_changes_only_stream_matches_repacker(values, chunk_rows):
+    builder = ChangesOnlyFluxQueryBuilder(
+        _item(TimeSeriesExporter.CHANGES_ONLY), lone_value=True,
+        server_side=False)
+    df = _frame(values)
+    expected = builder.repacker({'_result': df})
+    assert _stream(builder.stream_repacker(), df, chunk_rows) == expected
+
+
+def test_changes_only_stream_holds_back_last_row():
+    builder = ChangesOnlyFluxQueryBuilder(
+        _item(TimeSeriesExporter.CHANGES_ONLY), lone_value=True,
+        server_side=False)
+    repacker = builder.stream_repacker()
+    df = _frame([1.0, 1.0, 1.0])
+    assert repacker.feed('_result', df) == [(df['_time'][0], 1.0)]
+    assert repacker.finish() == [(df['_time'][2], 1.0)]
+
+
+def test_simple_stream_matches_repacker():
+    builder = SimpleFluxQueryBuilder(_item(TimeSeriesExporter.RAW),
+                                     lone_value=True)
+    df = _frame([1.0, 2.0, 2.0, None])
+    assert _stream(builder.stream_repacker(), df, 3) == \
+        builder.repacker({'_result': df})
+
+
+def test_batched_stream_routes_results():
+    builder = SimpleFluxQueryBuilder(_item(TimeSeriesExporter.RAW),
+                                     lone_value=True)
+    repacker = BatchedStreamRepacker({'a': builder.stream_repacker()})
+    df = _frame([1.0, 2.0])
+    assert repacker.feed('b', df) is None
+    assert repacker.feed('a', df.head(0)) is None
+    assert repacker.feed('a', df) == {'a': df.rows()}
+    assert repacker.finish() == {}
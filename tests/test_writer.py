@@ -0,0 +1,143 @@
+
+
+import asyncio
+import pytest
+from influxdb_client.rest import ApiException
+
+from tendril.config import INFLUXDB_BUCKETS
+from tendril.connectors.influxdb.writer import InfluxDBAsyncWriter
+
+
+pytestmark = pytest.mark.skipif(not INFLUXDB_BUCKETS,
+                                reason="No InfluxDB buckets configured")
+
+
+class _Server(object):
+    # Stands in for the writes to the server. Sends wait while the gate
+    # is closed, and fail with the queued errors, if any, first.
+    def __init__(self):
+        self.sent = []
+        self.attempts = 0
+        self.errors = []
+        self.gate = asyncio.Event()
+        self.gate.set()
+
+    async def send(self, domain, payload):
+        self.attempts += 1
+        await self.gate.wait()
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append((domain, payload.split('\n')))
+
+
+def _writer(monkeypatch, **kwargs):
+    kwargs.setdefault('flush_interval', 60)
+    kwargs.setdefault('retry_interval', 0.001)
+    kwargs.setdefault('max_retry_delay', 0.01)
+    kwargs.setdefault('spool_directory', None)
+    writer = InfluxDBAsyncWriter(**kwargs)
+    server = _Server()
+    monkeypatch.setattr(writer, '_send', server.send)
+    return writer, server
+
+
+def _lines(count, prefix='m'):
+    return [f'{prefix} value={idx}' for idx in range(count)]
+
+
+def test_full_batches_are_sent_and_rest_on_close(monkeypatch):
+    async def run():
+        writer, server = _writer(monkeypatch, batch_size=10)
+        domain = INFLUXDB_BUCKETS[0]
+        async with writer:
+            await writer.write_lines(_lines(25), domain=domain)
+            await asyncio.sleep(0.05)
+            assert [len(x) for _, x in server.sent] == [10, 10]
+        assert [len(x) for _, x in server.sent] == [10, 10, 5]
+        assert sum((x for _, x in server.sent), []) == _lines(25)
+        assert writer.stats()['written'] == 25
+    asyncio.run(run())
+
+
+def test_partial_buffer_is_flushed_by_deadline(monkeypatch):
+    async def run():
+        writer, server = _writer(monkeypatch, batch_size=10,
+                                 flush_interval=0.1)
+        domain = INFLUXDB_BUCKETS[0]
+        async with writer:
+            await writer.write_lines(_lines(3), domain=domain)
+            await asyncio.sleep(0.02)
+            assert server.sent == []
+            await asyncio.sleep(0.2)
+            assert server.sent == [(domain, _lines(3))]
+    asyncio.run(run())
+
+
+def test_stalled_domain_does_not_hold_up_others(monkeypatch):
+    if len(INFLUXDB_BUCKETS) < 2:
+        pytest.skip("Two InfluxDB buckets are needed")
+
+    async def run():
+        writer, server = _writer(monkeypatch, batch_size=2)
+        stalled, other = INFLUXDB_BUCKETS[0], INFLUXDB_BUCKETS[-1]
+        send = server.send
+
+        async def _send(domain, payload):
+            if domain == stalled:
+                await asyncio.sleep(0.5)
+            await send(domain, payload)
+        monkeypatch.setattr(writer, '_send', _send)
+        async with writer:
+            await writer.write_lines(_lines(2), domain=stalled)
+            await writer.write_lines(_lines(2, 'n'), domain=other)
+            await asyncio.sleep(0.1)
+            assert server.sent == [(other, _lines(2, 'n'))]
+        assert len(server.sent) == 2
+    asyncio.run(run())
+
+
+def test_writes_wait_for_pending_lines(monkeypatch):
+    async def run():
+        writer, server = _writer(monkeypatch, batch_size=10, max_pending=10)
+        domain = INFLUXDB_BUCKETS[0]
+        server.gate.clear()
+        async with writer:
+            await writer.write_lines(_lines(10), domain=domain)
+            second = asyncio.create_task(
+                writer.write_lines(_lines(5), domain=domain))
+            await asyncio.sleep(0.05)
+            assert not second.done()
+            assert writer.stats()['pending'] == 10
+            server.gate.set()
+            await asyncio.wait_for(second, timeout=1)
+        assert writer.stats()['written'] == 15
+    asyncio.run(run())
+
+
+def test_transient_errors_are_retried(monkeypatch):
+    async def run():
+        writer, server = _writer(monkeypatch, batch_size=5)
+        domain = INFLUXDB_BUCKETS[0]
+        server.errors = [ApiException(status=503), ApiException(status=429)]
+        async with writer:
+            await writer.write_lines(_lines(5), domain=domain)
+        assert server.attempts == 3
+        assert server.sent == [(domain, _lines(5))]
+        assert writer.stats()['written'] == 5
+    asyncio.run(run())
+
+
+def test_rejected_and_exhausted_writes_are_dropped(monkeypatch):
+    async def run():
+        writer, server = _writer(monkeypatch, batch_size=5, max_retries=1)
+        domain = INFLUXDB_BUCKETS[0]
+        server.errors = [ApiException(status=400)] + \
+            [ApiException(status=503)] * 2
+        async with writer:
+            await writer.write_lines(_lines(5), domain=domain)
+            await writer.flush()
+            await writer.write_lines(_lines(5), domain=domain)
+        assert server.attempts == 3
+        assert server.sent == []
+        assert writer.stats()['dropped'] == 10
+    asyncio.run(run())